@@ -0,0 +1,111 @@
+"""Stacked bands of the population between poverty lines.
+
+The headcounts of an entity at a set of poverty lines (sorted from lowest to highest) split its population into stacked
+bands: the people below the first line, between each line and the next one, and above the last line, which add up to
+the whole population (as shown in stacked area charts). Bands are computed for all rows at once from a (rows, lines)
+matrix of headcounts, so that any set of lines can be used, and the people between any pair of lines (not only
+consecutive ones) can be reported as well.
+
+"""
+
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+
+def check_sorted_povlines(povlines: Sequence) -> None:
+    """Raise a ValueError if the poverty lines are not sorted from lowest to highest (without repetitions)."""
+    if len(povlines) == 0:
+        raise ValueError("At least one poverty line is needed to compute stacked bands.")
+    if np.any(np.diff(np.asarray(povlines, dtype=float)) <= 0):
+        raise ValueError(f"Poverty lines of stacked bands must be sorted from lowest to highest: {list(povlines)}.")
+
+
+def stacked_band_names(povlines: Sequence, suffix: str = '') -> Tuple[List[str], List[str]]:
+    """Return the names of the columns with the number and the percentage of people in each stacked band.
+
+    Parameters
+    ----------
+    povlines : sequence
+        Poverty lines of the bands (sorted from lowest to highest), as they appear in column names.
+    suffix : str, optional
+        Suffix of all names (e.g. '_median' for relative poverty lines).
+
+    Returns
+    -------
+    col_n, col_pct : list of str
+        Names of the number of people (headcount_stacked_below_<line> for each line, and
+        headcount_stacked_above_<last line>), and of their percentage of the population (headcount_ratio_stacked_...).
+
+    """
+    bands = [f'below_{povline}{suffix}' for povline in povlines] + [f'above_{povlines[-1]}{suffix}']
+
+    return [f'headcount_stacked_{band}' for band in bands], [f'headcount_ratio_stacked_{band}' for band in bands]
+
+
+def between_band_names(pairs: Sequence[Tuple], suffix: str = '') -> Tuple[List[str], List[str]]:
+    """Return the names of the columns with the number and the percentage of people between each pair of lines."""
+    bands = [f'between_{low}_{high}{suffix}' for low, high in pairs]
+
+    return [f'headcount_stacked_{band}' for band in bands], [f'headcount_ratio_stacked_{band}' for band in bands]
+
+
+def stacked_bands(headcounts: np.ndarray, population: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute the number and the percentage of people in each stacked band.
+
+    Parameters
+    ----------
+    headcounts : np.ndarray
+        Number of people below each poverty line (rows, lines), with lines sorted from lowest to highest.
+    population : np.ndarray
+        Population of each row.
+
+    Returns
+    -------
+    counts : np.ndarray
+        Number of people (rows, lines + 1) below the first line, between each line and the previous one, and above the
+        last line.
+    shares : np.ndarray
+        Percentage of the population in each band (rows, lines + 1), adding up to 100 for each row.
+
+    """
+    headcounts = np.asarray(headcounts)
+    population = np.asarray(population).reshape(-1, 1)
+    bounds = np.empty((headcounts.shape[0], headcounts.shape[1] + 2), dtype=np.result_type(headcounts, population))
+    bounds[:, 0] = 0
+    bounds[:, 1:-1] = headcounts
+    bounds[:, -1:] = population
+    counts = np.diff(bounds, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = counts / population * 100
+
+    return counts, shares
+
+
+def between_bands(values: np.ndarray, povlines: Sequence, pairs: Sequence[Tuple]) -> np.ndarray:
+    """Compute the difference of the values at each pair of poverty lines (e.g. the people between them).
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Values at each poverty line (rows, lines), e.g. headcounts or headcount ratios.
+    povlines : sequence
+        Poverty lines of the columns of `values`.
+    pairs : sequence of tuple
+        Pairs of poverty lines (low, high), both in `povlines`.
+
+    Returns
+    -------
+    differences : np.ndarray
+        Value at the high line minus the value at the low line of each pair (rows, pairs).
+
+    """
+    values = np.asarray(values)
+    positions = {povline: j for j, povline in enumerate(povlines)}
+    for low, high in pairs:
+        if (low not in positions) or (high not in positions) or (low >= high):
+            raise ValueError(f"Pair of poverty lines ({low}, {high}) must be two of {list(povlines)}, lowest first.")
+    low_positions = [positions[low] for low, _ in pairs]
+    high_positions = [positions[high] for _, high in pairs]
+
+    return values[:, high_positions] - values[:, low_positions]
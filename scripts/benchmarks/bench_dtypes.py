@@ -0,0 +1,73 @@
+"""Report the memory of the full-distribution grid with the default and the compact dtypes.
+
+The full-distribution extraction parses one response of the PIP API (with all country-years) per poverty line of the
+grid (about 4,000 lines), and concatenates them. The responses of a sample of the lines are generated by the synthetic
+client of the transforms benchmark, and parsed both with the default types of pandas and with the compact types of
+scripts/dtypes.py. The memory of each (including the Python strings of text columns) is reported, extrapolated to the
+whole grid, and the values of both are checked to be the same.
+
+Run with:
+    python -m scripts.benchmarks.bench_dtypes
+
+"""
+
+import argparse
+import io
+
+import numpy as np
+import pandas as pd
+
+from scripts.benchmarks.bench_transforms import SyntheticPIPClient
+from scripts.dtypes import compact_dtypes, memory_usage_mb
+from scripts.shared import percentile_povline_list_dict
+
+
+def parse_grid(client: SyntheticPIPClient, povlines_cents: list, compact: bool, float32: bool = False) -> pd.DataFrame:
+    """Parse the responses of the synthetic client for each poverty line, and concatenate them."""
+    dfs = []
+    for povline in povlines_cents:
+        content = client.get(f'https://api.worldbank.org/pip/v1/pip?povline={povline / 100}&format=csv')
+        df = pd.read_csv(io.StringIO(content.decode('utf-8')))
+        dfs.append(compact_dtypes(df, float32=float32) if compact else df)
+    df_complete = pd.concat(dfs, ignore_index=True)
+
+    return compact_dtypes(df_complete, float32=float32) if compact else df_complete
+
+
+def main(n_povlines: int, scale: int) -> None:
+    povlines_cents = [povline for povlines in percentile_povline_list_dict().values() for povline in povlines]
+    sample = [povlines_cents[int(i)] for i in np.linspace(0, len(povlines_cents) - 1, n_povlines)]
+    client = SyntheticPIPClient(scale)
+    print(f'Grid of {len(client.countries)} country-years x {len(povlines_cents)} poverty lines, '
+          f'extrapolated from {len(sample)} lines.')
+
+    df_default = parse_grid(client, sample, compact=False)
+    df_compact = parse_grid(client, sample, compact=True)
+    df_float32 = parse_grid(client, sample, compact=True, float32=True)
+
+    factor = len(povlines_cents) / len(sample)
+    memory_default = memory_usage_mb(df_default) * factor
+    print(f'{"Dtypes":<28} {"Memory (MB)":>12} {"Reduction":>10}')
+    for label, df in [('default', df_default), ('compact', df_compact), ('compact, float32 metrics', df_float32)]:
+        memory = memory_usage_mb(df) * factor
+        print(f'{label:<28} {memory:>12.0f} {memory_default / memory:>9.1f}x')
+
+    pd.testing.assert_frame_equal(df_compact.astype(df_default.dtypes.to_dict()), df_default, check_exact=True)
+    print('Default and compact dtypes give the same values.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n",
+        "--n_povlines",
+        type=int,
+        default=50,
+        help="Number of poverty lines of the grid that are parsed (memory is extrapolated to the whole grid).",
+    )
+    parser.add_argument("--scale",
+        type=int,
+        default=1,
+        help="Multiple of the current number of country-years (about 2,000) of the synthetic data.",
+    )
+    args = parser.parse_args()
+    main(n_povlines=args.n_povlines, scale=args.scale)
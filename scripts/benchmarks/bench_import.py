@@ -0,0 +1,48 @@
+"""Benchmark the time it takes to import the modules of the pipeline.
+
+Each import is timed in a fresh Python process (so that nothing is already loaded), several times, and the median is
+reported. Scripts that only need paths (like the tests of the output dataset, or the upload to S3) import
+`scripts.constants`, which should take a few milliseconds, while `scripts.shared` loads numpy and pandas.
+
+Run with:
+    python -m scripts.benchmarks.bench_import
+
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+# Modules to import, from the lightest to the heaviest.
+MODULES = [
+    "scripts.constants",
+    "scripts.storage",
+    "scripts.pip_client",
+    "scripts.shared",
+    "scripts.make_dataset",
+]
+# Root folder of the repository (from which the modules are imported).
+ROOT_DIR = Path(__file__).parents[2]
+
+
+def time_import(module: str) -> float:
+    """Return the time (in seconds) that it takes to import a module in a fresh Python process."""
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT_DIR, capture_output=True, text=True, check=True)
+
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def main(repeats: int = 5) -> None:
+    for module in MODULES:
+        durations = [time_import(module) for _ in range(repeats)]
+        print(f"{module:<24} {statistics.median(durations) * 1000:8.1f} ms (median of {repeats} runs)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--repeats", type=int, default=5, help="Number of times each module is imported.")
+    args = parser.parse_args()
+    main(repeats=args.repeats)
@@ -0,0 +1,90 @@
+"""Benchmark the search of the grid points closest to each percentile.
+
+Compares the previous approach (recomputing the distance to each of the 99 percentiles over the whole grid, and sorting
+and grouping it every time) with `find_closest_percentiles`, on a synthetic grid of the size of the full distribution
+extraction (about 2,000 country-years times 3,500 poverty lines), and checks that both give the same output.
+
+Run with:
+    python -m scripts.benchmarks.bench_percentiles
+
+"""
+
+import argparse
+import time
+from math import erf, sqrt
+
+import numpy as np
+import pandas as pd
+
+from scripts.percentiles import find_closest_percentiles
+from scripts.shared import percentile_povline_list_dict
+
+ID_COLS = ['Entity', 'Year', 'reporting_level', 'welfare_type']
+
+
+def make_grid(n_entities: int, povlines_cents: list, seed: int = 0) -> pd.DataFrame:
+    """Generate a grid of headcount ratios of lognormal distributions, for each entity and poverty line."""
+    rng = np.random.default_rng(seed)
+    medians = rng.lognormal(mean=2, sigma=1, size=n_entities)
+    sigmas = rng.uniform(0.3, 1.2, size=n_entities)
+    povlines = np.asarray(povlines_cents) / 100
+    # Headcounts rounded as in the API responses, to have ties as in real data.
+    z_scores = (np.log(povlines)[None, :] - np.log(medians)[:, None]) / sigmas[:, None]
+    headcounts = np.round(0.5 * (1 + np.vectorize(erf)(z_scores / sqrt(2))), 10)
+    # The grid is made of one response (with all entities) per poverty line.
+    return pd.DataFrame({
+        'Entity': np.tile([f'Country {i // 3}' for i in range(n_entities)], len(povlines)),
+        'Year': np.tile(2000 + np.arange(n_entities) % 3, len(povlines)),
+        'reporting_level': 'national',
+        'welfare_type': 'income',
+        'poverty_line': np.repeat(povlines, n_entities),
+        'headcount': headcounts.T.ravel(),
+    })
+
+
+def find_closest_percentiles_by_sorting(df_complete: pd.DataFrame) -> pd.DataFrame:
+    """Previous approach of generate_percentiles_countries."""
+    df_complete = df_complete.copy()
+    df_closest_complete = pd.DataFrame()
+    for p in range(1, 100, 1):
+        df_complete['distance_to_p'] = abs(df_complete['headcount']-p/100)
+        df_closest = df_complete.sort_values("distance_to_p").groupby(ID_COLS, as_index=False).first()
+        df_closest['target_percentile'] = f'P{p}'
+        df_closest = df_closest[ID_COLS + ['target_percentile', 'poverty_line', 'headcount', 'distance_to_p']]
+        df_closest_complete = pd.concat([df_closest_complete, df_closest], ignore_index=True)
+
+    return df_closest_complete
+
+
+def main(n_entities: int) -> None:
+    povlines_cents = [povline for povlines in percentile_povline_list_dict().values() for povline in povlines]
+    df_complete = make_grid(n_entities, povlines_cents)
+    print(f'Grid of {n_entities} entities x {len(povlines_cents)} poverty lines ({len(df_complete)} rows).')
+
+    start_time = time.perf_counter()
+    df_sorting = find_closest_percentiles_by_sorting(df_complete)
+    time_sorting = time.perf_counter() - start_time
+    print(f'Sorting the grid for each percentile: {time_sorting:.2f} seconds')
+
+    start_time = time.perf_counter()
+    df_searching = find_closest_percentiles(df_complete, ID_COLS)
+    time_searching = time.perf_counter() - start_time
+    print(f'Binary search of all percentiles at once: {time_searching:.2f} seconds')
+    print(f'Speedup: {time_sorting / time_searching:.1f}x')
+
+    # Both approaches pick an equally close point (they may differ on which one, when several are equally close).
+    pd.testing.assert_frame_equal(df_sorting.drop(columns=['poverty_line', 'headcount']),
+                                  df_searching.drop(columns=['poverty_line', 'headcount']), check_dtype=False)
+    print('Both approaches give the same distances to each percentile.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n",
+        "--n_entities",
+        type=int,
+        default=2000,
+        help="Number of entities (country-years) in the synthetic grid.",
+    )
+    args = parser.parse_args()
+    main(n_entities=args.n_entities)
@@ -0,0 +1,334 @@
+"""Benchmark the transform stages of the pipeline at several scales.
+
+The stages (query_poverty, query_non_poverty, additional_variables_and_check, median_patch, standardise and
+combine_2011_and_2011_data) run on synthetic data, generated at multiples of the current number of country-years
+(about 2,000) and of poverty lines (9). PIP API responses are generated by a synthetic client instead of being queried,
+and all files are read from and written to a temporary folder, so that the benchmark runs offline and leaves the
+datasets untouched. The wall time (best of several runs) and peak memory (traced by tracemalloc) of each stage are
+reported, and compared with a stored baseline, to flag regressions.
+
+Timings depend on the machine, so the baseline is not part of the repository: store one on your machine first
+(in scripts/benchmarks/baseline_transforms.json, or in the file given with --baseline) with:
+    python -m scripts.benchmarks.bench_transforms --save_baseline
+
+and, after changing any of the stages, compare with it:
+    python -m scripts.benchmarks.bench_transforms
+
+Both run at the scales 1x and 10x. The 100x scale (about 200,000 country-years and 900 poverty lines) needs tens of GB
+of memory, so it only runs when asked for, e.g. with --scales 1 10 100.
+
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from math import erf, sqrt
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from scripts import shared
+from scripts.storage import write_intermediate
+
+# Number of countries and years of the synthetic data at scale 1 (about the current number of country-years).
+N_COUNTRIES = 170
+N_YEARS = 12
+# Number of world regions of the synthetic data.
+N_REGIONS = 8
+# Poverty lines (in cents) of each PPP version, as in make_dataset.main.
+POVERTY_LINES_CENTS = {
+    2011: [100, 190, 320, 550, 1000, 2000, 2170, 3000, 4000],
+    2017: [100, 215, 365, 685, 1000, 2000, 2435, 3000, 4000],
+}
+RELATIVE_POVERTY_LINES = [40, 50, 60]
+# Default scales to run at (100x is opt-in, as it needs tens of GB of memory).
+DEFAULT_SCALES = [1, 10]
+# Default file where the baseline is stored, and default relative increase above which a stage is flagged.
+DEFAULT_BASELINE_FILE = Path(__file__).parent / "baseline_transforms.json"
+DEFAULT_TOLERANCE = 0.2
+
+
+def lognormal_cdf(x: np.ndarray, mu: np.ndarray, sigma: np.ndarray) -> np.ndarray:
+    return 0.5 * (1 + np.vectorize(erf)((np.log(x) - mu) / (sigma * sqrt(2))))
+
+
+class SyntheticPIPClient:
+    """Client returning synthetic responses of the PIP API, for countries with lognormal distributions.
+
+    Responses are generated on the first request of each URL and kept in memory, so that the benchmarked stages only
+    pay for parsing them (as they would when served from the response cache).
+
+    """
+
+    def __init__(self, scale: int, seed: int = 0) -> None:
+        rng = np.random.default_rng(seed)
+        n_countries = N_COUNTRIES * scale
+        self.countries = pd.DataFrame({
+            'country_name': np.repeat([f'Country {i}' for i in range(n_countries)], N_YEARS),
+            'country_code': np.repeat([f'C{i:05d}' for i in range(n_countries)], N_YEARS),
+            'reporting_year': np.tile(np.arange(2000, 2000 + N_YEARS), n_countries),
+            'reporting_level': 'national',
+            'welfare_type': np.repeat(np.where(np.arange(n_countries) % 3 == 0, 'consumption', 'income'), N_YEARS),
+        })
+        n_rows = len(self.countries)
+        self.countries['mean'] = rng.lognormal(mean=2, sigma=0.8, size=n_rows)
+        self.countries['sigma'] = rng.uniform(0.4, 1.1, size=n_rows)
+        self.countries['reporting_pop'] = rng.integers(10 ** 5, 10 ** 8, size=n_rows).astype(float)
+        self.countries['median'] = self.countries['mean'] * np.exp(-self.countries['sigma'] ** 2 / 2)
+        self.countries['survey_year'] = self.countries['reporting_year'] + 0.5
+        self.countries['survey_comparability'] = 0.0
+        self.countries['comparable_spell'] = '2000 - 2011'
+        self.countries['mld'] = self.countries['sigma'] ** 2 / 2
+        self.countries['gini'] = 2 * np.vectorize(erf)(self.countries['sigma'] / 2) - 1
+        self.countries['polarization'] = rng.uniform(0.2, 0.5, size=n_rows)
+        shares = np.sort(rng.dirichlet(np.full(10, 5.0), size=n_rows), axis=1)
+        for i in range(10):
+            self.countries[f'decile{i + 1}'] = shares[:, i]
+        for column in ['cpi', 'ppp', 'reporting_gdp', 'reporting_pce']:
+            self.countries[column] = rng.uniform(0.5, 2, size=n_rows)
+        self.countries['distribution_type'] = 'micro'
+        self.countries['estimation_type'] = 'survey'
+
+        self.regions = pd.DataFrame({
+            'region_name': np.repeat([f'Region {i}' for i in range(N_REGIONS)], N_YEARS),
+            'reporting_year': np.tile(np.arange(2000, 2000 + N_YEARS), N_REGIONS),
+        })
+        self.regions['mean'] = rng.lognormal(mean=2, sigma=0.5, size=len(self.regions))
+        self.regions['sigma'] = rng.uniform(0.6, 1.0, size=len(self.regions))
+        self.regions['reporting_pop'] = rng.integers(10 ** 8, 10 ** 9, size=len(self.regions)).astype(float)
+        self._responses: Dict[str, bytes] = {}
+
+    @staticmethod
+    def poverty_measures(df: pd.DataFrame, povline: float) -> pd.DataFrame:
+        mu = np.log(df['mean'].to_numpy()) - df['sigma'].to_numpy() ** 2 / 2
+        sigma = df['sigma'].to_numpy()
+        headcount = lognormal_cdf(np.full(len(df), povline), mu, sigma)
+        # Share of the mean income of people below the line (partial first moment of the lognormal distribution).
+        partial_mean = lognormal_cdf(np.full(len(df), povline), mu + sigma ** 2, sigma) * df['mean'].to_numpy()
+        poverty_gap = np.clip(headcount - partial_mean / povline, 0, None)
+
+        return df.drop(columns=['sigma']).assign(poverty_line=povline, headcount=headcount, poverty_gap=poverty_gap,
+                                                 poverty_severity=poverty_gap ** 2 / np.maximum(headcount, 1e-9),
+                                                 watts=poverty_gap * 1.2)
+
+    def get(self, request_url: str) -> bytes:
+        if request_url not in self._responses:
+            parts = urlsplit(request_url)
+            query = dict(parse_qsl(parts.query))
+            if parts.path.endswith('pip-grp'):
+                df = self.poverty_measures(self.regions, float(query['povline']))
+            else:
+                df = self.poverty_measures(self.countries, float(query['povline']))
+            self._responses[request_url] = df.to_csv(index=False).encode('utf-8')
+
+        return self._responses[request_url]
+
+
+def scaled_poverty_lines(ppp: int, scale: int) -> List[int]:
+    """Return the poverty lines of a PPP version, with evenly spaced lines added to have `scale` times as many."""
+    povlines = POVERTY_LINES_CENTS[ppp]
+    candidates = [povline for povline in range(101, 4000) if povline not in povlines]
+    n_extra = len(povlines) * (scale - 1)
+    extra = [candidates[int(i)] for i in np.linspace(0, len(candidates) - 1, n_extra)] if n_extra > 0 else []
+
+    return sorted(povlines + extra)
+
+
+def write_synthetic_inputs(client: SyntheticPIPClient, temp_dir: Path, input_dir: Path, ppp: int) -> None:
+    """Write the files read by the stages (percentiles, relative poverty and entity mapping) for a PPP version."""
+    (temp_dir / f'ppp_{ppp}/raw').mkdir(parents=True, exist_ok=True)
+    (input_dir / f'ppp_{ppp}').mkdir(parents=True, exist_ok=True)
+    id_cols = ['Entity', 'Year', 'reporting_level', 'welfare_type']
+
+    # Percentiles of countries and regions (only the deciles are used by the stages).
+    countries = client.countries.rename(columns={'country_name': 'Entity', 'reporting_year': 'Year'})
+    regions = client.regions.rename(columns={'region_name': 'Entity', 'reporting_year': 'Year'})
+    regions = regions.assign(reporting_level=np.nan, welfare_type=np.nan)
+    entities = pd.concat([countries[id_cols + ['mean', 'sigma']], regions[id_cols + ['mean', 'sigma']]],
+                         ignore_index=True)
+    deciles = list(range(10, 100, 10))
+    df_percentiles = pd.DataFrame({
+        column: np.tile(entities[column], len(deciles)) for column in id_cols
+    })
+    df_percentiles['target_percentile'] = np.repeat([f'P{p}' for p in deciles], len(entities))
+    z_scores = np.repeat([1.2815516 * (p - 50) / 40 for p in deciles], len(entities))
+    df_percentiles['percentile_value'] = np.tile(entities['mean'] * np.exp(-entities['sigma'] ** 2 / 2), len(deciles)) \
+        * np.exp(np.tile(entities['sigma'], len(deciles)) * z_scores)
+    write_intermediate(df_percentiles, temp_dir / f'ppp_{ppp}/raw/percentiles')
+
+    # Relative poverty, with the columns written by generate_relative_poverty.
+    df_relative = countries[id_cols].copy()
+    for prefix in ['median', 'headcount', 'headcount_ratio', 'poverty_gap_index', 'total_shortfall', 'avg_shortfall',
+                   'income_gap_ratio', 'poverty_severity', 'watts']:
+        for pct in RELATIVE_POVERTY_LINES:
+            column = f'median_{pct}' if prefix == 'median' else f'{prefix}_{pct}_median'
+            df_relative[column] = countries['median'] * pct / 100
+    write_intermediate(df_relative, temp_dir / f'ppp_{ppp}/raw/relative_poverty')
+
+    # Mapping of entity names.
+    names = pd.concat([countries['Entity'], regions['Entity']]).drop_duplicates()
+    pd.DataFrame({'country': names, 'Our World In Data Name': names}).to_csv(
+        input_dir / f'ppp_{ppp}/countries_standardized.csv', index=False)
+
+
+def measure(function: Callable[[], object], repeats: int) -> Tuple[float, float, object]:
+    """Return the best wall time (in seconds) and the peak traced memory (in MB) of a function, and its result."""
+    durations = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(durations), peak / 1024 ** 2, result
+
+
+def run_stages(scale: int, repeats: int, ppp: int = 2017) -> Dict[str, Dict[str, float]]:
+    """Run each transform stage at a scale, returning its wall time and peak memory."""
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        paths = {
+            'TEMP_DIR': temp_dir / 'temp',
+            'INPUT_DIR': temp_dir / 'input',
+            'OUTPUT_CSV_FILE': temp_dir / 'datasets/pip_dataset.csv',
+            'OUTPUT_XLSX_FILE': temp_dir / 'datasets/pip_dataset.xlsx',
+        }
+        paths['OUTPUT_CSV_FILE'].parent.mkdir(parents=True)
+        client = SyntheticPIPClient(scale)
+
+        with mock.patch.multiple(shared, **paths), \
+                mock.patch('builtins.print'):
+            # Both PPP versions are needed by the last stage, but only the stages of one of them are timed.
+            for ppp_version in sorted(POVERTY_LINES_CENTS, key=lambda version: version == ppp):
+                timed = ppp_version == ppp
+                povlines = scaled_poverty_lines(ppp_version, scale)
+                write_synthetic_inputs(client, paths['TEMP_DIR'], paths['INPUT_DIR'], ppp_version)
+                df_country = shared.country_data(povlines[0], filled="false", ppp=ppp_version, additional_dfs=False,
+                                                 client=client)
+                df_region = shared.regional_data(povlines[0], ppp_version, client=client)
+
+                stages = [
+                    ('query_poverty', lambda: shared.query_poverty(povlines, "false", ppp_version, client=client)),
+                    ('query_non_poverty', lambda: shared.query_non_poverty(df_poverty, df_country, df_region)),
+                    ('additional_variables_and_check',
+                     lambda: shared.additional_variables_and_check(
+                         df_relative.copy(), list(povlines), col_relative, ppp_version)),
+                    ('median_patch', lambda: shared.median_patch(df_additional.copy(), ppp_version)),
+                    ('standardise', lambda: shared.standardise(df_median.copy(), cols, ppp_version)),
+                ]
+                # The responses of the API are generated before timing.
+                shared.query_poverty(povlines, "false", ppp_version, client=client)
+                for name, function in stages:
+                    if timed:
+                        duration, peak_mb, result = measure(function, repeats)
+                        results[name] = {'seconds': duration, 'peak_mb': peak_mb}
+                        sys.stdout.write(f'  {name:<32} {duration:9.3f} s {peak_mb:10.1f} MB\n')
+                    else:
+                        result = function()
+
+                    # Steps between the benchmarked stages (not timed).
+                    if name == 'query_poverty':
+                        df_poverty = result
+                    elif name == 'query_non_poverty':
+                        df_thresholds = shared.thresholds(result, answer=False, ppp=ppp_version)
+                        df_relative, col_relative = shared.integrate_relative_poverty(
+                            df_thresholds, df_country, answer=False, ppp=ppp_version)
+                    elif name == 'additional_variables_and_check':
+                        df_additional, cols = result
+                    elif name == 'median_patch':
+                        df_median = result
+
+            duration, peak_mb, _ = measure(shared.combine_2011_and_2011_data, repeats)
+            results['combine_2011_and_2011_data'] = {'seconds': duration, 'peak_mb': peak_mb}
+            sys.stdout.write(f'  {"combine_2011_and_2011_data":<32} {duration:9.3f} s {peak_mb:10.1f} MB\n')
+
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Dict[str, float]]], baseline: Dict[str, Dict[str, Dict[str, float]]],
+            tolerance: float) -> List[str]:
+    """Return the stages (at each scale) whose time or memory increased by more than the tolerance over the baseline."""
+    regressions = []
+    for scale, stages in results.items():
+        for name, measures in stages.items():
+            for measure_name, value in measures.items():
+                baseline_value = baseline.get(scale, {}).get(name, {}).get(measure_name)
+                if (baseline_value is not None) and (value > baseline_value * (1 + tolerance)):
+                    regressions.append(f'{name} at {scale}x: {measure_name} {value:.3f} (baseline {baseline_value:.3f}, '
+                                       f'+{(value / baseline_value - 1) * 100:.0f}%)')
+
+    return regressions
+
+
+def main(scales: List[int], repeats: int, baseline_file: Path, save_baseline: bool, tolerance: float) -> int:
+    results = {}
+    for scale in scales:
+        print(f'Scale {scale}x ({N_COUNTRIES * N_YEARS * scale} country-years, '
+              f'{len(POVERTY_LINES_CENTS[2017]) * scale} poverty lines):')
+        results[str(scale)] = run_stages(scale, repeats)
+
+    if save_baseline:
+        baseline = json.loads(baseline_file.read_text()) if baseline_file.is_file() else {}
+        baseline.update(results)
+        baseline_file.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+        print(f'Baseline saved in {baseline_file}')
+        return 0
+
+    if not baseline_file.is_file():
+        print(f'No baseline found in {baseline_file}, so nothing to compare with. Store one for this machine first, '
+              f'with: python -m scripts.benchmarks.bench_transforms --save_baseline')
+        return 0
+    regressions = compare(results, json.loads(baseline_file.read_text()), tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if len(regressions) == 0:
+        print(f'No regressions (tolerance {tolerance * 100:.0f}%) against {baseline_file}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s",
+        "--scales",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SCALES,
+        help=f"Multiples of the current number of country-years and poverty lines to run the stages at (default "
+             f"{DEFAULT_SCALES}; 100 needs tens of GB of memory).",
+    )
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="Number of timed runs of each stage.")
+    parser.add_argument("--baseline",
+        type=Path,
+        default=DEFAULT_BASELINE_FILE,
+        help=f"File where the baseline is stored (default {DEFAULT_BASELINE_FILE}).",
+    )
+    parser.add_argument("--save_baseline",
+        default=False,
+        action="store_true",
+        help="If given, store the results as the new baseline (for the scales that were run).",
+    )
+    parser.add_argument("--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help=f"Relative increase of time or memory over the baseline flagged as a regression (default "
+             f"{DEFAULT_TOLERANCE}).",
+    )
+    args = parser.parse_args()
+    # Keep the report readable (the stages raise deprecation warnings with recent versions of pandas).
+    warnings.simplefilter("ignore", FutureWarning)
+    sys.exit(main(scales=args.scales, repeats=args.repeats, baseline_file=args.baseline,
+                  save_baseline=args.save_baseline, tolerance=args.tolerance))
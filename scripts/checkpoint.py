@@ -0,0 +1,153 @@
+"""Checkpoints to resume long extractions of poverty line data from the PIP API.
+
+The response of each poverty line is written to its own shard as soon as it is fetched, and recorded in a manifest of
+completed lines. If the extraction is interrupted (by a crash, a network drop, or a SIGINT/SIGTERM signal), a new run
+with `resume=True` only fetches the lines missing from the manifest.
+
+Once the shards of a group of lines are merged into the file of the group, they are deleted (and the group is recorded
+as merged in the manifest), so that the checkpoint does not double the disk space taken by the extraction. The whole
+checkpoint is deleted once all groups are merged.
+
+"""
+
+import json
+import os
+import shutil
+import signal
+import threading
+from pathlib import Path
+from typing import List, Optional, Set
+
+import pandas as pd
+
+from scripts.storage import find_intermediate, read_intermediate, write_intermediate
+
+
+class PovlineCheckpoint:
+    """Per-poverty-line shards of fetched data, with a manifest of the completed lines.
+
+    Parameters
+    ----------
+    checkpoint_dir : Path
+        Directory where shards and the manifest will be stored.
+    version : str
+        PIP data version of the fetched data. Checkpoints of a different version are never resumed.
+    resume : bool, optional
+        True to keep the lines completed by a previous run, False to start afresh (removing any previous checkpoint).
+
+    """
+
+    def __init__(self, checkpoint_dir: Path, version: str, resume: bool = False) -> None:
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.version = version
+        self._lock = threading.Lock()
+        self.completed: Set[int] = set()
+        self.merged: Set[str] = set()
+
+        manifest = self._read_manifest()
+        if resume and (manifest is not None) and (manifest["version"] == version):
+            self.completed = set(manifest["completed"])
+            self.merged = set(manifest.get("merged", []))
+        elif self.checkpoint_dir.is_dir():
+            shutil.rmtree(self.checkpoint_dir)
+
+    @property
+    def manifest_file(self) -> Path:
+        return self.checkpoint_dir / "manifest.json"
+
+    def _shard_path(self, povline: int) -> Path:
+        return self.checkpoint_dir / str(povline)
+
+    def _read_manifest(self) -> Optional[dict]:
+        if not self.manifest_file.is_file():
+            return None
+        with open(self.manifest_file) as file:
+            return json.load(file)
+
+    def _write_manifest(self) -> None:
+        # Called with the lock held.
+        temp_manifest_file = self.manifest_file.with_suffix(".json.tmp")
+        with open(temp_manifest_file, "w") as file:
+            json.dump({"version": self.version, "completed": sorted(self.completed), "merged": sorted(self.merged)},
+                      file)
+        os.replace(temp_manifest_file, self.manifest_file)
+
+    def save(self, povline: int, df: pd.DataFrame) -> None:
+        """Write the data of a poverty line to its shard, and mark the line as completed."""
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        # Shards are written atomically, so an interruption never leaves a partial one.
+        write_intermediate(df, self._shard_path(povline))
+
+        with self._lock:
+            self.completed.add(povline)
+            self._write_manifest()
+
+    def load(self, povline: int) -> pd.DataFrame:
+        """Read the data of a completed poverty line."""
+        return read_intermediate(self._shard_path(povline))
+
+    def missing(self, povlines: List[int]) -> List[int]:
+        """Return the poverty lines (in the given order) that have not been completed yet."""
+        return [povline for povline in povlines if povline not in self.completed]
+
+    def mark_merged(self, group: str, povlines: List[int]) -> None:
+        """Record that the lines of a group were written to the file of the group, and delete their shards."""
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self.merged.add(group)
+            # The manifest is updated first, so that an interruption never leaves a group with missing shards that is
+            # not recorded as merged.
+            self._write_manifest()
+        for povline in povlines:
+            shard_file = find_intermediate(self._shard_path(povline))
+            if shard_file is not None:
+                shard_file.unlink()
+
+    def clear(self) -> None:
+        """Delete the checkpoint (shards and manifest), once all the data fetched was merged into group files."""
+        if self.checkpoint_dir.is_dir():
+            shutil.rmtree(self.checkpoint_dir)
+
+
+class GracefulInterruption:
+    """Context manager that turns SIGINT/SIGTERM into a flag, so that work in progress can be flushed before exiting.
+
+    The first signal sets `interrupted` (workers are expected to stop picking up new work); a second signal gets the
+    default behaviour back, and terminates the program straight away.
+
+    """
+
+    SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+    def __init__(self) -> None:
+        self.interrupted = threading.Event()
+        self.signal_number: Optional[int] = None
+        self._previous_handlers = {}
+
+    def _handle(self, signal_number, frame) -> None:
+        self.signal_number = signal_number
+        self.interrupted.set()
+        print(f"Received {signal.Signals(signal_number).name}: finishing requests in progress and saving checkpoint "
+              "(send it again to exit immediately)...")
+        self._restore()
+
+    def _restore(self) -> None:
+        for signal_number, handler in self._previous_handlers.items():
+            signal.signal(signal_number, handler)
+        self._previous_handlers = {}
+
+    def __enter__(self) -> "GracefulInterruption":
+        # Signal handlers can only be installed from the main thread.
+        if threading.current_thread() is threading.main_thread():
+            for signal_number in self.SIGNALS:
+                self._previous_handlers[signal_number] = signal.signal(signal_number, self._handle)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._restore()
+
+    def exit_if_interrupted(self) -> None:
+        """Exit the program if a signal was received."""
+        if self.interrupted.is_set():
+            raise SystemExit(f"Interrupted by {signal.Signals(self.signal_number).name}. Completed poverty lines were "
+                             "saved; run again with --resume to fetch only the missing ones.")
@@ -0,0 +1,72 @@
+"""Paths and settings of the pipeline.
+
+This module only depends on the standard library, so that scripts that only need paths (like the tests of the output
+dataset, or the upload to S3) can import them in a few milliseconds, without loading pandas, the PIP API client or the
+plotting libraries.
+
+"""
+
+from pathlib import Path
+
+# Path to current directory.
+CURRENT_DIR = Path(__file__).parent
+# Path to (public) directory where output datasets will be stored.
+OUTPUT_DIR = CURRENT_DIR.parent / "datasets"
+# Path to (public) directory where input files are stored.
+INPUT_DIR = CURRENT_DIR.parent / "input"
+# Path to output PIP dataset files.
+OUTPUT_CSV_FILE = OUTPUT_DIR / "pip_dataset.csv"
+OUTPUT_XLSX_FILE = OUTPUT_DIR / "pip_dataset.xlsx"
+# Path to PIP dataset codebook file.
+PIP_CODEBOOK_FILE = OUTPUT_DIR / "pip_codebook.csv"
+# Path to (ignored) directory where temporary files will be stored.
+TEMP_DIR = CURRENT_DIR.parent / "temp"
+# Define temporary sub-folders that need to be created.
+TEMP_SUB_DIRS = [
+    TEMP_DIR / "ppp_2011/raw",
+    TEMP_DIR / "ppp_2017/raw",
+    TEMP_DIR / "ppp_2011/full_dist",
+    TEMP_DIR / "ppp_2017/full_dist",
+    TEMP_DIR / "ppp_2011/full_dist_regions",
+    TEMP_DIR / "ppp_2017/full_dist_regions",
+]
+# Path to (ignored) directory where responses from the PIP API will be cached.
+PIP_CACHE_DIR = TEMP_DIR / "pip_cache"
+# Path to default directory where responses from the PIP API will be recorded, to replay them without network access.
+PIP_CASSETTE_DIR = TEMP_DIR / "pip_cassette"
+# Path to (ignored) directory where the metrics of the requests to the PIP API will be exported.
+METRICS_DIR = TEMP_DIR / "metrics"
+# Path to (ignored) directory where temporary plots will be stored (created when the first chart is rendered).
+GRAPHICS_DIR = CURRENT_DIR.parent / "graphics"
+# Define PIP data version (which depends on the PPP version), to pass to the API.
+PIP_VERSION = {
+    2011: "20220909_2011_02_02_PROD",
+    2017: "20220909_2017_01_02_PROD",
+}
+# Poverty line (in cents) of high income countries of each PPP version, left out of the stacked bands.
+HIGH_INCOME_POVLINE_CENTS = {
+    2011: 2170,
+    2017: 2435,
+}
+# Pairs of poverty lines (in cents) of each PPP version between which people are also counted in the stacked bands
+# (jumping over the lines in between).
+STACKED_BETWEEN_CENTS = {
+    2011: [(190, 1000), (1000, 3000)],
+    2017: [(215, 1000), (1000, 3000)],
+}
+# Base URL of PIP API.
+PIP_API_BASE_URL = "https://api.worldbank.org/pip/v1/"
+# Google sheet names and base URL.
+GOOGLE_SHEET_NAMES = {
+    2011: "pip_ppp_2011",
+    2017: "pip_ppp_2017",
+}
+GOOGLE_SHEET_ID = '1ntYtYF0NqIW2oXuXl_ZJHvuI7n-bik94BEIOvWHrJAI'
+GOOGLE_SHEET_BASE_URL = f'https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}/gviz/tq?tqx=out:csv&sheet='
+# Coarse grid of poverty lines (in cents) fetched for all countries at once, to bracket percentiles in search mode.
+SEARCH_SEED_POVLINES_CENTS = [50, 100, 150, 200, 300, 400, 550, 700, 1000, 1500, 2000, 3000, 4000, 5500, 8000, 12000,
+                              17500]
+# Default number of requests to have in flight at the same time when fetching many poverty lines.
+DEFAULT_MAX_WORKERS = 8
+# Default number of rows whose relative poverty values computed locally are compared with the ones of the PIP API.
+DEFAULT_RELATIVE_VALIDATION_SAMPLE = 50
@@ -0,0 +1,161 @@
+"""Poverty measures computed locally from the headcount curves of entities.
+
+The full-distribution grid (fetched by `thresholds` to find percentiles) holds the headcount ratio H(z) of every
+country-year at thousands of poverty lines z. As H is the cumulative distribution of income (or consumption), the
+measures of the Foster-Greer-Thorbecke family at any poverty line z can be computed from it (integrating by parts their
+definitions over the distribution), without querying the API:
+
+- headcount ratio: H(z)
+- poverty gap index: 1/z * integral of H(y) dy from 0 to z
+- poverty severity (squared poverty gap index): 2/z^2 * integral of (z - y) H(y) dy from 0 to z
+- Watts index: integral of H(y) / y dy from 0 to z
+
+Between the lines of the grid, H is interpolated linearly (which keeps it monotone), and below the lowest line it is
+taken to grow linearly from zero, so the integrals are exact on each segment of the grid. All entities of the grid are
+arranged as a (entities, lines) matrix, and batches of any number of (entity, poverty line) pairs are evaluated at once.
+
+"""
+
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from scripts.percentiles import entity_codes
+
+# Measures computed from the headcount curves (named as in the responses of the PIP API).
+MEASURES = ['headcount', 'poverty_gap', 'poverty_severity', 'watts']
+
+
+def headcount_curves(df: pd.DataFrame, id_cols: Sequence[str], povline_column: str = 'poverty_line',
+                     headcount_column: str = 'headcount') -> Tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """Arrange the headcount ratios of a grid of poverty lines as one curve per entity.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Headcount ratio of each entity at each poverty line of the grid (one row per entity and line).
+    id_cols : sequence of str
+        Columns identifying an entity (e.g. country, year, reporting level and welfare type).
+    povline_column : str, optional
+        Column with the poverty line (in dollars).
+    headcount_column : str, optional
+        Column with the headcount ratio (between 0 and 1).
+
+    Returns
+    -------
+    entities : pd.DataFrame
+        Identifiers of each entity (the row of its curve), sorted.
+    povlines : np.ndarray
+        Poverty lines of the grid, sorted.
+    curves : np.ndarray
+        Headcount ratio of each entity at each poverty line (entities, lines). Lines missing for an entity are
+        interpolated from its other lines (and left missing below its lowest line or above its highest one).
+
+    """
+    df = df.dropna(subset=[povline_column, headcount_column])
+    codes, first_rows = entity_codes(df, id_cols)
+    povlines, line_codes = np.unique(df[povline_column].to_numpy(dtype=float), return_inverse=True)
+    curves = np.full((len(first_rows), len(povlines)), np.nan)
+    curves[codes, line_codes] = df[headcount_column].to_numpy(dtype=float)
+
+    for i in np.flatnonzero(np.isnan(curves).any(axis=1)):
+        known = ~np.isnan(curves[i])
+        curves[i] = np.interp(povlines, povlines[known], curves[i, known], left=np.nan, right=np.nan)
+
+    return df[list(id_cols)].iloc[first_rows].reset_index(drop=True), povlines, curves
+
+
+def _segment_integrals(y1: np.ndarray, y2: np.ndarray, h1: np.ndarray,
+                       h2: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Integrals of H(y), y H(y) and H(y) / y over segments [y1, y2] where H is linear (from h1 to h2). The intercept of
+    # H is zero on segments starting at y1 = 0, where the logarithm of the Watts index diverges.
+    width = y2 - y1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(width > 0, (h2 - h1) / width, 0)
+        log_ratio = np.where(y1 > 0, np.log(y2 / np.where(y1 > 0, y1, 1)), 0)
+    integral = width * (h1 + h2) / 2
+    integral_y = width / 6 * (2 * y1 * h1 + y1 * h2 + y2 * h1 + 2 * y2 * h2)
+    integral_over_y = (h1 - slope * y1) * log_ratio + slope * width
+
+    return integral, integral_y, integral_over_y
+
+
+def interpolate_headcounts(povlines: np.ndarray, curves: np.ndarray, rows: np.ndarray,
+                           lines: np.ndarray) -> np.ndarray:
+    """Return the headcount ratio of the curve of each row at each poverty line (missing outside of the grid).
+
+    Parameters
+    ----------
+    povlines : np.ndarray
+        Poverty lines of the grid, sorted.
+    curves : np.ndarray
+        Headcount ratio of each entity at each poverty line of the grid (entities, lines).
+    rows : np.ndarray
+        Curve (entity) of each query.
+    lines : np.ndarray
+        Poverty line of each query (same shape as `rows`).
+
+    Returns
+    -------
+    headcounts : np.ndarray
+        Headcount ratio of each query (same shape as `rows`).
+
+    """
+    return poverty_measures(povlines, curves, rows, lines, measures=['headcount'])['headcount']
+
+
+def poverty_measures(povlines: np.ndarray, curves: np.ndarray, rows: np.ndarray, lines: np.ndarray,
+                     measures: Sequence[str] = MEASURES) -> Dict[str, np.ndarray]:
+    """Compute poverty measures of the curve of each row at each poverty line.
+
+    Parameters
+    ----------
+    povlines : np.ndarray
+        Poverty lines of the grid, sorted.
+    curves : np.ndarray
+        Headcount ratio of each entity at each poverty line of the grid (entities, lines).
+    rows : np.ndarray
+        Curve (entity) of each query.
+    lines : np.ndarray
+        Poverty line of each query (same shape as `rows`).
+    measures : sequence of str, optional
+        Measures to compute (any of MEASURES).
+
+    Returns
+    -------
+    values : dict
+        Values of each measure for each query (same shape as `rows`), as shares (between 0 and 1). Values are missing
+        for lines that are not positive or that are above the highest line of the grid.
+
+    """
+    rows, lines = np.broadcast_arrays(np.asarray(rows, dtype=int), np.asarray(lines, dtype=float))
+    shape = rows.shape
+    rows, lines = rows.ravel(), lines.ravel()
+
+    # Curves start from a headcount ratio of zero at a poverty line of zero.
+    grid = np.concatenate([[0.0], povlines])
+    used_rows, rows = np.unique(rows, return_inverse=True)
+    used_curves = np.hstack([np.zeros((len(used_rows), 1)), curves[used_rows]])
+
+    # Segment of the grid of each line, and headcount ratio at the line.
+    valid = (lines > 0) & (lines <= grid[-1])
+    segments = np.clip(np.searchsorted(grid, np.where(valid, lines, 0), side='right') - 1, 0, len(grid) - 2)
+    y1, y2 = grid[segments], grid[segments + 1]
+    h1, h2 = used_curves[rows, segments], used_curves[rows, segments + 1]
+    headcount = h1 + (h2 - h1) * (lines - y1) / (y2 - y1)
+
+    values = {'headcount': headcount}
+    if set(measures) - {'headcount'}:
+        # Integrals from zero to each line of the grid, plus the part of the segment below each line.
+        cumulative = [np.hstack([np.zeros((len(used_rows), 1)), np.cumsum(integral, axis=1)])
+                      for integral in _segment_integrals(grid[:-1], grid[1:], used_curves[:, :-1], used_curves[:, 1:])]
+        partial = _segment_integrals(y1, np.where(valid, lines, y1), h1, headcount)
+        integral, integral_y, integral_over_y = [total[rows, segments] + part
+                                                 for total, part in zip(cumulative, partial)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values['poverty_gap'] = integral / lines
+            values['poverty_severity'] = 2 * (lines * integral - integral_y) / lines ** 2
+        values['watts'] = integral_over_y
+
+    return {measure: np.where(valid, values[measure], np.nan).reshape(shape) for measure in measures}
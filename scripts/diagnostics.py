@@ -0,0 +1,238 @@
+"""Diagnostic charts of the percentile extraction (query durations and distance of the percentiles found to their
+targets).
+
+Rendering charts with plotly and kaleido is slow, so it is kept off the critical path of the pipeline. The pipeline
+only saves the (small) data behind the charts, and the figures are then either rendered in a separate pool of
+processes while the pipeline goes on ("parallel" mode), or later on, with the `diagnostics` step of `make_dataset.py`
+("deferred" mode). In "off" mode, nothing is saved nor rendered. A chart that fails to render is reported, but never
+stops the pipeline.
+
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+
+from scripts.storage import intermediate_exists, read_intermediate, write_intermediate
+
+DIAGNOSTICS_MODES = ("off", "deferred", "parallel")
+# Suffix of the files and title of the charts of each scope of the percentile extraction.
+SCOPES = {
+    "countries": ("", ""),
+    "regions": ("_regions", " for regions"),
+}
+# Charts rendered for each scope (each one is written to an svg file, and all but the time plot also to an html file).
+CHARTS = [
+    "time_plot",
+    "target_p_vs_distance_percentiles",
+    "povline_vs_distance_percentiles",
+    "distance_percentiles_histogram",
+    "target_p_vs_distance_deciles",
+    "povline_vs_distance_deciles",
+    "distance_deciles_histogram",
+]
+# Columns of the closest grid points to the percentiles that are needed by the charts.
+CLOSEST_PERCENTILES_COLUMNS = ['Entity', 'Year', 'target_percentile', 'poverty_line', 'headcount', 'distance_to_p']
+# Default number of processes rendering charts.
+DEFAULT_RENDER_WORKERS = 2
+
+# Current diagnostics settings (see configure_diagnostics).
+_diagnostics_mode = "parallel"
+_render_workers = DEFAULT_RENDER_WORKERS
+# Pool of processes rendering charts in "parallel" mode (created on first use), and charts submitted to it.
+_executor = None
+_pending = []
+
+
+def configure_diagnostics(mode: str = "parallel", render_workers: int = DEFAULT_RENDER_WORKERS) -> None:
+    """Set how diagnostic charts are produced.
+
+    Parameters
+    ----------
+    mode : str, optional
+        "off" to skip them, "deferred" to only save their data (to be rendered by a later `diagnostics` step), or
+        "parallel" to save their data and render them in a separate pool of processes.
+    render_workers : int, optional
+        Number of processes rendering charts in "parallel" mode.
+
+    """
+    global _diagnostics_mode, _render_workers
+
+    if mode not in DIAGNOSTICS_MODES:
+        raise ValueError(f"Unknown diagnostics mode {mode}. Choose one of {list(DIAGNOSTICS_MODES)}.")
+    _diagnostics_mode = mode
+    _render_workers = render_workers
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+
+    if _executor is None:
+        # Spawn (instead of fork) the workers, since the pipeline runs threads of its own.
+        _executor = ProcessPoolExecutor(max_workers=_render_workers, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def render_chart(data_dir: Path, graphics_dir: Path, scope: str, chart: str) -> List[Path]:
+    """Render one diagnostic chart from its saved data.
+
+    Parameters
+    ----------
+    data_dir : Path
+        Directory where the data of the charts was saved.
+    graphics_dir : Path
+        Directory where the chart will be written (created if it does not exist).
+    scope : str
+        Either "countries" or "regions".
+    chart : str
+        Name of the chart (one of CHARTS).
+
+    Returns
+    -------
+    files : list of Path
+        Files written.
+
+    """
+    # Plotly is only needed to render charts, which is never done by the pipeline itself.
+    import plotly.express as px
+
+    suffix, title_suffix = SCOPES[scope]
+    graphics_dir = Path(graphics_dir)
+    graphics_dir.mkdir(parents=True, exist_ok=True)
+
+    if chart == "time_plot":
+        df = read_intermediate(Path(data_dir) / f'query_durations{suffix}')
+        title = 'Execution time for poverty line queries' + (' (regions)' if scope == "regions" else '')
+        fig = px.line(df, x="povline", y="duration", title=title)
+        file = graphics_dir / f'{chart}{suffix}.svg'
+        fig.write_image(file)
+        return [file]
+
+    df = read_intermediate(Path(data_dir) / f'closest_percentiles{suffix}')
+    if chart.endswith("deciles") or chart.endswith("deciles_histogram"):
+        df = df[df['target_percentile'].isin([f'P{i}' for i in range(10, 100, 10)])].reset_index(drop=True)
+        subtitle = "Deciles"
+    else:
+        subtitle = "Percentiles"
+
+    if chart.startswith("target_p_vs_distance"):
+        fig = px.scatter(df, x="target_percentile", y="distance_to_p", color="Entity",
+                         hover_data=['poverty_line', 'headcount', 'Year'], opacity=0.5,
+                         title=f"<b>Target p vs. Distance to p{title_suffix}</b><br>{subtitle}",
+                         log_y=False,
+                         height=600)
+        fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
+    elif chart.startswith("povline_vs_distance"):
+        fig = px.scatter(df, x="poverty_line", y="distance_to_p", color="Entity",
+                         hover_data=['poverty_line', 'headcount', 'Year', 'target_percentile'], opacity=0.5,
+                         title=f"<b>Poverty line vs. Distance to p{title_suffix}</b><br>{subtitle}",
+                         log_y=False,
+                         height=600)
+        fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
+    else:
+        fig = px.histogram(df, x="distance_to_p", histnorm="percent", marginal="box")
+
+    files = [graphics_dir / f'{chart}{suffix}.svg', graphics_dir / f'{chart}{suffix}.html']
+    fig.write_image(files[0])
+    fig.write_html(files[1])
+
+    return files
+
+
+def save_percentile_diagnostics(df_query_durations, df_closest, data_dir: Path, graphics_dir: Path,
+                                scope: str) -> None:
+    """Save the data of the diagnostic charts of a percentile extraction, and render them if in "parallel" mode.
+
+    Parameters
+    ----------
+    df_query_durations : pd.DataFrame
+        Duration of the query of each poverty line (columns 'povline' and 'duration').
+    df_closest : pd.DataFrame
+        Closest grid point to each target percentile, as returned by `find_closest_percentiles`.
+    data_dir : Path
+        Directory where the data of the charts will be saved.
+    graphics_dir : Path
+        Directory where the charts will be written.
+    scope : str
+        Either "countries" or "regions".
+
+    """
+    if _diagnostics_mode == "off":
+        return
+
+    suffix, _ = SCOPES[scope]
+    Path(data_dir).mkdir(parents=True, exist_ok=True)
+    write_intermediate(df_query_durations, Path(data_dir) / f'query_durations{suffix}')
+    write_intermediate(df_closest[CLOSEST_PERCENTILES_COLUMNS], Path(data_dir) / f'closest_percentiles{suffix}')
+
+    if _diagnostics_mode == "parallel":
+        for chart in CHARTS:
+            future = _get_executor().submit(render_chart, data_dir, graphics_dir, scope, chart)
+            _pending.append((scope, chart, future))
+
+
+def _report(results) -> List[str]:
+    failed = []
+    for scope, chart, future in results:
+        try:
+            future.result()
+        except Exception as error:
+            print(f"Diagnostic chart {chart} ({scope}) could not be rendered: {type(error).__name__}: {error}")
+            failed.append(f"{chart} ({scope})")
+
+    return failed
+
+
+def wait_for_diagnostics() -> List[str]:
+    """Wait for the charts submitted in "parallel" mode to be rendered, and shut down the pool of processes.
+
+    Returns
+    -------
+    failed : list of str
+        Charts that could not be rendered.
+
+    """
+    global _executor, _pending
+
+    failed = _report(_pending)
+    _pending = []
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+    return failed
+
+
+def render_diagnostics(data_dir: Path, graphics_dir: Path, render_workers: int = DEFAULT_RENDER_WORKERS) -> List[str]:
+    """Render all diagnostic charts whose data was saved by a previous run of the pipeline.
+
+    Parameters
+    ----------
+    data_dir : Path
+        Directory where the data of the charts was saved.
+    graphics_dir : Path
+        Directory where the charts will be written.
+    render_workers : int, optional
+        Number of processes rendering charts.
+
+    Returns
+    -------
+    failed : list of str
+        Charts that could not be rendered.
+
+    """
+    scopes = [scope for scope, (suffix, _) in SCOPES.items()
+              if intermediate_exists(Path(data_dir) / f'closest_percentiles{suffix}')]
+    if len(scopes) == 0:
+        print(f"No diagnostics data found in {data_dir}. Run the pipeline with -d first.")
+        return []
+
+    with ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = [(scope, chart, executor.submit(render_chart, data_dir, graphics_dir, scope, chart))
+                   for scope in scopes for chart in CHARTS]
+        failed = _report(results)
+
+    print(f"Rendered {len(results) - len(failed)} of {len(results)} diagnostic charts in {graphics_dir}")
+
+    return failed
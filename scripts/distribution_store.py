@@ -0,0 +1,222 @@
+"""Memory-mapped store of the headcount curves of the full-distribution grid.
+
+The full-distribution grid (fetched by `thresholds`) holds the headcount ratio of every country-year at thousands of
+poverty lines. It is written once per PIP version and PPP version as a (entities, poverty lines) NumPy array on disk,
+next to the sorted poverty lines of the grid and the identifiers of the entity of each row. Queries open the array as a
+memory map and only read the rows of the entities they ask for, so headcounts (or any other measure of
+scripts/curves.py) at poverty lines that were never queried to the API are interpolated for batches of any size in
+milliseconds, without loading the whole store:
+
+    store = DistributionStore.open(2017)
+    store.headcount_at(["Chile", "Peru"], [2015, 2015], [2.15, 3.65])
+
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from scripts.constants import PIP_VERSION, TEMP_DIR
+from scripts.curves import MEASURES, headcount_curves, poverty_measures
+from scripts.storage import read_intermediate, write_intermediate
+
+# Columns identifying an entity of the store.
+ID_COLUMNS = ['Entity', 'Year', 'reporting_level', 'welfare_type']
+# Default maximum number of (entity, poverty line) pairs evaluated at once (and hence of rows read from the store).
+DEFAULT_CHUNK_SIZE = 100_000
+
+
+def distribution_store_dir(ppp: int) -> Path:
+    """Return the folder of the distribution store of a PPP version."""
+    return TEMP_DIR / f'ppp_{ppp}/distribution_store'
+
+
+def _normalise_ids(df: pd.DataFrame) -> pd.DataFrame:
+    # Identifiers may be stored as categories or small integers, so they are compared as plain strings and integers.
+    return pd.DataFrame({column: df[column].to_numpy(dtype=np.int64) if column == 'Year'
+                         else df[column].astype(str).to_numpy() for column in df.columns})
+
+
+def write_distribution_store(df: pd.DataFrame, path: Path, pip_version: str, ppp: int,
+                             dtype: np.dtype = np.float32) -> Path:
+    """Write the headcount curves of a grid of poverty lines to a distribution store.
+
+    The metadata file is written last (and removed first), so that an interrupted write never leaves a store that can
+    be opened.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Headcount ratio of each entity at each poverty line of the grid, with columns ID_COLUMNS, `poverty_line` (in
+        dollars) and `headcount`.
+    path : Path
+        Folder of the store.
+    pip_version : str
+        Version of the PIP data of the grid.
+    ppp : int
+        PPP version of the grid.
+    dtype : np.dtype, optional
+        Type of the stored headcount ratios.
+
+    Returns
+    -------
+    path : Path
+        Folder of the store.
+
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    meta_file = path / 'meta.json'
+    if meta_file.exists():
+        meta_file.unlink()
+
+    entities, povlines, curves = headcount_curves(df, ID_COLUMNS)
+    headcounts = np.lib.format.open_memmap(path / 'headcounts.npy', mode='w+', dtype=dtype, shape=curves.shape)
+    headcounts[:] = curves
+    headcounts.flush()
+    del headcounts
+    np.save(path / 'povlines.npy', povlines)
+    write_intermediate(entities, path / 'entities')
+
+    meta = {'pip_version': pip_version, 'ppp_version': ppp, 'entities': len(entities), 'povlines': len(povlines),
+            'dtype': np.dtype(dtype).name}
+    temp_file = meta_file.with_name(meta_file.name + '.tmp')
+    temp_file.write_text(json.dumps(meta, indent=2))
+    os.replace(temp_file, meta_file)
+
+    return path
+
+
+class DistributionStore:
+    """Headcount curves of the full-distribution grid, read from a memory-mapped store.
+
+    Parameters
+    ----------
+    path : Path
+        Folder of the store (written by `write_distribution_store`).
+    pip_version : str, optional
+        Version of the PIP data expected in the store (not checked if not given).
+
+    """
+
+    def __init__(self, path: Path, pip_version: Optional[str] = None) -> None:
+        self.path = Path(path)
+        meta_file = self.path / 'meta.json'
+        if not meta_file.is_file():
+            raise FileNotFoundError(f"No distribution store found in {self.path}. Download the full-distribution grid "
+                                    f"first, with -d and the grid percentile method.")
+        self.meta = json.loads(meta_file.read_text())
+        if (pip_version is not None) and (self.meta['pip_version'] != pip_version):
+            raise ValueError(f"The distribution store in {self.path} holds PIP version {self.meta['pip_version']}, not "
+                             f"{pip_version}. Build it again.")
+
+        self.headcounts = np.load(self.path / 'headcounts.npy', mmap_mode='r')
+        self.povlines = np.load(self.path / 'povlines.npy')
+        self.entities = read_intermediate(self.path / 'entities')
+        self._ids = _normalise_ids(self.entities[ID_COLUMNS]).assign(row=np.arange(len(self.entities)))
+
+    @classmethod
+    def open(cls, ppp: int) -> "DistributionStore":
+        """Open the distribution store of a PPP version, checking that it holds the current PIP version."""
+        return cls(distribution_store_dir(ppp), pip_version=PIP_VERSION[ppp])
+
+    def rows(self, entities, years, reporting_level='national', welfare_type=None) -> np.ndarray:
+        """Return the row of the store of each entity (-1 for entities that are not in the store).
+
+        Parameters
+        ----------
+        entities : str or array-like
+            Name of each entity.
+        years : int or array-like
+            Year of each entity (broadcast with `entities`).
+        reporting_level : str or array-like, optional
+            Reporting level of each entity (any if None).
+        welfare_type : str or array-like, optional
+            Welfare type of each entity (any if None).
+
+        Returns
+        -------
+        rows : np.ndarray
+            Row of each entity (with the broadcast shape of the arguments).
+
+        Raises
+        ------
+        ValueError
+            If an entity matches several rows (e.g. a country-year with both income and consumption data, and no
+            `welfare_type`).
+
+        """
+        keys = {'Entity': entities, 'Year': years, 'reporting_level': reporting_level, 'welfare_type': welfare_type}
+        keys = {column: value for column, value in keys.items() if value is not None}
+        arrays = np.broadcast_arrays(*[np.asarray(value, dtype=object) for value in keys.values()])
+        query = _normalise_ids(pd.DataFrame({column: array.ravel() for column, array in zip(keys, arrays)}))
+
+        # A left merge keeps the order of the query, with one more row for each entity matching several rows.
+        matches = pd.merge(query.reset_index(), self._ids[list(keys) + ['row']], how='left', on=list(keys))
+        duplicated = matches['index'].duplicated(keep=False)
+        if duplicated.any():
+            first = query.iloc[matches['index'][duplicated].iloc[0]]
+            ambiguous = ', '.join(f'{column}={value}' for column, value in first.items())
+            raise ValueError(f"{ambiguous} matches several rows of the distribution store. Give its reporting_level "
+                             f"and welfare_type.")
+
+        return matches['row'].fillna(-1).to_numpy(dtype=np.int64).reshape(arrays[0].shape)
+
+    def measures_at(self, entities, years, povlines, measures: Sequence[str] = MEASURES, reporting_level='national',
+                    welfare_type=None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict[str, np.ndarray]:
+        """Compute poverty measures of entities at any poverty lines, from their headcount curves.
+
+        Arguments are broadcast together, so that e.g. a column of entities and years and a row of poverty lines give
+        the measures of every entity at every line.
+
+        Parameters
+        ----------
+        entities : str or array-like
+            Name of each entity.
+        years : int or array-like
+            Year of each entity.
+        povlines : float or array-like
+            Poverty line of each query (in dollars a day).
+        measures : sequence of str, optional
+            Measures to compute (any of scripts.curves.MEASURES).
+        reporting_level : str or array-like, optional
+            Reporting level of each entity (any if None).
+        welfare_type : str or array-like, optional
+            Welfare type of each entity (any if None).
+        chunk_size : int, optional
+            Maximum number of queries evaluated at once.
+
+        Returns
+        -------
+        values : dict
+            Values of each measure for each query (with the broadcast shape of the arguments), as shares. Values are
+            missing for entities that are not in the store, and for lines outside of the grid.
+
+        """
+        rows, lines = np.broadcast_arrays(self.rows(entities, years, reporting_level, welfare_type),
+                                          np.asarray(povlines, dtype=float))
+        shape = rows.shape
+        rows, lines = rows.ravel(), lines.ravel()
+        values = {measure: np.full(len(rows), np.nan) for measure in measures}
+
+        # Queries are evaluated sorted by row, so that each chunk reads a narrow range of rows of the store.
+        found = np.flatnonzero(rows >= 0)
+        found = found[np.argsort(rows[found], kind='stable')]
+        for start in range(0, len(found), chunk_size):
+            chunk = found[start:start + chunk_size]
+            chunk_values = poverty_measures(self.povlines, self.headcounts, rows[chunk], lines[chunk],
+                                            measures=measures)
+            for measure in measures:
+                values[measure][chunk] = chunk_values[measure]
+
+        return {measure: value.reshape(shape) for measure, value in values.items()}
+
+    def headcount_at(self, entities, years, povlines, reporting_level='national', welfare_type=None,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> np.ndarray:
+        """Return the headcount ratio of entities at any poverty lines (see `measures_at`)."""
+        return self.measures_at(entities, years, povlines, measures=['headcount'], reporting_level=reporting_level,
+                                welfare_type=welfare_type, chunk_size=chunk_size)['headcount']
@@ -0,0 +1,69 @@
+"""Compact types of the columns of the data parsed from the PIP API.
+
+Responses are parsed with the default types of pandas: every text column (like the names of countries or the welfare
+type) is stored as Python strings, and every number as a 64-bit float or integer. Text columns that identify an entity
+or take a few values are stored as categoricals instead (one small integer code per row), and years as 16-bit integers,
+which do not change any value. Metrics can also be stored as 32-bit floats (which halves their memory, but rounds them
+to about 7 significant digits, and hence changes the values of the output); this is off by default.
+
+"""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Text columns stored as categoricals (identifiers of entities, and columns taking a few values).
+CATEGORICAL_COLUMNS = [
+    'country_name', 'region_name', 'Entity', 'country_code', 'region_code', 'reporting_level', 'welfare_type',
+    'distribution_type', 'estimation_type', 'comparable_spell', 'survey_coverage', 'is_interpolated',
+    'poverty line', 'ent_type',
+]
+# Year columns stored as 16-bit integers (when they have no missing values).
+YEAR_COLUMNS = ['reporting_year', 'Year']
+
+# Current settings (see configure_dtypes).
+_float32 = False
+
+
+def configure_dtypes(float32: bool = False) -> None:
+    """Set whether metrics are stored as 32-bit floats (which changes the values of the output)."""
+    global _float32
+
+    _float32 = float32
+
+
+def compact_dtypes(df: pd.DataFrame, float32: Optional[bool] = None) -> pd.DataFrame:
+    """Return a dataframe with compact types: categoricals for identifiers, 16-bit integers for years, and optionally
+    32-bit floats for metrics.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data parsed from the PIP API.
+    float32 : bool, optional
+        True to store float columns as 32-bit floats (the setting of configure_dtypes is used if not given).
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Data with the same values, in compact types.
+
+    """
+    float32 = _float32 if float32 is None else float32
+    dtypes = {}
+    for column in df.columns:
+        dtype = df[column].dtype
+        if (column in CATEGORICAL_COLUMNS) and (dtype == object):
+            dtypes[column] = 'category'
+        elif (column in YEAR_COLUMNS) and pd.api.types.is_integer_dtype(dtype):
+            dtypes[column] = np.int16
+        elif float32 and (dtype == np.float64):
+            dtypes[column] = np.float32
+
+    return df.astype(dtypes) if dtypes else df
+
+
+def memory_usage_mb(df: pd.DataFrame) -> float:
+    """Return the memory used by a dataframe (including the Python strings it holds), in MB."""
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
@@ -0,0 +1,97 @@
+"""Incremental refresh of the costly extractions (percentiles and relative poverty) for a new PIP data version.
+
+Each costly extraction keeps a copy of the data it was built from (the single-line query of all countries and regions,
+which is cheap to fetch). When the PIP data version changes, the new single-line query is compared with that copy, and
+only the entities (e.g. country-years) whose survey metadata or headline values changed, or that are new, need to be
+extracted again. The rows of all other entities are carried forward from the previous extraction.
+
+"""
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+# Columns identifying a country-year and a region-year in the single-line queries of the PIP API.
+COUNTRY_ID_COLUMNS = ['Entity', 'Year', 'reporting_level', 'welfare_type']
+REGION_ID_COLUMNS = ['Entity', 'Year']
+# Survey metadata and headline values compared to decide whether an entity changed between two PIP data versions (the
+# ones missing from the data, e.g. survey metadata for regions, are ignored).
+COMPARE_COLUMNS = ['country_code', 'survey_year', 'survey_coverage', 'survey_comparability', 'comparable_spell',
+                   'distribution_type', 'estimation_type', 'reporting_pop', 'cpi', 'ppp', 'reporting_gdp',
+                   'reporting_pce', 'mean', 'median', 'headcount', 'poverty_gap', 'poverty_severity', 'watts', 'gini',
+                   'mld', 'polarization'] + [f'decile{i}' for i in range(1, 11)]
+
+
+def changed_rows(df_previous: pd.DataFrame, df_current: pd.DataFrame, id_cols: List[str],
+                 compare_cols: List[str], rtol: float = 1e-9) -> pd.DataFrame:
+    """Return the rows of the current data that are new, or whose values changed since the previous data.
+
+    Parameters
+    ----------
+    df_previous : pd.DataFrame
+        Data the previous extraction was built from (one row per entity).
+    df_current : pd.DataFrame
+        Current data (one row per entity).
+    id_cols : list of str
+        Columns identifying an entity (e.g. ['Entity', 'Year', 'reporting_level', 'welfare_type']).
+    compare_cols : list of str
+        Columns whose values are compared (those missing from either dataframe are ignored). Numeric values are
+        compared up to a relative tolerance, and missing values are considered equal to each other.
+    rtol : float, optional
+        Relative tolerance when comparing numeric values.
+
+    Returns
+    -------
+    df_changed : pd.DataFrame
+        Rows of `df_current` that are new or changed.
+
+    """
+    compare_cols = [column for column in compare_cols
+                    if (column in df_previous.columns) and (column in df_current.columns) and (column not in id_cols)]
+    df = pd.merge(df_current[id_cols + compare_cols].reset_index(), df_previous[id_cols + compare_cols],
+                  how='left', on=id_cols, suffixes=('', '_previous'), indicator=True, validate='one_to_one')
+
+    changed = (df['_merge'] == 'left_only').to_numpy()
+    for column in compare_cols:
+        # Categoricals with different categories cannot be compared, so they are compared as values.
+        current = df[column].astype(object) if isinstance(df[column].dtype, pd.CategoricalDtype) else df[column]
+        previous = df[f'{column}_previous']
+        previous = previous.astype(object) if isinstance(previous.dtype, pd.CategoricalDtype) else previous
+        both_missing = (current.isnull() & previous.isnull()).to_numpy()
+        if pd.api.types.is_numeric_dtype(current) and pd.api.types.is_numeric_dtype(previous):
+            equal = np.isclose(current.to_numpy(dtype=float), previous.to_numpy(dtype=float), rtol=rtol, atol=0)
+        else:
+            equal = (current == previous).to_numpy()
+        changed = changed | ~(equal | both_missing)
+
+    return df_current.loc[df.loc[changed, 'index']]
+
+
+def carry_forward(df_previous: pd.DataFrame, df_refreshed: pd.DataFrame, df_entities: pd.DataFrame,
+                  id_cols: List[str]) -> pd.DataFrame:
+    """Combine the rows of a new extraction for some entities with the rows of the previous one for all others.
+
+    Parameters
+    ----------
+    df_previous : pd.DataFrame
+        Output of the previous extraction (possibly with several rows per entity, e.g. one per percentile).
+    df_refreshed : pd.DataFrame
+        Output of the new extraction, for the entities that changed.
+    df_entities : pd.DataFrame
+        Entities in the current data (rows of the previous extraction for any other entity are dropped).
+    id_cols : list of str
+        Columns identifying an entity.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Rows of the refreshed entities from `df_refreshed`, followed by the rows of all other current entities from
+        `df_previous`.
+
+    """
+    previous_keys = pd.MultiIndex.from_frame(df_previous[id_cols])
+    keep = previous_keys.isin(pd.MultiIndex.from_frame(df_entities[id_cols])) & \
+        ~previous_keys.isin(pd.MultiIndex.from_frame(df_refreshed[id_cols]))
+
+    return pd.concat([df_refreshed, df_previous[keep]], ignore_index=True)
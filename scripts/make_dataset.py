@@ -9,13 +9,47 @@ World Bank Data are based on primary household survey data obtained from governm
 """
 
 import argparse
-
-from scripts.shared import TEMP_SUB_DIRS, additional_variables_and_check, combine_2011_and_2011_data,\
-    country_data, integrate_relative_poverty, median_patch, query_non_poverty, query_poverty, regional_data,\
-    standardise, thresholds
-
-
-def main(ppp_version: int, download_data: bool = False, regenerate_data: bool = False) -> None:
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from scripts.constants import DEFAULT_MAX_WORKERS, DEFAULT_RELATIVE_VALIDATION_SAMPLE, HIGH_INCOME_POVLINE_CENTS,\
+    INPUT_DIR, METRICS_DIR, OUTPUT_CSV_FILE, OUTPUT_XLSX_FILE, PIP_CACHE_DIR, PIP_CASSETTE_DIR, PIP_CODEBOOK_FILE,\
+    PIP_VERSION, STACKED_BETWEEN_CENTS, TEMP_DIR, TEMP_SUB_DIRS
+from scripts.diagnostics import DIAGNOSTICS_MODES, configure_diagnostics, render_diagnostics, wait_for_diagnostics
+from scripts.distribution_store import distribution_store_dir
+from scripts.dtypes import configure_dtypes
+from scripts.percentiles import DEFAULT_HEADCOUNT_TOLERANCE
+from scripts.pip_client import CASSETTE_MODES, Cassette, PIPClient, ResponseCache
+from scripts.profiling import StageProfiler
+from scripts.shared import additional_variables_and_check, build_distribution_store, combine_2011_and_2011_data,\
+    country_data, diagnostics_dirs, integrate_relative_poverty, median_patch, percentile_povline_list_dict,\
+    query_non_poverty, query_poverty, regional_data, standardise, thresholds
+from scripts.stages import Stage, StageGraph
+from scripts.storage import FORMAT_SUFFIXES, configure_storage
+from scripts.telemetry import FetchMetrics
+
+# PPP versions built (in parallel) by --ppp_version all.
+PPP_VERSIONS = [2011, 2017]
+
+
+def combine_stage(after: Optional[List[str]] = None) -> Stage:
+    """Return the stage combining the datasets of both PPP versions into the final dataset files."""
+    return Stage("combine", combine_2011_and_2011_data,
+                 input_files=[TEMP_DIR / 'pip_dataset_ppp2011', TEMP_DIR / 'pip_dataset_ppp2017', PIP_CODEBOOK_FILE],
+                 output_files=[OUTPUT_CSV_FILE, OUTPUT_XLSX_FILE], after=after or [])
+
+
+def main(ppp_version: int, download_data: bool = False, regenerate_data: bool = False,
+         max_workers: int = DEFAULT_MAX_WORKERS, use_cache: bool = True, refresh_cache: bool = False,
+         resume: bool = False, percentile_method: str = "grid",
+         percentile_tolerance: float = DEFAULT_HEADCOUNT_TOLERANCE, relative_method: str = "api",
+         relative_validation_sample: int = DEFAULT_RELATIVE_VALIDATION_SAMPLE, intermediate_format: str = "parquet",
+         export_csv: bool = False, diagnostics: str = "parallel", stages_to_run: Optional[List[str]] = None,
+         force: bool = False, incremental: bool = False, cassette_mode: Optional[str] = None,
+         cassette_dir: Path = PIP_CASSETTE_DIR, metrics_interval: float = 60, profile: bool = False,
+         float32: bool = False, combine: bool = True, request_slots=None) -> None:
     """Generate PIP dataset.
 
     Parameters
@@ -26,6 +60,65 @@ def main(ppp_version: int, download_data: bool = False, regenerate_data: bool =
         True to download all percentiles data (which can take ~1.5 days).
     regenerate_data : bool, optional
         True to re-generate relative poverty data (which can take ~1.5 hours).
+    max_workers : int, optional
+        Maximum number of concurrent requests to the PIP API when downloading percentiles and relative poverty data (1
+        to query serially).
+    use_cache : bool, optional
+        False to neither read nor store PIP API responses in the on-disk response cache.
+    refresh_cache : bool, optional
+        True to query the PIP API again even for cached responses (and store the new responses in the cache).
+    resume : bool, optional
+        True to resume an interrupted download of percentiles data, fetching only the missing poverty lines.
+    percentile_method : str, optional
+        "grid" to find the percentiles of countries from a fixed grid of poverty lines, or "search" to search them for
+        each country-year until their headcount ratio is within `percentile_tolerance` of the target.
+    percentile_tolerance : float, optional
+        Tolerance of the headcount ratio (as a share of the population) when searching percentiles.
+    relative_method : str, optional
+        "api" to query the relative poverty measures of each country-year to the PIP API, or "local" to compute them
+        from the headcount curves of the full-distribution grid downloaded with the percentiles data (in seconds; not
+        with `incremental`, which does not download the grid again).
+    relative_validation_sample : int, optional
+        Number of country-years whose relative poverty measures computed locally are compared with the ones of the PIP
+        API (0 to skip the comparison).
+    intermediate_format : str, optional
+        Format of the intermediate files stored in the temporary folder ("parquet", "feather" or "csv").
+    export_csv : bool, optional
+        True to also export a csv copy of each intermediate file (for debugging).
+    diagnostics : str, optional
+        How to produce the diagnostic charts of the percentiles download: "off" to skip them, "deferred" to only save
+        their data (to render them later with the `diagnostics` step), or "parallel" to render them in separate
+        processes while the pipeline goes on.
+    stages_to_run : list of str, optional
+        Stages of the pipeline to run (if they are out of date), either by name, or by name followed by "+" to also run
+        all stages downstream of it. All stages if not given. Stages that are not selected use their stored outputs.
+    force : bool, optional
+        True to run the selected stages even if they are up to date.
+    incremental : bool, optional
+        True to extract percentiles and relative poverty data again only for the country-years whose survey metadata or
+        headline values changed since their previous extraction (e.g. after a change of PIP_VERSION), carrying forward
+        the data of all others. It implies `download_data` and `regenerate_data`.
+    cassette_mode : str, optional
+        "record" to record all PIP API responses in a cassette, or "replay" to read all of them from a cassette
+        recorded before, without any network access. If not given, no cassette is used.
+    cassette_dir : Path, optional
+        Directory of the cassette.
+    metrics_interval : float, optional
+        Number of seconds between exports of the metrics of the requests to the PIP API (a JSON summary and a
+        Prometheus textfile, in the metrics folder), or 0 to only export them at the end of the run.
+    profile : bool, optional
+        True to also trace the memory allocated by each stage and save its cProfile output (the wall time, CPU time,
+        maximum memory of the process so far and number of rows and columns of each stage are always written to the
+        run report).
+    float32 : bool, optional
+        True to store the metrics parsed from PIP API responses as 32-bit floats, which halves their memory but rounds
+        them to about 7 significant digits (and hence changes the values of the output).
+    combine : bool, optional
+        False to leave out the stage combining the datasets of both PPP versions (which `main_all_ppp_versions` runs
+        once both are built).
+    request_slots : semaphore, optional
+        Semaphore limiting the concurrent requests to the PIP API, shared with the pipelines running in other processes
+        (see `PIPClient`).
 
     """
     # ## Inputs
@@ -43,6 +136,36 @@ def main(ppp_version: int, download_data: bool = False, regenerate_data: bool =
         #Here we define the international poverty line
         extreme_povline_cents = 215    
 
+    #Here we define the poverty lines of the stacked bands (without the line of high income countries), and the pairs of
+    #lines between which people are also counted
+    stacked_povlines_cents = [povline for povline in poverty_lines_cents
+                              if povline != HIGH_INCOME_POVLINE_CENTS[ppp_version]]
+    stacked_between_cents = STACKED_BETWEEN_CENTS[ppp_version]
+
+    # An incremental refresh never downloads the full-distribution grid again, so the grid would be of another version.
+    if incremental and (relative_method == "local"):
+        raise ValueError("Relative poverty cannot be computed locally in an incremental refresh, which does not "
+                         "download the full-distribution grid again. Use relative_method=\"api\".")
+
+    # An incremental refresh runs both extractions, but only for the country-years that changed.
+    download_data = download_data or incremental
+    regenerate_data = regenerate_data or incremental
+
+    configure_storage(intermediate_format, export_csv=export_csv)
+    configure_diagnostics(diagnostics)
+    configure_dtypes(float32=float32)
+
+    # Client shared by all queries to the PIP API (with a pool of persistent connections, one per concurrent worker).
+    response_cache = ResponseCache(PIP_CACHE_DIR, enabled=use_cache, refresh=refresh_cache)
+    cassette = Cassette(cassette_dir, mode=cassette_mode) if cassette_mode else None
+    metrics = FetchMetrics(labels={"ppp_version": ppp_version, "pip_version": PIP_VERSION[ppp_version]})
+    metrics_files = {"json_file": METRICS_DIR / f"pip_fetch_ppp{ppp_version}.json",
+                     "prometheus_file": METRICS_DIR / f"pip_fetch_ppp{ppp_version}.prom"}
+    if metrics_interval > 0:
+        metrics.start_periodic_export(metrics_interval, **metrics_files)
+    client = PIPClient(cache=response_cache, pool_maxsize=max(max_workers, 1), cassette=cassette, metrics=metrics,
+                       request_slots=request_slots)
+
     # Ensure output temporary folders exist.
     for temp_sub_dir in TEMP_SUB_DIRS:
         if not temp_sub_dir.is_dir():
@@ -57,59 +180,214 @@ def main(ppp_version: int, download_data: bool = False, regenerate_data: bool =
     print(f'The international poverty line is defined as (in cents):')
     print(f'{extreme_povline_cents}')
 
-    # ## Get queries for the International Poverty Line
-    # Here the code produces the output of PIP queries for countries (with and without inter/extrapolations), together with dataframes filter for only income data, only consumption or both (dropping duplicates). Also regional data is queried.
-
-    df_country, df_country_inc, df_country_cons, df_country_inc_or_cons = country_data(extreme_povline_cents, filled="false", ppp=ppp_version)
-    # df_country_filled, df_country_inc_filled, df_country_cons_filled, df_country_inc_or_cons_filled = country_data(extreme_povline_cents, filled="true", ppp=ppp_version)
-    df_region = regional_data(extreme_povline_cents, ppp=ppp_version)
-
-    # ## Get poverty data for multiple poverty lines
-    # The PIP data is queried multiple times for each poverty line set in the input section. This data is then made wide to get a `Entity`, `Year`, `reporting_level`, `welfare_type` structure for each row and multiple poverty measures by each poverty line in columns. The poverty measures include headcount, headcount ratio, poverty gap index, income gap ratio, average shortfall, total shortfall, poverty severity, and Watts index 
-
-    df_final = query_poverty(poverty_lines_cents, filled="false", ppp=ppp_version)
-
-    # ## Get non-poverty data
-    # Data not affected by different poverty lines is obtained here. These are measures as population, mean, median, Gini coefficient, decile shares, to name some. This data is then merged with the poverty measures from the previous section. Note: only population and mean income are available by default for world regions.
-
-    df_final = query_non_poverty(df_final, df_country, df_region)
-
-    # ## Integrate income thresholds
-    # If `yes` was selected at the start, it will first generate percentile data for each country and region. It takes between 1 and 2 DAYS. If `no` is selected, the code goes straight to the next step, which is merging the data with the previously generated percentile output.
-
-    df_final = thresholds(df_final, answer=download_data, ppp=ppp_version)
-
-    # ## Integrate relative poverty data
-    # If `yes` was selected at the start, it will first generate relative poverty data from different queries for each country. It takes between 1 and 2 hours. If `no` is selected, the code goes straight to the next step, which is merging the data with the previously generated relative poverty output.
-
-    df_final, col_relative = integrate_relative_poverty(df_final, df_country, answer=regenerate_data, ppp=ppp_version)
-
-    # ## Generate additional variables and check for errors
-    # These new variables include headcount and headcount ratios in-between and above poverty lines, decile averages and percentile ratios. Also the list of the columns is obtained for the final output.
-    # Several tests are done to the data as well, related to monotonicity, missing values and stacked variables adding up to 100%. If rows do not follow these criteria, these are dropped.
-
-    df_final, cols = additional_variables_and_check(df_final, poverty_lines_cents, col_relative, ppp=ppp_version)
+    # The pipeline is a graph of stages, and each one only runs when its inputs, parameters, code or the files it reads
+    # changed since it last ran (see scripts/stages.py).
+    pip_version = {"pip_version": PIP_VERSION[ppp_version]}
+    if float32:
+        # Data parsed as 32-bit floats differs from the data stored before.
+        pip_version["float32"] = True
+    percentiles_file = TEMP_DIR / f'ppp_{ppp_version}/raw/percentiles'
+    stages = [
+        # ## Get queries for the International Poverty Line
+        # Here the code produces the output of PIP queries for countries (with and without inter/extrapolations), together with dataframes filter for only income data, only consumption or both (dropping duplicates). Also regional data is queried.
+        Stage("country_data", country_data,
+              outputs=["country", "country_inc", "country_cons", "country_inc_or_cons"],
+              params={"extreme_povline_cents": extreme_povline_cents, "filled": "false", "ppp": ppp_version},
+              options={"client": client}, context=pip_version),
+        # df_country_filled, df_country_inc_filled, df_country_cons_filled, df_country_inc_or_cons_filled = country_data(extreme_povline_cents, filled="true", ppp=ppp_version)
+        Stage("regional_data", regional_data,
+              outputs=["region"],
+              params={"extreme_povline_cents": extreme_povline_cents, "ppp": ppp_version},
+              options={"client": client}, context=pip_version),
+
+        # ## Get poverty data for multiple poverty lines
+        # The PIP data is queried multiple times for each poverty line set in the input section. This data is then made wide to get a `Entity`, `Year`, `reporting_level`, `welfare_type` structure for each row and multiple poverty measures by each poverty line in columns. The poverty measures include headcount, headcount ratio, poverty gap index, income gap ratio, average shortfall, total shortfall, poverty severity, and Watts index
+        Stage("query_poverty", query_poverty,
+              outputs=["poverty"],
+              params={"poverty_lines_cents": poverty_lines_cents, "filled": "false", "ppp": ppp_version},
+              options={"client": client}, context=pip_version),
+
+        # ## Get non-poverty data
+        # Data not affected by different poverty lines is obtained here. These are measures as population, mean, median, Gini coefficient, decile shares, to name some. This data is then merged with the poverty measures from the previous section. Note: only population and mean income are available by default for world regions.
+        Stage("query_non_poverty", query_non_poverty,
+              outputs=["non_poverty"],
+              inputs={"df_final": "poverty", "df_country": "country", "df_region": "region"}),
+
+        # ## Integrate income thresholds
+        # If `yes` was selected at the start, it will first generate percentile data for each country and region. It takes between 1 and 2 DAYS. If `no` is selected, the code goes straight to the next step, which is merging the data with the previously generated percentile output.
+        Stage("thresholds", thresholds,
+              outputs=["thresholds"],
+              inputs={"df_final": "non_poverty", "df_country": "country", "df_region": "region"},
+              params={"ppp": ppp_version, "method": percentile_method, "tolerance": percentile_tolerance},
+              options={"answer": download_data, "max_workers": max_workers, "resume": resume, "client": client,
+                       "incremental": incremental},
+              context=pip_version, input_files=[percentiles_file], always_run=download_data),
+
+        # ## Store the full distribution
+        # The full-distribution grid downloaded with the percentiles is written to a memory-mapped store (once per PIP version), to get headcounts at any poverty line in milliseconds with scripts.distribution_store.DistributionStore, without querying the API.
+        Stage("distribution_store", build_distribution_store,
+              params={"ppp": ppp_version}, context=pip_version,
+              input_files=[TEMP_DIR / f'ppp_{ppp_version}/full_dist/{key}' for key in percentile_povline_list_dict()]
+              + [TEMP_DIR / f'ppp_{ppp_version}/full_dist/version.json'],
+              output_files=[distribution_store_dir(ppp_version) / 'meta.json'], after=["thresholds"]),
+
+        # ## Integrate relative poverty data
+        # If `yes` was selected at the start, it will first generate relative poverty data from different queries for each country. It takes between 1 and 2 hours. If `no` is selected, the code goes straight to the next step, which is merging the data with the previously generated relative poverty output.
+        Stage("relative_poverty", integrate_relative_poverty,
+              outputs=["relative_poverty", "col_relative"],
+              inputs={"df_final": "thresholds", "df_country": "country"},
+              params={"ppp": ppp_version, "method": relative_method},
+              options={"answer": regenerate_data, "max_workers": max_workers, "client": client,
+                       "incremental": incremental, "validation_sample": relative_validation_sample},
+              context=pip_version, input_files=[percentiles_file, TEMP_DIR / f'ppp_{ppp_version}/raw/relative_poverty'],
+              always_run=regenerate_data),
+
+        # ## Generate additional variables and check for errors
+        # These new variables include headcount and headcount ratios in-between and above poverty lines, decile averages and percentile ratios. Also the list of the columns is obtained for the final output.
+        # Several tests are done to the data as well, related to monotonicity, missing values and stacked variables adding up to 100%. If rows do not follow these criteria, these are dropped.
+        Stage("additional_variables", additional_variables_and_check,
+              outputs=["additional_variables", "cols"],
+              inputs={"df_final": "relative_poverty", "col_relative": "col_relative"},
+              params={"poverty_lines_cents": poverty_lines_cents, "ppp": ppp_version,
+                      "stacked_povlines_cents": stacked_povlines_cents, "stacked_between_cents": stacked_between_cents}),
+
+        # ## Patch missing median values
+        # For several countries (including all national data for China, India and Indonesia) and all the regions there is no median income data. With the percentile output we can patch the blanks by filtering the P50 value.
+        Stage("median_patch", median_patch,
+              outputs=["median_patch"],
+              inputs={"df_final": "additional_variables"},
+              params={"ppp": ppp_version},
+              input_files=[percentiles_file]),
+
+        # ## Standardise entity values
+        # The dataset is formatted for public use.
+        Stage("standardise", standardise,
+              outputs=["dataset"],
+              inputs={"df_final": "median_patch", "cols": "cols"},
+              params={"ppp": ppp_version},
+              input_files=[INPUT_DIR / f"ppp_{ppp_version}/countries_standardized.csv"]),
+
+        # Once the script has been executed for 2011 and 2017, combine both dataframes and generate final dataset files.
+        combine_stage(after=["standardise"]),
+    ]
+    if not combine:
+        # Both PPP versions are being built at once, and are combined once both are done (see main_all_ppp_versions).
+        stages = [stage for stage in stages if stage.name != "combine"]
+    profile_dir = TEMP_DIR / f'ppp_{ppp_version}/profile'
+    profiler = StageProfiler(profile_dir / 'run_report.json', trace_memory=profile,
+                             cprofile_dir=profile_dir if profile else None)
+    try:
+        StageGraph(stages, state_dir=TEMP_DIR / f'ppp_{ppp_version}/stages', profiler=profiler).run(
+            selectors=stages_to_run, force=force)
+    finally:
+        # The run report, the cassette index and the metrics are written (and missing requests reported) even if a
+        # stage failed.
+        profiler.write_report()
+        print(profiler.summary())
+        print(f'Run report written to {profiler.report_file}')
+        client.close()
+        if use_cache and (cassette_mode != "replay"):
+            print(f'PIP API response cache: {response_cache.hits} hits, {response_cache.misses} misses')
+        if cassette is not None:
+            print(cassette.report())
+        metrics.stop_periodic_export()
+        metrics.export(**metrics_files)
+        print(f'Metrics of the PIP API requests exported to {METRICS_DIR}')
+
+    # Diagnostic charts do not affect the dataset, so failing to render them is only reported.
+    wait_for_diagnostics()
+
+
+def main_all_ppp_versions(max_workers: int = DEFAULT_MAX_WORKERS, intermediate_format: str = "parquet",
+                          export_csv: bool = False, stages_to_run: Optional[List[str]] = None, force: bool = False,
+                          **kwargs) -> None:
+    """Generate PIP dataset for both PPP versions at once, and combine them into the final dataset files.
+
+    The pipeline of each PPP version runs in its own process (most of their stages are CPU-bound), so that a full build
+    takes about as long as the slowest of both instead of their sum. Each process has its own client to the PIP API,
+    but both share the response cache (and cassette, if any), and a budget of `max_workers` concurrent requests, so
+    that the API is not queried harder than when building a single PPP version. The combine stage runs once both
+    pipelines finished successfully.
 
-    # ## Patch missing median values
-    # For several countries (including all national data for China, India and Indonesia) and all the regions there is no median income data. With the percentile output we can patch the blanks by filtering the P50 value.
-
-    df_final = median_patch(df_final, ppp=ppp_version)
+    Parameters
+    ----------
+    max_workers : int, optional
+        Maximum number of concurrent requests to the PIP API, shared by both PPP versions.
+    intermediate_format : str, optional
+        Format of the intermediate files stored in the temporary folder ("parquet", "feather" or "csv").
+    export_csv : bool, optional
+        True to also export a csv copy of each intermediate file (for debugging).
+    stages_to_run : list of str, optional
+        Stages of the pipeline to run for both PPP versions (see `main`). The combine stage runs if selected, either by
+        name or as downstream of another selected stage. All stages if not given.
+    force : bool, optional
+        True to run the selected stages even if they are up to date.
+    kwargs
+        Other arguments of `main`, used for both PPP versions.
 
-    # ## Standardise entity values
-    # The dataset is formatted for public use.
+    """
+    run_combine = (not stages_to_run) or any(selector.endswith("+") or (selector == "combine")
+                                             for selector in stages_to_run)
+    ppp_stages_to_run = [selector for selector in (stages_to_run or []) if selector.rstrip("+") != "combine"]
+
+    if (not stages_to_run) or ppp_stages_to_run:
+        context = multiprocessing.get_context("spawn")
+        with context.Manager() as manager, \
+                ProcessPoolExecutor(max_workers=len(PPP_VERSIONS), mp_context=context) as executor:
+            request_slots = manager.BoundedSemaphore(max(max_workers, 1))
+            futures = {
+                ppp_version: executor.submit(main, ppp_version=ppp_version, max_workers=max_workers,
+                                             intermediate_format=intermediate_format, export_csv=export_csv,
+                                             stages_to_run=ppp_stages_to_run or None, force=force, combine=False,
+                                             request_slots=request_slots, **kwargs)
+                for ppp_version in PPP_VERSIONS
+            }
+            # Wait for both pipelines, even if one of them fails.
+            failed = []
+            for ppp_version, future in futures.items():
+                try:
+                    future.result()
+                except (Exception, SystemExit) as error:
+                    print(f'The pipeline for the {ppp_version} PPPs failed: {error}')
+                    failed.append(ppp_version)
+        if failed:
+            raise SystemExit(f'The datasets were not combined, as the pipelines for the {failed} PPPs failed.')
+
+    if run_combine:
+        configure_storage(intermediate_format, export_csv=export_csv)
+        StageGraph([combine_stage()], state_dir=TEMP_DIR / 'stages').run(force=force)
+
+
+def render_diagnostic_charts(ppp_version: int, intermediate_format: str = "parquet") -> None:
+    """Render the diagnostic charts of the percentiles download, from the data saved by a previous run.
 
-    df_final = standardise(df_final, cols, ppp=ppp_version)
+    Parameters
+    ----------
+    ppp_version : int
+        PPP version of the run whose charts will be rendered.
+    intermediate_format : str, optional
+        Format of the intermediate files stored in the temporary folder ("parquet", "feather" or "csv").
 
-    # Once the script has been executed for 2011 and 2017, combine both dataframes and generate final dataset files.
-    combine_2011_and_2011_data()
+    """
+    configure_storage(intermediate_format)
+    render_diagnostics(*diagnostics_dirs(ppp_version))
 
 
 if __name__ == "__main__":
     # Get arguments from command line.
     parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("step",
+        nargs="?",
+        default="dataset",
+        choices=["dataset", "diagnostics"],
+        help="Either generate the dataset (default), or only render the diagnostic charts of the percentiles data "
+             "saved by a previous run.",
+    )
     parser.add_argument("-p",
         "--ppp_version",
-        help="PPP version (either 2011 or 2017), which will change the poverty lines to query.",
+        choices=[str(ppp_version) for ppp_version in PPP_VERSIONS] + ["all"],
+        help="PPP version (either 2011 or 2017), which will change the poverty lines to query, or all to build both "
+             "PPP versions in parallel (sharing the -w budget of concurrent requests), and combine them.",
         required=True,
     )
     parser.add_argument("-d",
@@ -124,6 +402,142 @@ if __name__ == "__main__":
         action="store_true",
         help="If given, relative poverty data will be regenerated (which can take ~1.5 hours).",
     )
+    parser.add_argument("-w",
+        "--max_workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help=f"Maximum number of concurrent requests to the PIP API when downloading percentiles and relative poverty data "
+             f"(default {DEFAULT_MAX_WORKERS}; 1 to query serially).",
+    )
+    parser.add_argument("--no-cache",
+        dest="use_cache",
+        default=True,
+        action="store_false",
+        help="If given, PIP API responses will neither be read from nor stored in the on-disk response cache.",
+    )
+    parser.add_argument("--refresh-cache",
+        default=False,
+        action="store_true",
+        help="If given, cached PIP API responses will be ignored and replaced by new ones.",
+    )
+    parser.add_argument("--resume",
+        default=False,
+        action="store_true",
+        help="If given (together with -d), resume an interrupted download of percentiles data, fetching only the "
+             "poverty lines that are missing.",
+    )
+    parser.add_argument("--percentile_method",
+        default="grid",
+        choices=["grid", "search"],
+        help="How to find the percentiles of countries when downloading percentiles data: from a fixed grid of "
+             "poverty lines (default), or searching them for each country-year (more accurate, but more requests).",
+    )
+    parser.add_argument("--percentile_tolerance",
+        type=float,
+        default=DEFAULT_HEADCOUNT_TOLERANCE,
+        help=f"Tolerance of the headcount ratio when searching percentiles (default {DEFAULT_HEADCOUNT_TOLERANCE}).",
+    )
+    parser.add_argument("--relative_method",
+        default="api",
+        choices=["api", "local"],
+        help="How to generate relative poverty data: querying each country-year to the PIP API (default), or computing "
+             "it locally from the full-distribution grid downloaded with the percentiles data (in seconds; not with "
+             "--incremental, which does not download the grid again).",
+    )
+    parser.add_argument("--relative_validation_sample",
+        type=int,
+        default=DEFAULT_RELATIVE_VALIDATION_SAMPLE,
+        help=f"Number of country-years whose relative poverty data computed locally is compared with the PIP API "
+             f"(default {DEFAULT_RELATIVE_VALIDATION_SAMPLE}; 0 to skip the comparison).",
+    )
+    parser.add_argument("--intermediate_format",
+        default="parquet",
+        choices=list(FORMAT_SUFFIXES),
+        help="Format of the intermediate files stored in the temporary folder (default parquet).",
+    )
+    parser.add_argument("--export_csv",
+        default=False,
+        action="store_true",
+        help="If given, a csv copy of each intermediate file will also be exported (for debugging).",
+    )
+    parser.add_argument("--diagnostics",
+        default="parallel",
+        choices=list(DIAGNOSTICS_MODES),
+        help="How to produce the diagnostic charts of the percentiles download: off, deferred (only save their data, "
+             "to render them later with the diagnostics step) or parallel (default; render them in separate "
+             "processes while the pipeline goes on).",
+    )
+    parser.add_argument("--stages",
+        default=None,
+        help="Comma-separated stages of the pipeline to run (if they are out of date); a stage followed by + also runs "
+             "all stages downstream of it, e.g. --stages thresholds+. Stages: country_data, regional_data, "
+             "query_poverty, query_non_poverty, thresholds, distribution_store, relative_poverty, additional_variables, "
+             "median_patch, standardise, combine (default all).",
+    )
+    parser.add_argument("--force",
+        default=False,
+        action="store_true",
+        help="If given, the selected stages will run even if they are up to date.",
+    )
+    parser.add_argument("--incremental",
+        default=False,
+        action="store_true",
+        help="If given, percentiles and relative poverty data will be extracted again only for the country-years whose "
+             "survey metadata or headline values changed since their previous extraction (e.g. after a change of "
+             "PIP_VERSION), carrying forward the data of all others (implies -d and -r).",
+    )
+    parser.add_argument("--cassette",
+        dest="cassette_mode",
+        default=None,
+        choices=list(CASSETTE_MODES),
+        help="If given, either record all PIP API responses in a cassette, or replay them from a cassette recorded "
+             "before, without any network access (requests missing from the cassette are reported).",
+    )
+    parser.add_argument("--cassette_dir",
+        default=PIP_CASSETTE_DIR,
+        type=Path,
+        help=f"Directory of the cassette of PIP API responses (default {PIP_CASSETTE_DIR}).",
+    )
+    parser.add_argument("--metrics_interval",
+        type=float,
+        default=60,
+        help="Number of seconds between exports of the metrics of the PIP API requests (JSON summary and Prometheus "
+             "textfile), or 0 to only export them at the end of the run (default 60).",
+    )
+    parser.add_argument("--profile",
+        default=False,
+        action="store_true",
+        help="If given, the memory allocated by each stage will be traced (which slows it down), and its cProfile "
+             "output saved in the profile folder of the temporary folder.",
+    )
+    parser.add_argument("--float32",
+        default=False,
+        action="store_true",
+        help="If given, metrics parsed from PIP API responses will be stored as 32-bit floats, to halve their memory "
+             "(values are rounded to about 7 significant digits, so the output changes slightly).",
+    )
     args = parser.parse_args()
-    # Execute main pipeline.
-    main(ppp_version=int(args.ppp_version), download_data=args.download_data, regenerate_data=args.regenerate_data)
+    # An incremental run never downloads the full-distribution grid again, so it would be of another PIP version.
+    if args.incremental and (args.relative_method == "local"):
+        parser.error("--relative_method local cannot be used with --incremental, which does not download the "
+                     "full-distribution grid again. Use --relative_method api, or download the grid again with -d.")
+    if args.step == "diagnostics":
+        for ppp_version in (PPP_VERSIONS if args.ppp_version == "all" else [int(args.ppp_version)]):
+            render_diagnostic_charts(ppp_version=ppp_version, intermediate_format=args.intermediate_format)
+    else:
+        # Execute main pipeline.
+        arguments = dict(download_data=args.download_data, regenerate_data=args.regenerate_data,
+                         max_workers=args.max_workers, use_cache=args.use_cache, refresh_cache=args.refresh_cache,
+                         resume=args.resume, percentile_method=args.percentile_method,
+                         percentile_tolerance=args.percentile_tolerance, relative_method=args.relative_method,
+                         relative_validation_sample=args.relative_validation_sample,
+                         intermediate_format=args.intermediate_format,
+                         export_csv=args.export_csv, diagnostics=args.diagnostics,
+                         stages_to_run=args.stages.split(",") if args.stages else None, force=args.force,
+                         incremental=args.incremental, cassette_mode=args.cassette_mode,
+                         cassette_dir=args.cassette_dir, metrics_interval=args.metrics_interval, profile=args.profile,
+                         float32=args.float32)
+        if args.ppp_version == "all":
+            main_all_ppp_versions(**arguments)
+        else:
+            main(ppp_version=int(args.ppp_version), **arguments)
@@ -0,0 +1,221 @@
+"""Engines to find the income or consumption thresholds of percentiles from headcount ratios.
+
+The headcount ratio of an entity (the share of its population below a poverty line) is a monotone function of the
+poverty line. The percentile P(p) of the distribution is the poverty line at which the headcount ratio is p/100.
+
+"""
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Default tolerance (as a share of the population) of the headcount ratio at the poverty line found for a percentile.
+DEFAULT_HEADCOUNT_TOLERANCE = 0.0005
+
+
+def search_percentile_thresholds(evaluate: Callable[[float], float], targets: Sequence[float],
+                                 known_points: Optional[Dict[float, float]] = None,
+                                 tolerance: float = DEFAULT_HEADCOUNT_TOLERANCE, min_step: float = 0.001,
+                                 max_povline: float = 10000.0, max_evaluations: int = 1000) -> List[Tuple[float, float]]:
+    """Search the poverty lines at which the headcount ratio of one entity is closest to each target.
+
+    Each target is bracketed between the evaluated poverty lines just below and above it, and the bracket is narrowed
+    with secant steps (falling back to bisection when a secant step does not halve the bracket), until the headcount
+    ratio at some evaluated line is within the tolerance of the target. Evaluations are shared by all targets, so the
+    search for each target starts from the brackets left by the previous ones.
+
+    Parameters
+    ----------
+    evaluate : callable
+        Function returning the headcount ratio (between 0 and 1) at a given poverty line (in dollars).
+    targets : sequence of float
+        Target headcount ratios (e.g. 0.01, ..., 0.99).
+    known_points : dict, optional
+        Headcount ratios already known for some poverty lines, e.g. from a coarse grid fetched for all entities at once.
+    tolerance : float, optional
+        Maximum absolute difference between the headcount ratio found and its target.
+    min_step : float, optional
+        Width of a bracket (in dollars) below which the search stops, e.g. where the headcount ratio jumps over the
+        target because it is a step function (as with survey microdata).
+    max_povline : float, optional
+        Largest poverty line (in dollars) to evaluate when looking for an upper bracket.
+    max_evaluations : int, optional
+        Maximum number of calls to `evaluate`.
+
+    Returns
+    -------
+    thresholds : list of tuple
+        Pair (poverty line, headcount ratio) of the evaluated line closest to each target, in the order of the targets.
+
+    """
+    points = dict(known_points or {})
+    n_evaluations = 0
+
+    def add_point(povline):
+        nonlocal n_evaluations
+        points[povline] = evaluate(povline)
+        n_evaluations += 1
+
+    if len(points) == 0:
+        add_point(1.0)
+
+    thresholds = []
+    for target in targets:
+        previous_width = np.inf
+        while n_evaluations < max_evaluations:
+            povlines = np.array(sorted(points))
+            headcounts = np.array([points[povline] for povline in povlines])
+            if np.abs(headcounts - target).min() <= tolerance:
+                break
+
+            # Bracket the target between the closest lines below and above it (nobody is below a poverty line of 0).
+            below = povlines[headcounts < target]
+            low, headcount_low = (below[-1], points[below[-1]]) if len(below) > 0 else (0.0, 0.0)
+            above = povlines[(headcounts > target) & (povlines > low)]
+            if len(above) == 0:
+                if povlines[-1] >= max_povline:
+                    break
+                # Expand the search upwards.
+                add_point(round(min(max(povlines[-1], low, min_step) * 2, max_povline), 4))
+                continue
+            high, headcount_high = above[0], points[above[0]]
+
+            width = high - low
+            if width < min_step:
+                break
+            # Bisect when the previous step did not halve the bracket (secant steps can stall on one side).
+            use_bisection = width > previous_width / 2
+            previous_width = width
+            if use_bisection or (headcount_high == headcount_low):
+                povline = low + width / 2
+            else:
+                povline = low + (target - headcount_low) * width / (headcount_high - headcount_low)
+            # Make sure the new line is strictly inside the bracket, once rounded.
+            povline = round(min(max(povline, low + width * 0.01), high - width * 0.01), 4)
+            if (povline <= low) or (povline >= high):
+                break
+            add_point(povline)
+
+        # Pick the evaluated line closest to the target.
+        povline_closest = min(points, key=lambda povline: abs(points[povline] - target))
+        thresholds.append((povline_closest, points[povline_closest]))
+
+    return thresholds
+
+
+def _sorted_codes(values: pd.Series) -> Tuple[np.ndarray, int]:
+    # Codes of the values of a column in the order of their sorted values (and the number of codes). Categoricals are
+    # sorted by value, as the order of their categories may not be sorted.
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = values.cat.categories
+        ranks = np.empty(len(categories), dtype=np.int64)
+        ranks[np.argsort(np.asarray(categories), kind='stable')] = np.arange(len(categories))
+        codes = values.cat.codes.to_numpy()
+        return np.where(codes >= 0, ranks[codes], -1), len(categories)
+    codes, uniques = pd.factorize(values, sort=True)
+
+    return codes, len(uniques)
+
+
+def entity_codes(df: pd.DataFrame, id_cols: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Number the entities (combinations of identifiers) of a dataframe in the order of their sorted identifiers.
+
+    Grouping by several categorical identifiers does not sort the groups in some versions of pandas, so entities are
+    numbered from the sorted codes of each identifier instead.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data with columns `id_cols` (without missing values).
+    id_cols : list of str
+        Columns identifying an entity.
+
+    Returns
+    -------
+    codes : np.ndarray
+        Number of the entity of each row (from 0 to the number of entities - 1).
+    first_rows : np.ndarray
+        Position of the first row of each entity.
+
+    """
+    if len(df) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    column_codes = [_sorted_codes(df[column]) for column in id_cols]
+    if np.prod([float(n_codes + 1) for _, n_codes in column_codes]) >= 2 ** 62:
+        # Too many combinations to number them with a single integer.
+        _, first_rows, codes = np.unique(np.column_stack([codes for codes, _ in column_codes]), axis=0,
+                                         return_index=True, return_inverse=True)
+        return codes.ravel(), first_rows
+
+    # Combine the codes of all identifiers into a single integer (in the same order as the identifiers), and number
+    # the combinations with a hash table (sorting only the distinct combinations, instead of all rows).
+    combined = np.zeros(len(df), dtype=np.int64)
+    for codes, n_codes in column_codes:
+        combined = combined * (n_codes + 1) + codes + 1
+    codes, uniques = pd.factorize(combined)
+    order = np.argsort(uniques)
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    # Distinct combinations are numbered in order of appearance, so their first rows are the first non-duplicates.
+    first_rows = np.flatnonzero(~pd.Series(combined).duplicated().to_numpy())[order]
+
+    return ranks[codes], first_rows
+
+
+def find_closest_percentiles(df: pd.DataFrame, id_cols: List[str], percentiles: Sequence[int] = range(1, 100),
+                             ) -> pd.DataFrame:
+    """Find, for each entity and percentile, the poverty line of a grid at which the headcount ratio is closest to it.
+
+    The headcount curve of each entity is sorted only once, and the closest grid point to every target percentile is
+    found for all entities and percentiles at once with a binary search (`np.searchsorted`), instead of sorting the
+    whole grid again for each percentile. When two grid points are equally close to a target, the one with the lowest
+    headcount ratio is chosen.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Grid of headcount ratios, with columns `id_cols`, 'poverty_line' and 'headcount' (one row per entity and line).
+    id_cols : list of str
+        Columns identifying an entity (e.g. ['Entity', 'Year', 'reporting_level', 'welfare_type']).
+    percentiles : sequence of int, optional
+        Target percentiles.
+
+    Returns
+    -------
+    df_closest : pd.DataFrame
+        Closest grid point to each target percentile, with columns `id_cols`, 'target_percentile' (e.g. 'P10'),
+        'poverty_line', 'headcount' and 'distance_to_p', sorted by percentile and then by entity.
+
+    """
+    # Ignore rows without an entity or a headcount ratio.
+    df = df.dropna(subset=id_cols + ['headcount'])
+    codes, _ = entity_codes(df, id_cols)
+    headcounts = df['headcount'].to_numpy(dtype=float)
+    povlines = df['poverty_line'].to_numpy()
+
+    # Sort by entity and headcount ratio, so that the headcount curve of each entity is a sorted segment of the array.
+    # Headcount ratios are within [0, 1], so offsetting them by twice the entity code keeps the segments apart.
+    order = np.lexsort((povlines, headcounts, codes))
+    keys = codes[order] * 2.0 + headcounts[order]
+    n_entities = codes.max() + 1 if len(codes) > 0 else 0
+    segment_starts = np.searchsorted(codes[order], np.arange(n_entities), side='left')
+    segment_ends = np.searchsorted(codes[order], np.arange(n_entities), side='right')
+
+    # Binary search of every (percentile, entity) target in its entity's segment.
+    targets = np.repeat(np.asarray(percentiles) / 100, n_entities)
+    target_entities = np.tile(np.arange(n_entities), len(percentiles))
+    positions = np.searchsorted(keys, target_entities * 2.0 + targets, side='left')
+    # The closest point is either the last one below the target or the first one above it.
+    below = np.clip(positions - 1, segment_starts[target_entities], segment_ends[target_entities] - 1)
+    above = np.clip(positions, segment_starts[target_entities], segment_ends[target_entities] - 1)
+    distance_below = np.abs(headcounts[order][below] - targets)
+    distance_above = np.abs(headcounts[order][above] - targets)
+    closest = order[np.where(distance_above < distance_below, above, below)]
+
+    df_closest = df.iloc[closest][id_cols + ['poverty_line', 'headcount']].reset_index(drop=True)
+    df_closest.insert(len(id_cols), 'target_percentile', np.repeat([f'P{p}' for p in percentiles], n_entities))
+    df_closest['distance_to_p'] = np.minimum(distance_below, distance_above)
+
+    return df_closest
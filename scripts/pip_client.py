@@ -0,0 +1,604 @@
+"""Client-side helpers to query the World Bank PIP API.
+
+Responses are stored in an on-disk cache keyed on the full request URL. Since the URL pins the PIP data version and the
+PPP version (which refer to immutable data releases), a cached response never needs to be invalidated, and reruns of
+the pipeline for a given version are almost entirely served locally.
+
+All requests go through a `PIPClient`, which keeps a pool of persistent (keep-alive) connections to the API and asks
+for compressed responses, so that thousands of queries do not each pay for a new connection and TLS handshake.
+
+Failed requests are retried with exponential backoff (honouring the `Retry-After` header sent by the API) up to a
+retry budget, after which a `PIPRequestError` is raised. A circuit breaker shared by all requests pauses every worker
+for a while when the recent error rate is too high, instead of letting them hammer an overloaded server.
+
+Every request attempt can be recorded in a `FetchMetrics` (latency, bytes, retries and statuses by endpoint, see
+scripts/telemetry.py).
+
+A `Cassette` can record every response the client gets, and replay them later without any network access (e.g. to run
+the pipeline offline, in tests or on a machine without access to the API).
+
+The response cache and the cassette can be shared by clients in several processes (e.g. when both PPP versions are
+built at once), which can also share a budget of concurrent requests to the API (`request_slots`).
+
+"""
+
+import collections
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from scripts.telemetry import FetchMetrics
+
+# Default maximum size of the response cache (in bytes), after which the least recently used responses are evicted.
+DEFAULT_CACHE_MAX_SIZE_BYTES = 10 * 1024 ** 3
+# HTTP status codes of responses that are worth retrying (any other error status fails straight away).
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Errors of requests that are not worth retrying, as they come from the request itself rather than from the network.
+NON_RETRYABLE_REQUEST_ERRORS = (requests.exceptions.InvalidURL, requests.exceptions.InvalidSchema,
+                                requests.exceptions.MissingSchema, requests.exceptions.InvalidHeader)
+# Modes of a cassette: record the responses of all requests, or replay them without network access.
+CASSETTE_MODES = ("record", "replay")
+
+
+class PIPRequestError(Exception):
+    """Raised when a request to the PIP API fails permanently, or keeps failing after its retry budget is exhausted."""
+
+    def __init__(self, request_url: str, reason: str, attempts: int) -> None:
+        super().__init__(f"Request failed after {attempts} attempt(s) ({reason}): {request_url}")
+        self.request_url = request_url
+        self.reason = reason
+        self.attempts = attempts
+
+    def __reduce__(self):
+        # Rebuilt from its arguments when sent from another process (e.g. a pipeline run by main_all_ppp_versions).
+        return PIPRequestError, (self.request_url, self.reason, self.attempts)
+
+
+class CassetteMissError(PIPRequestError):
+    """Raised when a request is not in the cassette being replayed."""
+
+    def __init__(self, request_url: str) -> None:
+        super().__init__(request_url, reason="not recorded in the cassette", attempts=0)
+
+    def __reduce__(self):
+        return CassetteMissError, (self.request_url,)
+
+
+def normalize_url(request_url: str) -> str:
+    """Return a canonical form of a request URL, with sorted query parameters and no repeated slashes in its path."""
+    parts = urlsplit(request_url)
+    path = "/".join(part for part in parts.path.split("/") if part != "")
+    if parts.path.startswith("/"):
+        path = "/" + path
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ""))
+
+
+class Cassette:
+    """Recorded responses of the PIP API, to replay them without network access.
+
+    Each response is stored compressed (with gzip) in a file named after the SHA-256 hash of its normalized request
+    URL, and an index maps each of these keys back to its URL. Each process recording responses writes its own index
+    file (index-<pid>.json), so that cassettes recording at the same time in several processes never overwrite each
+    other's entries, and the index of the cassette is the union of all of them. In "record" mode, every response the client gets (from
+    the API or from the response cache) is stored. In "replay" mode, responses are only read from the cassette, and any
+    request that was not recorded fails with a `CassetteMissError` (and is listed in `missing`).
+
+    Parameters
+    ----------
+    cassette_dir : Path
+        Directory where responses are stored.
+    mode : str
+        Either "record" or "replay".
+
+    """
+
+    def __init__(self, cassette_dir: Path, mode: str) -> None:
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode {mode}. Choose one of {list(CASSETTE_MODES)}.")
+        self.cassette_dir = Path(cassette_dir)
+        self.mode = mode
+        self.replayed = 0
+        self.recorded = 0
+        self.missing: List[str] = []
+        self._lock = threading.Lock()
+        # Responses recorded by this cassette (the index of all recorded responses is read with _read_index).
+        self._index: Dict[str, str] = {}
+
+    @property
+    def index_file(self) -> Path:
+        """Index file of the responses recorded by this process."""
+        return self.cassette_dir / f"index-{os.getpid()}.json"
+
+    @staticmethod
+    def _read_index_file(index_file: Path) -> Dict[str, str]:
+        if not index_file.is_file():
+            return {}
+        with open(index_file) as file:
+            return json.load(file)
+
+    def _read_index(self) -> Dict[str, str]:
+        # The index written by previous versions (index.json) and the index of each process that recorded responses.
+        index = {}
+        for index_file in sorted(self.cassette_dir.glob("index*.json")):
+            index.update(self._read_index_file(index_file))
+
+        return index
+
+    def _path(self, key: str) -> Path:
+        return self.cassette_dir / key[:2] / f"{key}.gz"
+
+    @staticmethod
+    def key(request_url: str) -> str:
+        return hashlib.sha256(normalize_url(request_url).encode("utf-8")).hexdigest()
+
+    def get(self, request_url: str) -> bytes:
+        """Return the recorded response of a request URL.
+
+        Raises
+        ------
+        CassetteMissError
+            If the request was not recorded.
+
+        """
+        path = self._path(self.key(request_url))
+        if not path.is_file():
+            with self._lock:
+                self.missing.append(request_url)
+            raise CassetteMissError(request_url)
+        with self._lock:
+            self.replayed += 1
+
+        return gzip.decompress(path.read_bytes())
+
+    def put(self, request_url: str, content: bytes) -> None:
+        """Record the response of a request URL."""
+        key = self.key(request_url)
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that an interruption never leaves a partially written response.
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        # A fixed modification time keeps the compressed bytes identical for identical responses.
+        temp_path.write_bytes(gzip.compress(content, mtime=0))
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._index[key] = normalize_url(request_url)
+            self.recorded += 1
+
+    def close(self) -> None:
+        """Write the index of the responses recorded by this process (in "record" mode).
+
+        Only this process writes its index file, so no lock between processes is needed. The file is merged with the
+        one left by an earlier process with the same id, if any.
+
+        """
+        if self.mode != "record":
+            return
+        self.cassette_dir.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            index = {**self._read_index_file(self.index_file), **self._index}
+            temp_index_file = self.index_file.with_name(f"{self.index_file.name}.tmp")
+            with open(temp_index_file, "w") as file:
+                json.dump(index, file, indent=0, sort_keys=True)
+            os.replace(temp_index_file, self.index_file)
+
+    def report(self) -> str:
+        """Return a summary of the requests recorded or replayed (listing the ones missing from the cassette)."""
+        if self.mode == "record":
+            return f"PIP API cassette: {self.recorded} responses recorded in {self.cassette_dir}"
+        summary = f"PIP API cassette: {self.replayed} responses replayed, {len(self.missing)} missing"
+        for request_url in self.missing:
+            summary += f"\n  missing: {request_url}"
+
+        return summary
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of API responses, with size-based LRU eviction.
+
+    Each response is stored in a file named after the SHA-256 hash of its request URL. Reading a response updates the
+    modification time of its file, which is used to decide which responses to evict when the cache exceeds its
+    maximum size.
+
+    Parameters
+    ----------
+    cache_dir : Path
+        Directory where responses will be stored (created on first write).
+    max_size_bytes : int, optional
+        Maximum total size of the stored responses.
+    enabled : bool, optional
+        False to neither read from nor write to the cache.
+    refresh : bool, optional
+        True to ignore stored responses, but still store the new ones (overwriting the old ones).
+
+    """
+
+    def __init__(self, cache_dir: Path, max_size_bytes: int = DEFAULT_CACHE_MAX_SIZE_BYTES, enabled: bool = True,
+                 refresh: bool = False) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.enabled = enabled
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size_bytes: Optional[int] = None
+
+    @staticmethod
+    def key(request_url: str) -> str:
+        return hashlib.sha256(request_url.encode("utf-8")).hexdigest()
+
+    def _path(self, request_url: str) -> Path:
+        key = self.key(request_url)
+        return self.cache_dir / key[:2] / key
+
+    def _files(self):
+        return [path for path in self.cache_dir.glob("*/*") if path.is_file() and not path.name.endswith(".tmp")]
+
+    def get(self, request_url: str) -> Optional[bytes]:
+        """Return the stored response for a request URL, or None if it is not in the cache."""
+        if not self.enabled:
+            return None
+
+        path = self._path(request_url)
+        content = None
+        if not self.refresh and path.is_file():
+            try:
+                content = path.read_bytes()
+                # Mark the response as recently used.
+                os.utime(path)
+            except FileNotFoundError:
+                # The file was evicted by another thread in the meantime.
+                content = None
+
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return content
+
+    def put(self, request_url: str, content: bytes) -> None:
+        """Store the response of a request URL, evicting old responses if the cache grows beyond its maximum size."""
+        if not self.enabled:
+            return
+
+        path = self._path(request_url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never see a partially written response.
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(content)
+
+        with self._lock:
+            old_size = path.stat().st_size if path.is_file() else 0
+            os.replace(temp_path, path)
+            if self._size_bytes is None:
+                self._size_bytes = sum(file.stat().st_size for file in self._files())
+            else:
+                self._size_bytes += len(content) - old_size
+            if self._size_bytes > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Remove least recently used responses until the cache is back under its maximum size.
+        files = sorted(self._files(), key=lambda file: file.stat().st_mtime)
+        for file in files:
+            if self._size_bytes <= self.max_size_bytes:
+                break
+            try:
+                size = file.stat().st_size
+                file.unlink()
+            except FileNotFoundError:
+                # The file was evicted by another process sharing the cache.
+                continue
+            self._size_bytes -= size
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, and a maximum number of retries per request.
+
+    Parameters
+    ----------
+    max_retries : int, optional
+        Maximum number of times a request is retried before giving up.
+    backoff_base : float, optional
+        Maximum delay (in seconds) before the first retry, which doubles with every new retry.
+    backoff_max : float, optional
+        Upper bound (in seconds) for the backoff delay.
+    max_retry_after : float, optional
+        Upper bound (in seconds) for the delay requested by the server in a `Retry-After` header.
+
+    """
+
+    def __init__(self, max_retries: int = 8, backoff_base: float = 1.0, backoff_max: float = 120.0,
+                 max_retry_after: float = 600.0) -> None:
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+
+    def delay(self, retry: int, retry_after: Optional[float] = None) -> float:
+        """Return the number of seconds to wait before the given retry (starting at 0)."""
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+        if retry_after is not None:
+            # Never retry earlier than the server asked for.
+            return max(backoff, min(retry_after, self.max_retry_after))
+
+        return backoff
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse the value of a `Retry-After` header (either a number of seconds or an HTTP date) into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+
+class CircuitBreaker:
+    """Pause all requests for a while when the error rate of the most recent requests is too high.
+
+    Parameters
+    ----------
+    window : int, optional
+        Number of most recent request attempts used to compute the error rate.
+    error_rate_threshold : float, optional
+        Error rate (between 0 and 1) above which the circuit opens.
+    min_attempts : int, optional
+        Minimum number of attempts in the window before the circuit can open.
+    cooldown : float, optional
+        Number of seconds during which requests are paused once the circuit opens.
+
+    """
+
+    def __init__(self, window: int = 50, error_rate_threshold: float = 0.5, min_attempts: int = 10,
+                 cooldown: float = 60.0) -> None:
+        self.window = window
+        self.error_rate_threshold = error_rate_threshold
+        self.min_attempts = min_attempts
+        self.cooldown = cooldown
+        self.times_opened = 0
+        self._outcomes = collections.deque(maxlen=window)
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+    def wait(self) -> None:
+        """Block while the circuit is open."""
+        while True:
+            with self._lock:
+                remaining = self._open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def record(self, success: bool) -> None:
+        """Record the outcome of a request attempt, and open the circuit if the error rate is too high."""
+        with self._lock:
+            self._outcomes.append(success)
+            n_errors = self._outcomes.count(False)
+            if (len(self._outcomes) >= self.min_attempts) and (n_errors / len(self._outcomes) > self.error_rate_threshold):
+                print(f"Error rate of the PIP API too high ({n_errors}/{len(self._outcomes)} failed attempts). "
+                      f"Pausing all requests for {self.cooldown} seconds.")
+                self._open_until = time.monotonic() + self.cooldown
+                self.times_opened += 1
+                # Start afresh after the pause, so that the circuit only opens again if errors persist.
+                self._outcomes.clear()
+
+
+def wire_bytes(response: requests.Response) -> int:
+    """Return the number of bytes of a response received over the network (compressed, if it was).
+
+    The size of `response.content` is the size once decompressed, which overstates the traffic of gzipped responses.
+    The bytes read from the raw stream are used instead, or else the `Content-Length` header, or else the size of the
+    content.
+
+    """
+    try:
+        n_bytes = response.raw.tell()
+    except Exception:
+        n_bytes = None
+    if isinstance(n_bytes, int) and (n_bytes > 0):
+        return n_bytes
+    content_length = response.headers.get("Content-Length")
+    if isinstance(content_length, str) and content_length.isdigit():
+        return int(content_length)
+
+    return len(response.content)
+
+
+def get_with_retries(request_url: str, retry_policy: RetryPolicy, circuit_breaker: CircuitBreaker,
+                     timeout: float = 500, session: Optional[requests.Session] = None,
+                     metrics: Optional[FetchMetrics] = None, request_slots=None) -> bytes:
+    """Get the content of a successful response for a request URL, retrying failed attempts.
+
+    Parameters
+    ----------
+    request_url : str
+        URL to request.
+    retry_policy : RetryPolicy
+        Policy deciding how long to wait before each retry and when to give up.
+    circuit_breaker : CircuitBreaker
+        Circuit breaker shared by all requests.
+    timeout : float, optional
+        Timeout (in seconds) of each attempt.
+    session : requests.Session, optional
+        Session used to send the request (if not given, a new connection is opened).
+    metrics : FetchMetrics, optional
+        Metrics where each attempt (and each retry and failure) is recorded.
+    request_slots : semaphore, optional
+        Semaphore held during each attempt (but not while waiting before a retry, so that other requests sharing it
+        are not starved during backoffs).
+
+    Returns
+    -------
+    content : bytes
+        Content of the response.
+
+    Raises
+    ------
+    PIPRequestError
+        If the response has a non-retryable error status, or if the request keeps failing after all retries.
+
+    """
+    retry = 0
+    while True:
+        circuit_breaker.wait()
+        retry_after = None
+        start_time = time.perf_counter()
+        try:
+            with request_slots if request_slots is not None else contextlib.nullcontext():
+                response = (session or requests).get(request_url, timeout=timeout)
+        except NON_RETRYABLE_REQUEST_ERRORS as error:
+            # A malformed request will not be fixed by retrying.
+            if metrics is not None:
+                metrics.record_attempt(request_url, time.perf_counter() - start_time, status=type(error).__name__)
+                metrics.record_failure(request_url)
+            raise PIPRequestError(request_url, reason=f"{type(error).__name__}: {error}", attempts=retry + 1)
+        except requests.RequestException as error:
+            # Connection errors, timeouts, and responses cut or corrupted mid-body (e.g. ChunkedEncodingError or
+            # ContentDecodingError) are transient.
+            reason = f"{type(error).__name__}: {error}"
+            if metrics is not None:
+                metrics.record_attempt(request_url, time.perf_counter() - start_time, status=type(error).__name__)
+        else:
+            if metrics is not None:
+                metrics.record_attempt(request_url, time.perf_counter() - start_time,
+                                       status=str(response.status_code), n_bytes=wire_bytes(response),
+                                       n_content_bytes=len(response.content))
+            if response.status_code == 200:
+                circuit_breaker.record(success=True)
+                return response.content
+            reason = f"status {response.status_code}"
+            if response.status_code not in RETRY_STATUS_CODES:
+                # Client errors (e.g. a malformed query) will not be fixed by retrying.
+                if metrics is not None:
+                    metrics.record_failure(request_url)
+                raise PIPRequestError(request_url, reason=reason, attempts=retry + 1)
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+        circuit_breaker.record(success=False)
+        if retry >= retry_policy.max_retries:
+            if metrics is not None:
+                metrics.record_failure(request_url)
+            raise PIPRequestError(request_url, reason=reason, attempts=retry + 1)
+        delay = retry_policy.delay(retry, retry_after=retry_after)
+        print(f"Request failed ({reason}), retrying in {delay:.1f} seconds: {request_url}")
+        if metrics is not None:
+            metrics.record_retry(request_url)
+        time.sleep(delay)
+        retry += 1
+
+
+class PIPClient:
+    """Client for the PIP API, shared by all queries of a pipeline run.
+
+    Parameters
+    ----------
+    cache : ResponseCache, optional
+        On-disk cache of responses (if not given, no responses are cached).
+    retry_policy : RetryPolicy, optional
+        Policy for retrying failed requests.
+    circuit_breaker : CircuitBreaker, optional
+        Circuit breaker pausing all requests when the API is struggling.
+    pool_connections : int, optional
+        Number of hosts for which a connection pool is kept.
+    pool_maxsize : int, optional
+        Maximum number of connections kept alive per host (which should be at least the number of concurrent workers).
+    timeout : float, optional
+        Timeout (in seconds) of each request attempt.
+    cassette : Cassette, optional
+        Cassette where all responses are recorded or, in "replay" mode, from which all responses are read (without ever
+        querying the API).
+    metrics : FetchMetrics, optional
+        Metrics where all requests (and lookups in the response cache) are recorded.
+    request_slots : semaphore, optional
+        Semaphore held during each request attempt to the API (e.g. a `multiprocessing.Manager().BoundedSemaphore`), to
+        share a budget of concurrent requests with clients in other processes. It is released while waiting before a
+        retry. Requests are only limited by the number of workers of each query if not given.
+
+    """
+
+    def __init__(self, cache: Optional[ResponseCache] = None, retry_policy: Optional[RetryPolicy] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None, pool_connections: int = 2, pool_maxsize: int = 16,
+                 timeout: float = 500, cassette: Optional[Cassette] = None,
+                 metrics: Optional[FetchMetrics] = None, request_slots=None) -> None:
+        self.cache = cache
+        self.request_slots = request_slots
+        self.cassette = cassette
+        self.metrics = metrics
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Retries are handled by get_with_retries, not by the adapter.
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+
+    def get(self, request_url: str) -> bytes:
+        """Get the content of the response for a request URL, from the cache if the same request was made before.
+
+        Raises
+        ------
+        PIPRequestError
+            If the request fails permanently or exhausts its retries (or, when replaying a cassette, if the request was
+            not recorded).
+
+        """
+        if (self.cassette is not None) and (self.cassette.mode == "replay"):
+            return self.cassette.get(request_url)
+
+        content = None
+        if self.cache is not None:
+            content = self.cache.get(request_url)
+            if (self.metrics is not None) and self.cache.enabled:
+                self.metrics.record_cache(hit=content is not None)
+        if content is None:
+            content = get_with_retries(request_url, retry_policy=self.retry_policy,
+                                       circuit_breaker=self.circuit_breaker, timeout=self.timeout,
+                                       session=self.session, metrics=self.metrics, request_slots=self.request_slots)
+            if self.cache is not None:
+                self.cache.put(request_url, content)
+
+        if self.cassette is not None:
+            self.cassette.put(request_url, content)
+
+        return content
+
+    def close(self) -> None:
+        self.session.close()
+        if self.cassette is not None:
+            self.cassette.close()
@@ -0,0 +1,146 @@
+"""Time and memory profiling of the stages of the pipeline.
+
+A `StageProfiler` wraps every stage run by a `StageGraph` (see scripts/stages.py) and records its wall time and CPU
+time (in seconds, of all threads of the process), the peak of the memory allocated by the stage (traced with
+tracemalloc, only if enabled, as tracing slows down allocations), the maximum resident memory of the process so far,
+and the number of rows and columns of the dataframes it takes and returns. The maximum resident memory is a high-water
+mark of the whole process, which stays the same for every stage after the heaviest one, so the traced peak is the
+memory of each stage. A run report with all stages (including the ones skipped because they were up to date) is
+written as JSON. Optionally, the output of cProfile is also saved for each stage (only the main thread is profiled, so
+time spent in threads fetching data from the API shows up as waiting for them).
+
+"""
+
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak resident memory is not reported.
+    resource = None
+
+
+def max_rss_mb() -> Optional[float]:
+    """Return the maximum resident memory of the process so far (in MB), or None if it cannot be measured."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes on Linux.
+    return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def shape_of(value: Any) -> Optional[List[int]]:
+    """Return the number of rows and columns of a dataframe (or None for any other value)."""
+    shape = getattr(value, "shape", None)
+    if (shape is None) or (len(shape) != 2):
+        return None
+
+    return [int(shape[0]), int(shape[1])]
+
+
+class StageProfiler:
+    """Profiler of the stages of a pipeline run.
+
+    Parameters
+    ----------
+    report_file : Path
+        JSON file where the run report will be written.
+    trace_memory : bool, optional
+        True to trace the memory allocated by each stage with tracemalloc.
+    cprofile_dir : Path, optional
+        Directory where the output of cProfile will be saved for each stage (as <stage>.prof, to be read with pstats
+        or snakeviz). Stages are not profiled with cProfile if not given.
+
+    """
+
+    def __init__(self, report_file: Path, trace_memory: bool = False, cprofile_dir: Optional[Path] = None) -> None:
+        self.report_file = Path(report_file)
+        self.trace_memory = trace_memory
+        self.cprofile_dir = Path(cprofile_dir) if cprofile_dir is not None else None
+        self.started_at = time.time()
+        self.stages: List[Dict[str, Any]] = []
+
+    def skipped(self, name: str, reason: str) -> None:
+        """Record a stage that did not run."""
+        self.stages.append({"stage": name, "status": "skipped", "reason": reason})
+
+    def run(self, name: str, function: Callable, arguments: Dict[str, Any]) -> Any:
+        """Run the function of a stage with the given arguments, recording its profile."""
+        record = {
+            "stage": name,
+            "status": "failed",
+            "inputs": {argument: shape_of(value) for argument, value in arguments.items()
+                       if shape_of(value) is not None},
+        }
+        self.stages.append(record)
+        profile = cProfile.Profile() if self.cprofile_dir is not None else None
+        if self.trace_memory:
+            tracemalloc.start()
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        try:
+            if profile is not None:
+                result = profile.runcall(function, **arguments)
+            else:
+                result = function(**arguments)
+            record["status"] = "ran"
+            record["outputs"] = [shape_of(value) for value in (result if isinstance(result, tuple) else (result,))]
+        finally:
+            record["wall_time_seconds"] = time.perf_counter() - start_wall_time
+            record["cpu_time_seconds"] = time.process_time() - start_cpu_time
+            record["process_max_rss_mb"] = max_rss_mb()
+            record["peak_traced_mb"] = None
+            if self.trace_memory:
+                record["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+                tracemalloc.stop()
+            if profile is not None:
+                self.cprofile_dir.mkdir(parents=True, exist_ok=True)
+                profile.dump_stats(self.cprofile_dir / f"{name}.prof")
+            self.write_report()
+
+        return result
+
+    def report(self) -> Dict[str, Any]:
+        """Return the run report."""
+        return {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "wall_time_seconds": time.time() - self.started_at,
+            "process_max_rss_mb": max_rss_mb(),
+            "stages": self.stages,
+        }
+
+    def write_report(self) -> None:
+        """Write the run report (atomically)."""
+        self.report_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.report_file.with_name(f"{self.report_file.name}.tmp")
+        with open(temp_file, "w") as file:
+            json.dump(self.report(), file, indent=2)
+        os.replace(temp_file, self.report_file)
+
+    def summary(self) -> str:
+        """Return a table with the time and memory of each stage that ran.
+
+        The peak traced memory is the memory of each stage (only with `trace_memory`), whereas the maximum resident
+        memory is the high-water mark of the process up to the end of each stage.
+
+        """
+        lines = [f"{'Stage':<24} {'Wall (s)':>10} {'CPU (s)':>10} {'Peak traced (MB)':>17} "
+                 f"{'Process max RSS so far (MB)':>28} {'Rows out':>10}"]
+        for record in self.stages:
+            if record["status"] == "skipped":
+                lines.append(f"{record['stage']:<24} {'skipped (' + record['reason'] + ')':>77}")
+                continue
+            rows_out = ", ".join(str(shape[0]) for shape in record.get("outputs", []) if shape is not None)
+            peak_traced = f"{record['peak_traced_mb']:.0f}" if record["peak_traced_mb"] is not None else "-"
+            max_rss = f"{record['process_max_rss_mb']:.0f}" if record["process_max_rss_mb"] is not None else "-"
+            lines.append(f"{record['stage']:<24} {record['wall_time_seconds']:>10.2f} "
+                         f"{record['cpu_time_seconds']:>10.2f} {peak_traced:>17} {max_rss:>28} {rows_out:>10}")
+
+        return "\n".join(lines)
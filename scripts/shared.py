@@ -1,91 +1,120 @@
+import hashlib
 import io
+import json
 import time
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
-import plotly.express as px
-import requests
-
-# Path to current directory.
-CURRENT_DIR = Path(__file__).parent
-# Path to (public) directory where output datasets will be stored.
-OUTPUT_DIR = CURRENT_DIR.parent / "datasets"
-# Path to (public) directory where input files are stored.
-INPUT_DIR = CURRENT_DIR.parent / "input"
-# Path to output PIP dataset files.
-OUTPUT_CSV_FILE = OUTPUT_DIR / "pip_dataset.csv"
-OUTPUT_XLSX_FILE = OUTPUT_DIR / "pip_dataset.xlsx"
-# Path to PIP dataset codebook file.
-PIP_CODEBOOK_FILE = OUTPUT_DIR / "pip_codebook.csv"
-# Path to (ignored) directory where temporary files will be stored.
-TEMP_DIR = CURRENT_DIR.parent / "temp"
-# Define temporary sub-folders that need to be created.
-TEMP_SUB_DIRS = [
-    TEMP_DIR / "ppp_2011/raw",
-    TEMP_DIR / "ppp_2017/raw"
-]
-# Path to (ignored) directory where temporary plots will be stored.
-GRAPHICS_DIR = CURRENT_DIR.parent / "graphics"
-# Define PIP data version (which depends on the PPP version), to pass to the API.
-PIP_VERSION = {
-    2011: "20220909_2011_02_02_PROD",
-    2017: "20220909_2017_01_02_PROD",
-}
-# Base URL of PIP API.
-PIP_API_BASE_URL = "https://api.worldbank.org/pip/v1/"
-# Google sheet names and base URL.
-GOOGLE_SHEET_NAMES = {
-    2011: "pip_ppp_2011",
-    2017: "pip_ppp_2017",
-}
-GOOGLE_SHEET_ID = '1ntYtYF0NqIW2oXuXl_ZJHvuI7n-bik94BEIOvWHrJAI'
-GOOGLE_SHEET_BASE_URL = f'https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}/gviz/tq?tqx=out:csv&sheet='
+from scripts.bands import between_band_names, between_bands, check_sorted_povlines, stacked_band_names,\
+    stacked_bands
+from scripts.checkpoint import GracefulInterruption, PovlineCheckpoint
+from scripts.constants import CURRENT_DIR, OUTPUT_DIR, INPUT_DIR, OUTPUT_CSV_FILE, OUTPUT_XLSX_FILE, PIP_CODEBOOK_FILE,\
+    TEMP_DIR, TEMP_SUB_DIRS, PIP_CACHE_DIR, GRAPHICS_DIR, PIP_VERSION, PIP_API_BASE_URL, GOOGLE_SHEET_NAMES,\
+    GOOGLE_SHEET_ID, GOOGLE_SHEET_BASE_URL, SEARCH_SEED_POVLINES_CENTS, DEFAULT_MAX_WORKERS,\
+    DEFAULT_RELATIVE_VALIDATION_SAMPLE, HIGH_INCOME_POVLINE_CENTS, STACKED_BETWEEN_CENTS
+from scripts.curves import headcount_curves, poverty_measures
+from scripts.diagnostics import save_percentile_diagnostics
+from scripts.distribution_store import distribution_store_dir, write_distribution_store
+from scripts.dtypes import compact_dtypes
+from scripts.incremental import COMPARE_COLUMNS, COUNTRY_ID_COLUMNS, REGION_ID_COLUMNS, carry_forward, changed_rows
+from scripts.percentiles import DEFAULT_HEADCOUNT_TOLERANCE, entity_codes, find_closest_percentiles,\
+    search_percentile_thresholds
+from scripts.storage import intermediate_exists, read_intermediate, write_intermediate
+
+# Client used by queries that are not given one explicitly (see get_pip_client).
+_default_pip_client = None
+
+
+# Return the directories where the data of the diagnostic charts is saved, and where the charts are rendered.
+def diagnostics_dirs(ppp):
+    return TEMP_DIR / f'ppp_{ppp}/diagnostics', GRAPHICS_DIR / f'ppp_{ppp}'
+
+
+# Return the given PIP API client or, if None, a default client (with an on-disk response cache) shared by all queries.
+def get_pip_client(client=None):
+    global _default_pip_client
+
+    if client is not None:
+        return client
+    if _default_pip_client is None:
+        # The HTTP client is only loaded when the first query is made.
+        from scripts.pip_client import PIPClient, ResponseCache
+
+        _default_pip_client = PIPClient(cache=ResponseCache(PIP_CACHE_DIR), pool_maxsize=DEFAULT_MAX_WORKERS)
+
+    return _default_pip_client
 
 
-def pip_query_country(popshare_or_povline, value, country_code="all", year="all", fill_gaps="true", welfare_type="all", reporting_level="all", ppp_version=2011):
+def pip_query_country(popshare_or_povline, value, country_code="all", year="all", fill_gaps="true", welfare_type="all", reporting_level="all", ppp_version=2011, client=None):
     # Get PIP data version from PPP version.
     version = PIP_VERSION[ppp_version]
         
     # Build query
     request_url = f'{PIP_API_BASE_URL}pip?{popshare_or_povline}={value}&country={country_code}&year={year}&fill_gaps={fill_gaps}&welfare_type={welfare_type}&reporting_level={reporting_level}&ppp_version={ppp_version}&version={version}&format=csv'
-    status = 0
-    
-    while status != 200:
-        #df = pd.read_csv(request_url)
-        response = requests.get(request_url, timeout=500)
-        content = response.content
-        status = response.status_code
-    
-    df = pd.read_csv(io.StringIO(content.decode('utf-8')))
+    content = get_pip_client(client).get(request_url)
+
+    # Identifiers are stored as categoricals and years as small integers (see scripts/dtypes.py)
+    df = compact_dtypes(pd.read_csv(io.StringIO(content.decode('utf-8'))))
 
     return df
 
 
 # For world regions, the popshare query is not available (or rather, it returns nonsense).
-def pip_query_region(povline, year="all", ppp_version=2011):
+def pip_query_region(povline, year="all", ppp_version=2011, client=None):
     # Get PIP data version from PPP version.
     version = PIP_VERSION[ppp_version]
 
     # Build query
     request_url = f'{PIP_API_BASE_URL}/pip-grp?country=all&povline={povline}&year={year}&ppp_version={ppp_version}&version={version}&group_by=wb&format=csv'
-    status = 0
-    
-    while status != 200:
-        #df = pd.read_csv(request_url)
-        response = requests.get(request_url, timeout=500)
-        content = response.content
-        status = response.status_code
-    
-    df = pd.read_csv(io.StringIO(content.decode('utf-8')))
+    content = get_pip_client(client).get(request_url)
+
+    df = compact_dtypes(pd.read_csv(io.StringIO(content.decode('utf-8'))))
     df = df[df['reporting_year']>=1990].reset_index(drop=True)
 
     return df
 
 
+# Run fetch_function on each item (e.g. each poverty line), with at most max_workers requests sent to the API at the same time.
+# Results (and the time each query took) are returned in the same order as items, regardless of the order in which
+# the requests complete, so the output is identical to the one of a serial loop (which is what max_workers=1 runs).
+def fetch_concurrently(fetch_function, items, max_workers=DEFAULT_MAX_WORKERS):
+
+    def timed_fetch(item):
+        start_time = time.time()
+        result = fetch_function(item)
+        end_time = time.time()
+        return result, end_time - start_time
+
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            timed_results = list(executor.map(timed_fetch, items))
+    else:
+        timed_results = [timed_fetch(item) for item in items]
+
+    results = [result for result, _ in timed_results]
+    durations = [duration for _, duration in timed_results]
+
+    return results, durations
+
+
+# Return the rows of df_current (single-line data of all countries or regions) that are new or changed since the data
+# saved in snapshot_path, from which the artifacts in artifact_paths were extracted. Returns None if there is no
+# snapshot or artifact to refresh incrementally, in which case everything has to be extracted again.
+def changed_since_snapshot(df_current, snapshot_path, artifact_paths, id_cols, label):
+    if not all(intermediate_exists(path) for path in [snapshot_path] + artifact_paths):
+        print(f'No previous extraction of {label} to refresh incrementally: all of them will be extracted.')
+        return None
+
+    df_changed = changed_rows(read_intermediate(snapshot_path), df_current, id_cols, COMPARE_COLUMNS)
+    print(f'Incremental refresh of {label}: {len(df_changed)} of {len(df_current)} entities are new or changed.')
+
+    return df_changed
+
+
 # ## Get country data
 # This code is to query poverty data from a poverty line (filled or not). Entities are standardised and returns multiple outputs, one raw file with all the results, one only for consumption, one only for income and one for income and consumption dropping duplicates.
-def country_data(extreme_povline_cents, filled, ppp, additional_dfs=True):
+def country_data(extreme_povline_cents, filled, ppp, additional_dfs=True, client=None):
     #Query for all the countries and for the poverty line defined (only non-filled data)
     df_country = pip_query_country(popshare_or_povline = "povline",
                                     country_code = "all",
@@ -94,22 +123,22 @@ def country_data(extreme_povline_cents, filled, ppp, additional_dfs=True):
                                     reporting_level = "all",
                                     value = extreme_povline_cents/100,
                                     fill_gaps=filled,
-                                    ppp_version=ppp)
+                                    ppp_version=ppp,
+                                    client=client)
 
     df_country = df_country.rename(columns={'country_name': 'Entity', 'reporting_year': 'Year'})
     
     if additional_dfs:
         
-        # Separate out consumption-only, income-only, and both dataframes
-        df_country_inc = df_country[df_country['welfare_type']=="income"].reset_index(drop=True).copy()
-        df_country_cons = df_country[df_country['welfare_type']=="consumption"].reset_index(drop=True).copy()
+        # Separate out consumption-only, income-only, and both dataframes (filtering already returns new dataframes)
+        df_country_inc = df_country[df_country['welfare_type']=="income"].reset_index(drop=True)
+        df_country_cons = df_country[df_country['welfare_type']=="consumption"].reset_index(drop=True)
 
-        df_country_inc_or_cons = df_country.copy()
         # If both inc and cons are available in a given year, drop inc
 
         # Flag duplicates – indicating multiple welfare_types
         #Sort values to ensure the welfare_type consumption is marked as False when there are multiple welfare types
-        df_country_inc_or_cons.sort_values(by=['Entity', 'Year', 'reporting_level', 'welfare_type'], ignore_index=True, inplace=True)
+        df_country_inc_or_cons = df_country.sort_values(by=['Entity', 'Year', 'reporting_level', 'welfare_type'], ignore_index=True)
         df_country_inc_or_cons['duplicate_flag'] = df_country_inc_or_cons.duplicated(subset=['Entity', 'Year', 'reporting_level'])
 
         #print(f'Checking the data for years with both income and consumption. Before dropping duplicated, there were {len(df_country_inc_or_cons)} rows...')
@@ -127,9 +156,9 @@ def country_data(extreme_povline_cents, filled, ppp, additional_dfs=True):
 
 # ## Regional data
 # Returns standardised regional data
-def regional_data(extreme_povline_cents, ppp):
+def regional_data(extreme_povline_cents, ppp, client=None):
     #Query for all the regions and for the poverty line defined
-    df_region = pip_query_region(extreme_povline_cents/100, ppp_version=ppp)
+    df_region = pip_query_region(extreme_povline_cents/100, ppp_version=ppp, client=client)
 
     df_region = df_region.rename(columns={'region_name': 'Entity', 'reporting_year': 'Year'})
 
@@ -174,124 +203,113 @@ def standardize_entities(orig_df,
 
 # ## Querying poverty and non-poverty data from the PIP API
 
-#Create a dataframe for each poverty line on the list, including and excluding interpolations and for countries and regions
-#Each of these combinations are concatenated in a larger data frame.
-def query_poverty(poverty_lines_cents, filled, ppp):
+# Make a long dataframe wide, with one row per combination of `id_cols` (sorted), and one column per value column and
+# value of `column` (named by joining both, e.g. 'headcount_ratio' and '_190' into 'headcount_ratio_190'). Unlike
+# pivot_table, values are not aggregated: keys appearing more than once (e.g. a country-year returned twice by the API)
+# raise an error instead of being averaged. As pivot_table did, rows with missing keys or without any value, and
+# columns without any value, are left out.
+def unstack_strict(df, id_cols, column, value_cols):
+    keys = id_cols + [column]
+    keep = df[keys].notna().all(axis=1) & df[value_cols].notna().any(axis=1)
+    if not keep.all():
+        df = df[keep]
+
+    # Each row of the long data goes to one cell of the wide data
+    row_codes, first_rows = entity_codes(df, id_cols)
+    column_codes, first_columns = entity_codes(df, [column])
+    cells = row_codes * len(first_columns) + column_codes
+    duplicated = pd.Series(cells).duplicated(keep=False).to_numpy()
+    if duplicated.any():
+        raise ValueError(f'{duplicated.sum()} rows have duplicated keys {keys}, e.g. '
+                         f'{df[keys].iloc[np.flatnonzero(duplicated)[:5]].values.tolist()}')
+
+    column_labels = df[column].iloc[first_columns].tolist()
+    wide_columns = {}
+    for value_col in sorted(value_cols):
+        values = np.full(len(first_rows) * len(first_columns), np.nan)
+        values[cells] = df[value_col].to_numpy(dtype=float)
+        values = values.reshape(len(first_rows), len(first_columns))
+        for i, label in enumerate(column_labels):
+            if not np.isnan(values[:, i]).all():
+                wide_columns[f'{value_col}{label}'.strip()] = values[:, i]
+
+    return pd.concat([df[id_cols].iloc[first_rows].reset_index(drop=True), pd.DataFrame(wide_columns)], axis=1)
+
+
+#Query the data of each poverty line on the list, including and excluding interpolations and for countries and regions.
+#The data of all lines is stacked in a long data frame, where the derived metrics are computed at once, and then made wide.
+def query_poverty(poverty_lines_cents, filled, ppp, client=None):
 
     print('Querying data from several poverty lines from the PIP API...')
     start_time = time.time()
 
-    df_complete = pd.DataFrame()
-
-    # Run the API query and clean the response...
-    #... for each poverty line
-    for p in poverty_lines_cents:
-        
-        p_dollar = p/100
-        print(p_dollar)
-
-        #.. and for both countries and WB regional aggregates
-        for ent_type in ['country', 'region']:
-
-            # Make the API query for country data
-            if ent_type == 'country':
-                
-                df = country_data(p, filled, ppp, additional_dfs=False)
-
-                # Keep only these variables:
-                keep_vars = [ 
-                    'Entity',
-                    'Year',
-                    'reporting_level',
-                    'welfare_type', 
-                    'headcount',
-                    'poverty_gap',
-                    'poverty_severity', 
-                    'watts',
-                    'reporting_pop'
-                ]
+    # Variables identifying each row of countries and regions
+    id_vars = {
+        'country': ['Entity', 'Year', 'reporting_level', 'welfare_type'],
+        'region': ['Entity', 'Year'],
+    }
+    # Variables kept from the API responses
+    keep_vars = ['headcount', 'poverty_gap', 'poverty_severity', 'watts', 'reporting_pop']
 
-            # Make the API query for region data
-            # Note that the filled and not filled data is the same in this case .
-            # The code runs it twice anyhow.
-            if ent_type == 'region':
-                
-                df = regional_data(p, ppp)
+    # Results are collected in a list and concatenated once at the end (concatenating them one by one inside the loop
+    # would copy all the previous results on each iteration)
+    dfs = []
 
-                keep_vars = [ 
-                    'Entity',
-                    'Year',
-                    'headcount',
-                    'poverty_gap',
-                    'poverty_severity',
-                    'watts',
-                    'reporting_pop'
-                ]
-
-
-            df = df[keep_vars]
-
-            # rename columns
-            df = df.rename(columns={
-            'headcount':'headcount_ratio',
-            'poverty_gap': 'poverty_gap_index'})
+    # Run the API query for each poverty line...
+    for p in poverty_lines_cents:
 
+        print(p/100)
 
-            # Calculate number in poverty
-            df['headcount'] = df['headcount_ratio'] * df['reporting_pop']
-            df['headcount'] = df['headcount'].round(0)
+        #.. for countries
+        df_country = country_data(p, filled, ppp, additional_dfs=False, client=client)
 
-            # Calculate shortfall of incomes
-            df['total_shortfall'] = df['poverty_gap_index'] * p_dollar * df['reporting_pop']                      
+        #.. and for WB regional aggregates
+        # Note that the filled and not filled data is the same in this case .
+        df_region = regional_data(p, ppp, client=client)
 
-            # Calculate average shortfall of incomes (averaged across population in poverty)
-            df['avg_shortfall'] = df['total_shortfall'] / df['headcount']
+        for ent_type, df in [('country', df_country), ('region', df_region)]:
+            # Add poverty line as a var (I add the '_' character, because it being treated as a float later on was causing headaches)
+            dfs.append(df[id_vars[ent_type] + keep_vars].assign(**{'poverty line': f'_{p}', 'ent_type': ent_type,
+                                                                   'p_dollar': p/100}))
 
-            # Calculate income gap ratio (according to Ravallion's definition)
-            df['income_gap_ratio'] = (df['total_shortfall'] / df['headcount']) / p_dollar
+    #Concatenate all the results (concatenating country and region data turns their identifiers back into strings)
+    df_complete = compact_dtypes(pd.concat(dfs, ignore_index=True))
+    p_dollar = df_complete.pop('p_dollar')
 
+    # rename columns
+    df_complete = df_complete.rename(columns={
+        'headcount':'headcount_ratio',
+        'poverty_gap': 'poverty_gap_index'})
 
-            # Shares to percentages
-            # executing the function over list of vars
-            var_list = ['headcount_ratio', 'income_gap_ratio', 'poverty_gap_index' ]
+    # Calculate number in poverty
+    df_complete['headcount'] = (df_complete['headcount_ratio'] * df_complete['reporting_pop']).round(0)
 
-            #df[var_list] = df[var_list].apply(multiply_by_100)
-            df.loc[:, var_list] = df[var_list] * 100
+    # Calculate shortfall of incomes
+    df_complete['total_shortfall'] = df_complete['poverty_gap_index'] * p_dollar * df_complete['reporting_pop']
 
+    # Calculate average shortfall of incomes (averaged across population in poverty)
+    df_complete['avg_shortfall'] = df_complete['total_shortfall'] / df_complete['headcount']
 
-            # Add poverty line as a var (I add the '_' character, because it being treated as a float later on was causing headaches)
-            df['poverty line'] = f'_{p}'
-            df['ent_type'] = ent_type
+    # Calculate income gap ratio (according to Ravallion's definition)
+    df_complete['income_gap_ratio'] = (df_complete['total_shortfall'] / df_complete['headcount']) / p_dollar
 
-            #Concatenate all the results
-            df_complete = pd.concat([df_complete, df],ignore_index=True)
+    # Shares to percentages
+    var_list = ['headcount_ratio', 'income_gap_ratio', 'poverty_gap_index']
+    df_complete[var_list] = df_complete[var_list] * 100
 
     #I drop 'reporting_pop' for now to avoid it to get multiplied by all the poverty lines in the next section
-    df_complete = df_complete.drop(columns=['reporting_pop'])
-    df_complete.to_csv(TEMP_DIR / f'ppp_{ppp}/raw/multiple_povlines_long.csv', index=False)
-
-    # Select data for countries 
-    headcounts_country = df_complete[(df_complete['ent_type'] == 'country')].reset_index(drop=True)
-
-    # Select data for regions
-    headcounts_region = df_complete[(df_complete['ent_type'] == 'region')].reset_index(drop=True)
-
-    #Create pivot tables to make the data wide
-    headcounts_country_wide = headcounts_country.pivot_table(index=['Entity', 'Year', 'reporting_level', 'welfare_type'], 
-                    columns='poverty line')
-
-    headcounts_region_wide = headcounts_region.pivot_table(index=['Entity', 'Year'], 
-                    columns='poverty line')
+    metric_vars = ['headcount_ratio', 'poverty_gap_index', 'poverty_severity', 'watts', 'headcount', 'total_shortfall',
+                   'avg_shortfall', 'income_gap_ratio']
+    df_complete = df_complete[id_vars['country'] + metric_vars + ['poverty line', 'ent_type']]
+    write_intermediate(df_complete, TEMP_DIR / f'ppp_{ppp}/raw/multiple_povlines_long')
 
-    #Join multi index columns
-    headcounts_country_wide.columns = [''.join(col).strip() for col in headcounts_country_wide.columns.values]
-    headcounts_country_wide = headcounts_country_wide.reset_index()
-
-    headcounts_region_wide.columns = [''.join(col).strip() for col in headcounts_region_wide.columns.values]
-    headcounts_region_wide = headcounts_region_wide.reset_index()
+    #Make the data wide for countries and regions (each with one row per entity, and one column per metric and line)
+    headcounts_wide = [unstack_strict(df_complete[df_complete['ent_type'] == ent_type], id_vars[ent_type],
+                                      'poverty line', metric_vars)
+                       for ent_type in ['country', 'region']]
 
     #Concatenate country and regional wide datasets
-    df_final = pd.concat([headcounts_country_wide, headcounts_region_wide], ignore_index=False)
+    df_final = pd.concat(headcounts_wide, ignore_index=False)
     
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -358,19 +376,51 @@ def query_non_poverty(df_final, df_country, df_region):
     return df_final
 
 
-def integrate_relative_poverty(df_final, df_country, answer, ppp):
+# With incremental=True, relative poverty is only generated again for the rows of df_country (or their patched median)
+# that changed since the previous generation, and the rows of all other country-years are carried forward.
+# With method="local", it is computed from the full-distribution grid instead of querying the PIP API (see
+# generate_relative_poverty).
+def integrate_relative_poverty(df_final, df_country, answer, ppp, max_workers=DEFAULT_MAX_WORKERS, client=None,
+                               incremental=False, method="api", validation_sample=DEFAULT_RELATIVE_VALIDATION_SAMPLE):
     
     relative_poverty_lines = [40, 50, 60]
+    relative_file = TEMP_DIR / f'ppp_{ppp}/raw/relative_poverty'
+    snapshot_file = TEMP_DIR / f'ppp_{ppp}/raw/relative_poverty_base'
     
     if answer:
-        print("Generating relative poverty values... (takes about 1.5 hours)")
+        if method == "local":
+            print("Generating relative poverty values from the full-distribution grid...")
+        else:
+            print("Generating relative poverty values... (takes about 1.5 hours)")
         start_time = time.time()
         df = median_patch(df_country, ppp)
         
         for pct in relative_poverty_lines:
             df[f'median_{pct}'] = df['median'] * pct/100
-            
-        generate_relative_poverty(df, relative_poverty_lines, ppp)
+
+        df_changed = None
+        if incremental:
+            df_changed = changed_since_snapshot(df, snapshot_file, [relative_file], COUNTRY_ID_COLUMNS,
+                                                'relative poverty')
+        if df_changed is None:
+            df_relative = generate_relative_poverty(df, relative_poverty_lines, ppp, max_workers=max_workers,
+                                                    client=client, method=method, validation_sample=validation_sample)
+        else:
+            df_previous = read_intermediate(relative_file)
+            df_refreshed = df_previous.iloc[:0]
+            if len(df_changed) > 0:
+                df_refreshed = generate_relative_poverty(df_changed, relative_poverty_lines, ppp,
+                                                         max_workers=max_workers, client=client, method=method,
+                                                         validation_sample=validation_sample)
+            df_relative = carry_forward(df_previous, df_refreshed, df, COUNTRY_ID_COLUMNS)
+        write_intermediate(df_relative, relative_file)
+
+        # Keep the data the relative poverty values were generated from, to refresh them incrementally for a new PIP
+        # version. Rows whose queries failed are left out, so that they are queried again next time.
+        failed = df_relative[[f'headcount_ratio_{pct}_median' for pct in relative_poverty_lines]].isnull().any(axis=1) & \
+            df_relative[[f'median_{pct}' for pct in relative_poverty_lines]].notnull().all(axis=1)
+        failed_keys = pd.MultiIndex.from_frame(df_relative.loc[failed, COUNTRY_ID_COLUMNS])
+        write_intermediate(df[~pd.MultiIndex.from_frame(df[COUNTRY_ID_COLUMNS]).isin(failed_keys)], snapshot_file)
         
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -378,7 +428,7 @@ def integrate_relative_poverty(df_final, df_country, answer, ppp):
     
     print('Integrating relative poverty data...')
     start_time = time.time()
-    df_relative = pd.read_csv(TEMP_DIR / f'ppp_{ppp}/raw/relative_poverty.csv')
+    df_relative = read_intermediate(relative_file)
 
     df_final = pd.merge(df_final, df_relative, 
                         how='left', on=['Entity', 'Year', 'reporting_level', 'welfare_type'])
@@ -395,121 +445,163 @@ def integrate_relative_poverty(df_final, df_country, answer, ppp):
     return df_final, col_relative
 
 
-def generate_relative_poverty(df, relative_poverty_lines, ppp):
-
-    # Initialise list to fill with headcount (ratio) data for 40%, 50% and 60% of the median
-    headcount_40_list = []
-    headcount_50_list = []
-    headcount_60_list = []
+# Measures of relative poverty (as named in the responses of the PIP API), and the name of their columns
+RELATIVE_MEASURES = {
+    'headcount': 'headcount_ratio',
+    'poverty_gap': 'poverty_gap_index',
+    'poverty_severity': 'poverty_severity',
+    'watts': 'watts',
+}
 
-    pgi_40_list = []
-    pgi_50_list = []
-    pgi_60_list = []
 
-    pov_severity_40_list = []
-    pov_severity_50_list = []
-    pov_severity_60_list = []
+# Query the measures of relative poverty of each row of df at each relative poverty line (the share of its median in
+# the columns median_<pct>) to the PIP API. Returns the values in a (rows, relative lines, measures) array, and the
+# failed queries as (row, relative line, error) tuples
+def query_relative_poverty_values(df, relative_poverty_lines, ppp, max_workers=DEFAULT_MAX_WORKERS, client=None):
 
-    watts_40_list = []
-    watts_50_list = []
-    watts_60_list = []
+    # Query one relative poverty line for one row of the dataset, returning the values of the measures (or the error)
+    def query_relative_line(task):
+        i, pct = task
+        if pct == relative_poverty_lines[0]:
+            print(f'Generating relative poverty values for {df.country_code[i]} ({df.Year[i]})...')
 
-    # For each row of the dataset
-    for i in range(len(df)):
-        
-        print(f'Generating relative poverty values for {df.country_code[i]} ({df.Year[i]})...')
-
-        # Run 3 queries, one for each relative poverty line, to get the headcount (ratio)
-        df_query_40 = pip_query_country(popshare_or_povline = "povline",
-                                        country_code = df['country_code'][i],
-                                        year = df['Year'][i],
-                                        welfare_type = df['welfare_type'][i],
-                                        reporting_level = df['reporting_level'][i],
-                                        value = df['median_40'][i],
-                                        fill_gaps="false",
-                                        ppp_version=ppp)
-
-        df_query_50 = pip_query_country(popshare_or_povline = "povline",
-                                        country_code = df['country_code'][i],
-                                        year = df['Year'][i],
-                                        welfare_type = df['welfare_type'][i],
-                                        reporting_level = df['reporting_level'][i],
-                                        value = df['median_50'][i],
-                                        fill_gaps="false",
-                                        ppp_version=ppp)
-
-        df_query_60 = pip_query_country(popshare_or_povline = "povline",
-                                        country_code = df['country_code'][i],
-                                        year = df['Year'][i],
-                                        welfare_type = df['welfare_type'][i],
-                                        reporting_level = df['reporting_level'][i],
-                                        value = df['median_60'][i],
-                                        fill_gaps="false",
-                                        ppp_version=ppp)
-
-        # If there is no error, get the headcount value and append it to a list
         try:
-            headcount_40_value = df_query_40['headcount'][0]
-            headcount_40_list.append(headcount_40_value)
-            pgi_40_value = df_query_40['poverty_gap'][0]
-            pgi_40_list.append(pgi_40_value)
-            pov_severity_40_value = df_query_40['poverty_severity'][0]
-            pov_severity_40_list.append(pov_severity_40_value)
-            watts_40_value = df_query_40['watts'][0]
-            watts_40_list.append(watts_40_value)
-
-            headcount_50_value = df_query_50['headcount'][0]
-            headcount_50_list.append(headcount_50_value)
-            pgi_50_value = df_query_50['poverty_gap'][0]
-            pgi_50_list.append(pgi_50_value)
-            pov_severity_50_value = df_query_50['poverty_severity'][0]
-            pov_severity_50_list.append(pov_severity_50_value)
-            watts_50_value = df_query_50['watts'][0]
-            watts_50_list.append(watts_50_value)
-
-            headcount_60_value = df_query_60['headcount'][0]
-            headcount_60_list.append(headcount_60_value)
-            pgi_60_value = df_query_60['poverty_gap'][0]
-            pgi_60_list.append(pgi_60_value)
-            pov_severity_60_value = df_query_60['poverty_severity'][0]
-            pov_severity_60_list.append(pov_severity_60_value)
-            watts_60_value = df_query_60['watts'][0]
-            watts_60_list.append(watts_60_value)
-
-        # If there is an error, append a null value to the list
-        except:
-            headcount_40_list.append(np.nan)
-            pgi_40_list.append(np.nan)
-            pov_severity_40_list.append(np.nan)
-            watts_40_list.append(np.nan)
-
-            headcount_50_list.append(np.nan)
-            pgi_50_list.append(np.nan)
-            pov_severity_50_list.append(np.nan)
-            watts_50_list.append(np.nan)
-
-            headcount_60_list.append(np.nan)
-            pgi_60_list.append(np.nan)
-            pov_severity_60_list.append(np.nan)
-            watts_60_list.append(np.nan)
-
-
-    # The lists converted into new columns
-    df['headcount_ratio_40_median'] = headcount_40_list
-    df['headcount_ratio_50_median'] = headcount_50_list
-    df['headcount_ratio_60_median'] = headcount_60_list
-
-    df['poverty_gap_index_40_median'] = pgi_40_list
-    df['poverty_gap_index_50_median'] = pgi_50_list
-    df['poverty_gap_index_60_median'] = pgi_60_list
-
-    df['poverty_severity_40_median'] = pov_severity_40_list
-    df['poverty_severity_50_median'] = pov_severity_50_list
-    df['poverty_severity_60_median'] = pov_severity_60_list
-
-    df['watts_40_median'] = watts_40_list
-    df['watts_50_median'] = watts_50_list
-    df['watts_60_median'] = watts_60_list
+            df_query = pip_query_country(popshare_or_povline = "povline",
+                                         country_code = df['country_code'][i],
+                                         year = df['Year'][i],
+                                         welfare_type = df['welfare_type'][i],
+                                         reporting_level = df['reporting_level'][i],
+                                         value = df[f'median_{pct}'][i],
+                                         fill_gaps="false",
+                                         ppp_version=ppp,
+                                         client=client)
+            values = [df_query[measure][0] for measure in RELATIVE_MEASURES]
+        except Exception as error:
+            return None, f'{type(error).__name__}: {error}'
+
+        return values, None
+
+    # Run the queries for all the rows and relative poverty lines (40%, 50% and 60% of the median) as one batch
+    tasks = [(i, pct) for i in range(len(df)) for pct in relative_poverty_lines]
+    results, _ = fetch_concurrently(query_relative_line, tasks, max_workers=max_workers)
+
+    # Collect the values in a (rows, relative lines, measures) array, keeping a record of the failed queries
+    values = np.full((len(df), len(relative_poverty_lines), len(RELATIVE_MEASURES)), np.nan)
+    failures = []
+    for (i, pct), (task_values, error) in zip(tasks, results):
+        if error is None:
+            values[i, relative_poverty_lines.index(pct)] = task_values
+        else:
+            failures.append((i, pct, error))
+
+    return values, failures
+
+
+# Compute the measures of relative poverty of each row of df from the headcount curves of the full-distribution grid of
+# countries (fetched by thresholds), instead of querying them to the PIP API (see scripts/curves.py). Returns the same
+# as query_relative_poverty_values
+def local_relative_poverty_values(df, relative_poverty_lines, ppp):
+    id_cols = ['Entity', 'Year', 'reporting_level', 'welfare_type']
+    grid_problem = full_dist_grid_problem(ppp)
+    if grid_problem is not None:
+        raise ValueError(f'Relative poverty is computed locally from the full-distribution grid, but {grid_problem}. '
+                         f'Download it again, with -d (not incremental) and the grid percentile method, or use '
+                         f'--relative_method api.')
+
+    entities, povlines, curves = headcount_curves(read_full_dist_grid(ppp), id_cols)
+
+    # Curve of each row (missing for the rows that are not in the grid)
+    curve_rows = pd.merge(df[id_cols].astype(object),
+                          entities.astype(object).assign(curve=np.arange(len(entities))),
+                          how='left', on=id_cols, validate='many_to_one')['curve'].to_numpy(dtype=float)
+    in_grid = ~np.isnan(curve_rows)
+
+    # All rows and relative poverty lines are computed as one batch
+    lines = df[[f'median_{pct}' for pct in relative_poverty_lines]].to_numpy(dtype=float)
+    measures = poverty_measures(povlines, curves, np.where(in_grid, curve_rows, 0).astype(int)[:, np.newaxis], lines,
+                                measures=list(RELATIVE_MEASURES))
+    values = np.stack([measures[measure] for measure in RELATIVE_MEASURES], axis=2)
+    values[~in_grid] = np.nan
+
+    failures = []
+    for i, j in zip(*np.nonzero(np.isnan(values).any(axis=2))):
+        if in_grid[i]:
+            error = f'No headcount curve in the full-distribution grid up to the poverty line {lines[i, j]}'
+        else:
+            error = 'Not in the full-distribution grid'
+        failures.append((i, relative_poverty_lines[j], error))
+
+    return values, failures
+
+
+# Compare the relative poverty values computed locally with the ones of the PIP API for a random sample of (at most
+# sample_size) rows. The comparison is written to relative_poverty_validation.csv, and the largest and mean absolute
+# error of each measure (in percentage points) are printed
+def validate_relative_poverty(df, values, relative_poverty_lines, ppp, sample_size, max_workers=DEFAULT_MAX_WORKERS,
+                              client=None, seed=0):
+    complete_rows = np.flatnonzero(~np.isnan(values).any(axis=(1, 2)))
+    sample = np.sort(np.random.default_rng(seed).choice(complete_rows, size=min(sample_size, len(complete_rows)),
+                                                        replace=False))
+    api_values, _ = query_relative_poverty_values(df.iloc[sample].reset_index(drop=True), relative_poverty_lines, ppp,
+                                                  max_workers=max_workers, client=client)
+
+    # One row per sampled row, relative poverty line and measure
+    n_values = len(relative_poverty_lines) * len(RELATIVE_MEASURES)
+    df_validation = pd.DataFrame({column: np.repeat(df[column].to_numpy()[sample], n_values)
+                                  for column in ['Entity', 'Year', 'reporting_level', 'welfare_type']})
+    df_validation['relative_poverty_line'] = np.tile(np.repeat(relative_poverty_lines, len(RELATIVE_MEASURES)),
+                                                     len(sample))
+    df_validation['measure'] = np.tile(list(RELATIVE_MEASURES), len(sample) * len(relative_poverty_lines))
+    df_validation['local'] = values[sample].ravel()
+    df_validation['api'] = api_values.ravel()
+    df_validation['error'] = df_validation['local'] - df_validation['api']
+    df_validation.to_csv(TEMP_DIR / f'ppp_{ppp}/raw/relative_poverty_validation.csv', index=False)
+
+    df_errors = (df_validation['error'].abs() * 100).groupby(df_validation['measure'], sort=False).agg(['max', 'mean'])
+    print(f'Absolute error of the relative poverty values computed locally, against the PIP API for {len(sample)} rows '
+          f'(percentage points):')
+    print(df_errors.to_string())
+
+    return df_validation
+
+
+# With method="local", the measures are computed from the full-distribution grid instead of querying the PIP API, and
+# (if validation_sample is not 0) compared with the ones of the API for a sample of rows
+def generate_relative_poverty(df, relative_poverty_lines, ppp, max_workers=DEFAULT_MAX_WORKERS, client=None,
+                              method="api", validation_sample=DEFAULT_RELATIVE_VALIDATION_SAMPLE):
+
+    df = df.reset_index(drop=True)
+
+    if method == "local":
+        start_time = time.time()
+        values, failures = local_relative_poverty_values(df, relative_poverty_lines, ppp)
+        print(f'Relative poverty values computed locally for {len(df)} rows in {time.time() - start_time} seconds.')
+        if validation_sample > 0:
+            validate_relative_poverty(df, values, relative_poverty_lines, ppp, validation_sample,
+                                      max_workers=max_workers, client=client)
+    else:
+        values, failures = query_relative_poverty_values(df, relative_poverty_lines, ppp, max_workers=max_workers,
+                                                         client=client)
+
+    # If any of the queries of a row failed, all its relative poverty values are set to null
+    failed_rows = sorted(set(i for i, _, _ in failures))
+    values[failed_rows] = np.nan
+
+    df_failures = pd.DataFrame([{'Entity': df['Entity'][i], 'Year': df['Year'][i],
+                                 'reporting_level': df['reporting_level'][i], 'welfare_type': df['welfare_type'][i],
+                                 'relative_poverty_line': pct, 'error': error} for i, pct, error in failures],
+                               columns=['Entity', 'Year', 'reporting_level', 'welfare_type',
+                                        'relative_poverty_line', 'error'])
+    df_failures.to_csv(TEMP_DIR / f'ppp_{ppp}/raw/relative_poverty_failures.csv', index=False)
+    if len(failed_rows) > 0:
+        print(f'Relative poverty queries failed for {len(failed_rows)} rows (set to null). '
+              f'See relative_poverty_failures.csv for details.')
+
+    # The values converted into new columns
+    df_values = pd.DataFrame({f'{column}_{pct}_median': values[:, j, k]
+                              for k, column in enumerate(RELATIVE_MEASURES.values())
+                              for j, pct in enumerate(relative_poverty_lines)})
+    df = pd.concat([df, df_values], axis=1)
 
     for pct in relative_poverty_lines:
         df[f'headcount_{pct}_median'] = df[f'headcount_ratio_{pct}_median'] * df['reporting_pop']
@@ -524,55 +616,12 @@ def generate_relative_poverty(df, relative_poverty_lines, ppp):
     #Calculate numbers in poverty between pov lines for stacked area charts
     #Make sure the poverty lines are in order, lowest to highest
     relative_poverty_lines.sort()
+    col_stacked_n, col_stacked_pct = stacked_band_names(relative_poverty_lines, suffix='_median')
+    stacked_n, stacked_pct = stacked_bands(df[[f'headcount_{pct}_median' for pct in relative_poverty_lines]].to_numpy(),
+                                           df['reporting_pop'].to_numpy())
+    df = pd.concat([df, pd.DataFrame(stacked_n, columns=col_stacked_n),
+                    pd.DataFrame(stacked_pct, columns=col_stacked_pct)], axis=1)
 
-    col_stacked_n = []
-    col_stacked_pct = []
-
-    #For each poverty line in relative_poverty_lines
-    for i in range(len(relative_poverty_lines)):
-        #if it's the first value only get people below this poverty line (and percentage)
-        if i == 0:
-            varname_n = f'headcount_stacked_below_{relative_poverty_lines[i]}_median'
-            df[varname_n] = df[f'headcount_{relative_poverty_lines[i]}_median']
-            col_stacked_n.append(varname_n)
-
-            varname_pct = f'headcount_ratio_stacked_below_{relative_poverty_lines[i]}_median'
-            df[varname_pct] = df[varname_n] / df['reporting_pop']
-            col_stacked_pct.append(varname_pct)
-
-        #If it's the last value calculate the people between this value and the previous 
-        #and also the people over this poverty line (and percentages)
-        elif i == len(relative_poverty_lines)-1:
-
-            varname_n = f'headcount_stacked_below_{relative_poverty_lines[i]}_median'
-            df[varname_n] = df[f'headcount_{relative_poverty_lines[i]}_median'] - df[f'headcount_{relative_poverty_lines[i-1]}_median']
-            col_stacked_n.append(varname_n)
-
-            varname_pct = f'headcount_ratio_stacked_below_{relative_poverty_lines[i]}_median'
-            df[varname_pct] = df[varname_n] / df['reporting_pop']
-            col_stacked_pct.append(varname_pct)
-
-            varname_n = f'headcount_stacked_above_{relative_poverty_lines[i]}_median'
-            df[varname_n] = df['reporting_pop'] - df[f'headcount_{relative_poverty_lines[i]}_median']
-            col_stacked_n.append(varname_n)
-
-            varname_pct = f'headcount_ratio_stacked_above_{relative_poverty_lines[i]}_median'
-            df[varname_pct] = df[varname_n] / df['reporting_pop']
-            col_stacked_pct.append(varname_pct)
-
-        #If it's any value between the first and the last calculate the people between this value and the previous (and percentage)
-        else:
-            varname_n = f'headcount_stacked_below_{relative_poverty_lines[i]}_median'
-            df[varname_n] = df[f'headcount_{relative_poverty_lines[i]}_median'] - df[f'headcount_{relative_poverty_lines[i-1]}_median']
-            col_stacked_n.append(varname_n)
-
-            varname_pct = f'headcount_ratio_stacked_below_{relative_poverty_lines[i]}_median'
-            df[varname_pct] = df[varname_n] / df['reporting_pop']
-            col_stacked_pct.append(varname_pct)
-
-    df.loc[:, col_stacked_pct] = df[col_stacked_pct] * 100
-    
-    
     col_povlines = []
     col_headcount = []
     col_headcount_ratio = []
@@ -595,47 +644,140 @@ def generate_relative_poverty(df, relative_poverty_lines, ppp):
         col_income_gap_ratio.append(f'income_gap_ratio_{pct}_median')
 
     df = df[['Entity', 'Year', 'reporting_level', 'welfare_type'] + col_povlines + col_headcount + col_headcount_ratio + col_pgi + col_total_shortfall + col_avg_shortfall + col_income_gap_ratio + col_severity + col_watts + col_stacked_n + col_stacked_pct]
-    df.to_csv(TEMP_DIR / f'ppp_{ppp}/raw/relative_poverty.csv', index=False)
+
+    return df
+
+
+# Groups of the full-distribution grid of countries (fetched by thresholds) that are missing in the temporary folder
+def missing_full_dist_groups(ppp):
+    full_dist_dir = TEMP_DIR / f'ppp_{ppp}/full_dist'
+    return [key for key in percentile_povline_list_dict() if not intermediate_exists(full_dist_dir / key)]
+
+
+# Why the full-distribution grid of countries cannot be used for the current PIP version (None if it can): some of its
+# groups are missing, or it was fetched for another PIP version (e.g. an incremental run never fetches it again)
+def full_dist_grid_problem(ppp):
+    missing_groups = missing_full_dist_groups(ppp)
+    if len(missing_groups) > 0:
+        return f'the grid is missing in {TEMP_DIR / f"ppp_{ppp}/full_dist"} ({", ".join(missing_groups)})'
+    grid_version = fetched_version(TEMP_DIR / f'ppp_{ppp}/full_dist')
+    if grid_version != PIP_VERSION[ppp]:
+        return (f'the grid in {TEMP_DIR / f"ppp_{ppp}/full_dist"} was fetched for PIP version '
+                f'{grid_version or "unknown"}, not {PIP_VERSION[ppp]}')
+    return None
 
 
-def thresholds(df_final, answer, ppp):
+# Headcount ratio of each country-year at each poverty line of the full-distribution grid (in dollars)
+def read_full_dist_grid(ppp):
+    full_dist_dir = TEMP_DIR / f'ppp_{ppp}/full_dist'
+    columns = ['Entity', 'Year', 'reporting_level', 'welfare_type', 'poverty_line', 'headcount']
+    dfs = [read_intermediate(full_dist_dir / key, columns=columns) for key in percentile_povline_list_dict()]
+    return pd.concat(dfs, ignore_index=True)
+
+
+# Write the full-distribution grid of countries to a memory-mapped store, to query headcounts at any poverty line
+# without the PIP API (see scripts/distribution_store.py). The store is only written again for a new grid or PIP
+# version, and nothing is written if the grid was never downloaded or was fetched for another PIP version
+def build_distribution_store(ppp):
+    grid_problem = full_dist_grid_problem(ppp)
+    if grid_problem is not None:
+        print(f'The distribution store is not built: {grid_problem}. Download it again, with -d (not incremental) and '
+              f'the grid percentile method.')
+        return
+
+    start_time = time.time()
+    # Stamped with the version the grid was fetched with (the same as PIP_VERSION, as checked above)
+    grid_version = fetched_version(TEMP_DIR / f'ppp_{ppp}/full_dist')
+    store_dir = write_distribution_store(read_full_dist_grid(ppp), distribution_store_dir(ppp), grid_version, ppp)
+    print(f'Distribution store written to {store_dir} in {time.time() - start_time} seconds.')
+
+
+# Grid of poverty lines (in cents) queried to find the percentiles of all entities, grouped in sets of lines.
+def percentile_povline_list_dict():
+    # Define list of poverty lines to query (max 500 requests per category)
+
+    under_5_dollars = list(range(1,500, 1))
+    between_5_and_10_dollars = list(range(500,1000, 1))
+    between_10_and_20_dollars = list(range(1000,2000, 2))
+    between_20_and_30_dollars = list(range(2000,3000, 2))
+    between_30_and_55_dollars = list(range(3000,5500, 5))
+    between_55_and_80_dollars = list(range(5500,8000, 5))
+    between_80_and_100_dollars = list(range(8000,10000, 5))
+    between_100_and_150_dollars = list(range(10000,15000, 10))
+    between_150_and_175_dollars = list(range(15000,17500, 10))
+
+    #Define dictionary to iterate with
+    povline_list_dict = {
+        'under_5_dollars': under_5_dollars, 
+        'between_5_and_10_dollars': between_5_and_10_dollars,
+        'between_10_and_20_dollars': between_10_and_20_dollars,
+        'between_20_and_30_dollars': between_20_and_30_dollars,
+        'between_30_and_55_dollars': between_30_and_55_dollars,
+        'between_55_and_80_dollars': between_55_and_80_dollars,
+        'between_80_and_100_dollars': between_80_and_100_dollars,
+        'between_100_and_150_dollars': between_100_and_150_dollars,
+        'between_150_and_175_dollars': between_150_and_175_dollars
+                       }
+
+    return povline_list_dict
+
+
+# With incremental=True, percentiles are only extracted again for the country-years of df_country that changed since
+# the previous extraction (searching them for each country-year, as a grid query returns all countries at once), and
+# the percentiles of all other country-years are carried forward. Regional percentiles are all extracted again from the
+# grid if any row of df_region changed.
+def thresholds(df_final, answer, ppp, df_country=None, df_region=None, max_workers=DEFAULT_MAX_WORKERS, resume=False,
+               method="grid", tolerance=DEFAULT_HEADCOUNT_TOLERANCE, client=None, incremental=False):
     #Decile thresholds
 
     if answer:
-        print("Generating percentile values... (takes about 1.5 DAYS)")
         start_time = time.time()
-        # Define list of poverty lines to query (max 500 requests per category)
-
-        under_5_dollars = list(range(1,500, 1))
-        between_5_and_10_dollars = list(range(500,1000, 1))
-        between_10_and_20_dollars = list(range(1000,2000, 2))
-        between_20_and_30_dollars = list(range(2000,3000, 2))
-        between_30_and_55_dollars = list(range(3000,5500, 5))
-        between_55_and_80_dollars = list(range(5500,8000, 5))
-        between_80_and_100_dollars = list(range(8000,10000, 5))
-        between_100_and_150_dollars = list(range(10000,15000, 10))
-        between_150_and_175_dollars = list(range(15000,17500, 10))
-
-        #Define dictionary to iterate with
-        povline_list_dict = {
-            'under_5_dollars': under_5_dollars, 
-            'between_5_and_10_dollars': between_5_and_10_dollars,
-            'between_10_and_20_dollars': between_10_and_20_dollars,
-            'between_20_and_30_dollars': between_20_and_30_dollars,
-            'between_30_and_55_dollars': between_30_and_55_dollars,
-            'between_55_and_80_dollars': between_55_and_80_dollars,
-            'between_80_and_100_dollars': between_80_and_100_dollars,
-            'between_100_and_150_dollars': between_100_and_150_dollars,
-            'between_150_and_175_dollars': between_150_and_175_dollars
-                           }
-        
-        df_closest_complete = generate_percentiles_countries(povline_list_dict, ppp)
-        df_closest_complete_regions = generate_percentiles_regions(povline_list_dict, ppp)
+        povline_list_dict = percentile_povline_list_dict()
+        countries_file = TEMP_DIR / f'ppp_{ppp}/full_dist/percentiles_countries'
+        regions_file = TEMP_DIR / f'ppp_{ppp}/full_dist_regions/percentiles_regions'
+        countries_snapshot_file = TEMP_DIR / f'ppp_{ppp}/raw/percentiles_base_countries'
+        regions_snapshot_file = TEMP_DIR / f'ppp_{ppp}/raw/percentiles_base_regions'
+
+        df_changed = df_regions_changed = None
+        if incremental:
+            df_changed = changed_since_snapshot(df_country, countries_snapshot_file, [countries_file],
+                                                COUNTRY_ID_COLUMNS, 'country percentiles')
+            df_regions_changed = changed_since_snapshot(df_region, regions_snapshot_file, [regions_file],
+                                                        REGION_ID_COLUMNS, 'regional percentiles')
+
+        if df_changed is not None:
+            df_previous = read_intermediate(countries_file)
+            df_refreshed = df_previous.iloc[:0]
+            if len(df_changed) > 0:
+                df_refreshed = search_percentiles_countries(ppp, tolerance=tolerance,
+                                                            entities=df_changed[COUNTRY_ID_COLUMNS + ['country_code']],
+                                                            max_workers=max_workers, client=client, resume=resume)
+            df_closest_complete = carry_forward(df_previous, df_refreshed, df_country, COUNTRY_ID_COLUMNS)
+            write_intermediate(df_closest_complete, countries_file)
+        elif method == "search":
+            print("Searching percentile values for each country (regions are extracted from the grid)...")
+            df_closest_complete = search_percentiles_countries(ppp, tolerance=tolerance, max_workers=max_workers,
+                                                               client=client, resume=resume)
+        else:
+            print("Generating percentile values... (takes about 1.5 DAYS)")
+            df_closest_complete = generate_percentiles_countries(povline_list_dict, ppp, max_workers=max_workers,
+                                                                 resume=resume, client=client)
+        if (df_regions_changed is not None) and (len(df_regions_changed) == 0):
+            df_closest_complete_regions = read_intermediate(regions_file)
+        else:
+            df_closest_complete_regions = generate_percentiles_regions(povline_list_dict, ppp, max_workers=max_workers,
+                                                                       resume=resume, client=client)
         df_percentiles = pd.concat([df_closest_complete, df_closest_complete_regions], ignore_index=True)
         df_percentiles = df_percentiles.rename(columns={'poverty_line': 'percentile_value'})
         
         #Export concatenation
-        df_percentiles.to_csv(TEMP_DIR / f'ppp_{ppp}/raw/percentiles.csv', index=False)
+        write_intermediate(df_percentiles, TEMP_DIR / f'ppp_{ppp}/raw/percentiles')
+
+        # Keep the data the percentiles were extracted from, to refresh them incrementally for a new PIP version
+        if df_country is not None:
+            write_intermediate(df_country, countries_snapshot_file)
+        if df_region is not None:
+            write_intermediate(df_region, regions_snapshot_file)
         #To use it in PIP issues
         # df_percentiles.to_csv(f'notebooks/percentiles_ppp_{ppp}.csv', index=False)
 
@@ -645,7 +787,7 @@ def thresholds(df_final, answer, ppp):
 
     print('Integrating decile thresholds...')
     start_time = time.time()
-    df_percentiles = pd.read_csv(TEMP_DIR / f'ppp_{ppp}/raw/percentiles.csv')
+    df_percentiles = read_intermediate(TEMP_DIR / f'ppp_{ppp}/raw/percentiles')
     deciles = []
 
     for i in range(10,100,10):
@@ -672,245 +814,288 @@ def thresholds(df_final, answer, ppp):
     return df_final
 
 
-def generate_percentiles_countries(povline_list_dict, ppp):
+# Fetch the data of every poverty line in povline_list_dict, and write each group of lines to an intermediate file in
+# output_dir. Each line is checkpointed as soon as it is fetched, so that an interrupted extraction can be resumed
+# (resume=True) fetching only the lines that are missing. On SIGINT/SIGTERM, requests in progress are finished and
+# saved before exiting. The checkpoint of each group is deleted once the file of the group is written, and the whole
+# checkpoint at the end. The PIP version of the data is then recorded in output_dir (see fetched_version), so that it
+# is never used for another PIP version
+def fetch_povline_groups(fetch_function, povline_list_dict, output_dir, ppp, query_durations,
+                         max_workers=DEFAULT_MAX_WORKERS, resume=False, file_suffix=''):
 
-    start_time_overall = time.time()
-    query_durations = {"povline":[],"duration":[]}
+    # Until all groups are written again, the files in output_dir are of no single version
+    version_file = output_dir / 'version.json'
+    if version_file.exists():
+        version_file.unlink()
+
+    checkpoint = PovlineCheckpoint(output_dir / 'checkpoint', version=PIP_VERSION[ppp], resume=resume)
+    if resume:
+        print(f'Resuming extraction: {len(checkpoint.completed)} poverty lines were already fetched.')
+
+    with GracefulInterruption() as interruption:
+
+        def fetch_and_save(povline):
+            # Once interrupted, do not start new requests
+            if interruption.interrupted.is_set():
+                return None
+            df = fetch_function(povline)
+            checkpoint.save(povline, df)
+            return df
+
+        for key in povline_list_dict:
+
+            # Groups written to their file by a previous run
+            group_file = output_dir / f'{key}{file_suffix}'
+            if (key in checkpoint.merged) and intermediate_exists(group_file):
+                continue
 
-    for key in povline_list_dict:
+            # Query the missing poverty lines of the group concurrently (results are kept in the order of the list)
+            povlines_missing = checkpoint.missing(povline_list_dict[key])
+            dfs, durations = fetch_concurrently(fetch_and_save, povlines_missing, max_workers=max_workers)
+            interruption.exit_if_interrupted()
 
-        df_complete = pd.DataFrame()
+            query_durations["povline"].extend([povline/100 for povline in povlines_missing])
+            query_durations["duration"].extend(durations)
 
-        for povline in povline_list_dict[key]:
+            # Combine the lines just fetched with the ones fetched by a previous run
+            dfs_fetched = dict(zip(povlines_missing, dfs))
+            dfs = [dfs_fetched[povline] if povline in dfs_fetched else checkpoint.load(povline)
+                   for povline in povline_list_dict[key]]
+            df_complete = compact_dtypes(pd.concat(dfs, ignore_index=True))
 
-            start_time = time.time()
+            #Write the complete data to an intermediate file (see scripts/storage.py)
+            write_intermediate(df_complete, group_file)
+            checkpoint.mark_merged(key, povline_list_dict[key])
 
-            povline_dollars = povline/100
-            print(f'Fetching country headcounts for: ${povline_dollars} a day')
+    checkpoint.clear()
+    version_file.write_text(json.dumps({'version': PIP_VERSION[ppp]}))
 
-            df = country_data(povline, filled="false", ppp=ppp, additional_dfs=False)
-            df_complete = pd.concat([df_complete, df],ignore_index=True)
 
-            end_time = time.time()
-            query_durations["povline"].append(povline_dollars)
-            query_durations["duration"].append(end_time - start_time)
+# PIP version of the data fetched to output_dir by fetch_povline_groups (None if its extraction did not finish, or if it
+# was fetched before versions were recorded)
+def fetched_version(output_dir):
+    version_file = output_dir / 'version.json'
+    if not version_file.is_file():
+        return None
+    return json.loads(version_file.read_text())['version']
 
 
-        #Write the complete data to csv
-        df_complete.to_csv(TEMP_DIR / f'ppp_{ppp}/full_dist/{key}.csv', index=False)
+def generate_percentiles_countries(povline_list_dict, ppp, max_workers=DEFAULT_MAX_WORKERS, resume=False, client=None):
+
+    start_time_overall = time.time()
+    query_durations = {"povline":[],"duration":[]}
+
+    def fetch_country_headcounts(povline):
+        povline_dollars = povline/100
+        print(f'Fetching country headcounts for: ${povline_dollars} a day')
+
+        return country_data(povline, filled="false", ppp=ppp, additional_dfs=False, client=client)
+
+    fetch_povline_groups(fetch_country_headcounts, povline_list_dict, TEMP_DIR / f'ppp_{ppp}/full_dist', ppp,
+                         query_durations, max_workers=max_workers, resume=resume)
 
     end_time_overall = time.time()
     elapsed_time_overall = end_time_overall - start_time_overall
     print(f'Execution time: {elapsed_time_overall/3600} hours')
 
-    # Take a look at how long each query took
-    df_query_durations = pd.DataFrame.from_dict(query_durations)
-    fig = px.line(df_query_durations, x="povline", y="duration", title=f'Execution time for poverty line queries')
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/time_plot.svg')
-    
-    df_complete = pd.DataFrame()
-    for key in povline_list_dict:
-        df = pd.read_csv(TEMP_DIR / f'ppp_{ppp}/full_dist/{key}.csv')
-        df_complete = pd.concat([df_complete, df], ignore_index=True)
+    dfs = [read_intermediate(TEMP_DIR / f'ppp_{ppp}/full_dist/{key}') for key in povline_list_dict]
+    df_complete = compact_dtypes(pd.concat(dfs, ignore_index=True))
 
     # Find closest to percentiles
     print("Find closest to percentiles after the extraction")
     start_time = time.time()
 
     percentiles = range(1, 100, 1)
-    df_closest_complete = pd.DataFrame()
-
-    for p in percentiles:
-        df_complete['distance_to_p'] = abs(df_complete['headcount']-p/100)
-        df_closest = df_complete.sort_values("distance_to_p").groupby(['Entity', 'Year','reporting_level','welfare_type'], as_index=False).first()
-        df_closest['target_percentile'] = f'P{p}'
-        df_closest = df_closest[['Entity', 'Year','reporting_level','welfare_type', 'target_percentile', 'poverty_line', 'headcount', 'distance_to_p']]
-        df_closest_complete = pd.concat([df_closest_complete, df_closest],ignore_index=True)
+    df_closest_complete = find_closest_percentiles(df_complete, ['Entity', 'Year', 'reporting_level', 'welfare_type'],
+                                                   percentiles=percentiles)
 
     end_time = time.time()
     print(f'Execution time: {(end_time - start_time)/60} minutes')
 
-    #Charts to check results
-    fig = px.scatter(df_closest_complete, x="target_percentile", y="distance_to_p", color="Entity",
-                     hover_data=['poverty_line', 'headcount', 'Year'], opacity=0.5,
-                     title="<b>Target p vs. Distance to p</b><br>Percentiles",
-                     log_y=False,
-                     height=600)
-    fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/target_p_vs_distance_percentiles.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/target_p_vs_distance_percentiles.html')
-
-    fig = px.scatter(df_closest_complete, x="poverty_line", y="distance_to_p", color="Entity",
-                     hover_data=['poverty_line', 'headcount', 'Year', 'target_percentile'], opacity=0.5,
-                     title="<b>Poverty line vs. Distance to p</b><br>Percentiles",
-                     log_y=False,
-                     height=600)
-    fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/povline_vs_distance_percentiles.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/povline_vs_distance_percentiles.html')
-
-    fig = px.histogram(df_closest_complete, x="distance_to_p", histnorm="percent", marginal="box")
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/distance_percentiles_histogram.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/distance_percentiles_histogram.html')
-
-    deciles = []
-
-    for i in range(10,100,10):
-        deciles.append(f'P{i}')
+    #Charts to check results (rendered off the critical path, see scripts/diagnostics.py)
+    save_percentile_diagnostics(pd.DataFrame.from_dict(query_durations), df_closest_complete,
+                                *diagnostics_dirs(ppp), scope="countries")
 
-    df_closest_deciles = df_closest_complete[df_closest_complete['target_percentile'].isin(deciles)].copy().reset_index(drop=True)
-
-    fig = px.scatter(df_closest_deciles, x="target_percentile", y="distance_to_p", color="Entity",
-                     hover_data=['poverty_line', 'headcount', 'Year'], opacity=0.5,
-                     title="<b>Target p vs. Distance to p</b><br>Deciles",
-                     log_y=False,
-                     height=600)
-    fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/target_p_vs_distance_deciles.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/target_p_vs_distance_deciles.html')
-
-    fig = px.scatter(df_closest_deciles, x="poverty_line", y="distance_to_p", color="Entity",
-                     hover_data=['poverty_line', 'headcount', 'Year', 'target_percentile'], opacity=0.5,
-                     title="<b>Poverty line vs. Distance to p</b><br>Deciles",
-                     log_y=False,
-                     height=600)
-    fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/povline_vs_distance_deciles.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/povline_vs_distance_deciles.html')
-
-    fig = px.histogram(df_closest_deciles, x="distance_to_p", histnorm="percent", marginal="box")
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/distance_deciles_histogram.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/distance_deciles_histogram.html')
-
-    df_closest_complete.to_csv(TEMP_DIR / f'ppp_{ppp}/full_dist/percentiles_countries.csv', index=False)
+    write_intermediate(df_closest_complete, TEMP_DIR / f'ppp_{ppp}/full_dist/percentiles_countries')
     
     return df_closest_complete
 
 
-def generate_percentiles_regions(povline_list_dict, ppp):
+# Find the percentiles of each country-year by searching, for each (country, year, reporting_level, welfare_type), the
+# poverty lines at which its headcount ratio is within tolerance of each percentile, instead of picking the closest
+# line of a fixed grid. A coarse grid fetched for all countries at once brackets the percentiles, and each country-year
+# is then refined with its own queries. This takes more requests than the grid (as grid requests return all countries
+# at once), but gives more accurate percentiles, and is much cheaper to run for a subset of country-years (entities).
+# The percentiles of each entity are checkpointed as soon as they are found, so that an interrupted search can be
+# resumed (resume=True) searching only the missing entities. If the queries of an entity fail, its percentiles are left
+# null and the failure is recorded in percentile_search_failures.csv, instead of stopping the whole search.
+def search_percentiles_countries(ppp, tolerance=DEFAULT_HEADCOUNT_TOLERANCE, entities=None,
+                                 max_workers=DEFAULT_MAX_WORKERS, client=None, resume=False):
 
-    start_time_overall = time.time()
-    query_durations_regions = {"povline":[],"duration":[]}
+    start_time = time.time()
+    id_cols = ['Entity', 'Year', 'reporting_level', 'welfare_type']
+
+    dfs_seed, _ = fetch_concurrently(lambda povline: country_data(povline, filled="false", ppp=ppp,
+                                                                  additional_dfs=False, client=client),
+                                     SEARCH_SEED_POVLINES_CENTS, max_workers=max_workers)
+    df_seed = pd.concat(dfs_seed, ignore_index=True)
+    search_all = entities is None
+    if search_all:
+        entities = df_seed[id_cols + ['country_code']].drop_duplicates(subset=id_cols)
+    entities = entities.sort_values(id_cols).reset_index(drop=True)
+    known_points = {key: dict(zip(df_group['poverty_line'], df_group['headcount']))
+                    for key, df_group in df_seed.groupby(id_cols, observed=True)}
 
-    for key in povline_list_dict:
+    percentiles = range(1, 100, 1)
 
-        df_complete_regions = pd.DataFrame()
+    # The checkpoint is only resumed for the same entities and tolerance (and PIP version)
+    search_key = hashlib.sha256((entities[id_cols].astype(str).to_csv(index=False) + str(tolerance)).encode())
+    checkpoint = PovlineCheckpoint(TEMP_DIR / f'ppp_{ppp}/full_dist/search_checkpoint',
+                                   version=f'{PIP_VERSION[ppp]}:{search_key.hexdigest()}', resume=resume)
+    if resume:
+        print(f'Resuming search: percentiles of {len(checkpoint.completed)} entities were already found.')
+
+    def search_entity(i):
+        entity = entities.loc[i]
+        print(f'Searching percentiles for {entity["country_code"]} ({entity["Year"]}, {entity["reporting_level"]}, '
+              f'{entity["welfare_type"]})...')
+
+        def evaluate(povline):
+            df_query = pip_query_country(popshare_or_povline="povline",
+                                         value=povline,
+                                         country_code=entity['country_code'],
+                                         year=entity['Year'],
+                                         welfare_type=entity['welfare_type'],
+                                         reporting_level=entity['reporting_level'],
+                                         fill_gaps="false",
+                                         ppp_version=ppp,
+                                         client=client)
+            if ('headcount' not in df_query) or (len(df_query) == 0):
+                raise ValueError(f'Empty response for the poverty line {povline}')
+            return df_query['headcount'][0]
+
+        key = tuple(entity[id_cols])
+        try:
+            result = search_percentile_thresholds(evaluate, [p/100 for p in percentiles],
+                                                  known_points=known_points.get(key), tolerance=tolerance)
+        except Exception as error:
+            return None, f'{type(error).__name__}: {error}'
+        checkpoint.save(i, pd.DataFrame(result, columns=['poverty_line', 'headcount']))
+
+        return result, None
+
+    with GracefulInterruption() as interruption:
+
+        def search_missing_entity(i):
+            # Once interrupted, do not start new searches
+            if interruption.interrupted.is_set():
+                return None, 'interrupted'
+            return search_entity(i)
+
+        entities_missing = checkpoint.missing(list(entities.index))
+        searched, _ = fetch_concurrently(search_missing_entity, entities_missing, max_workers=max_workers)
+        interruption.exit_if_interrupted()
+
+    # Combine the entities just searched with the ones searched by a previous run, leaving failed entities null
+    searched = dict(zip(entities_missing, searched))
+    failures = []
+    results = []
+    for i in entities.index:
+        if i not in searched:
+            results.append(list(checkpoint.load(i).itertuples(index=False, name=None)))
+            continue
+        result, error = searched[i]
+        if error is not None:
+            failures.append({**entities.loc[i, id_cols].to_dict(), 'error': error})
+            result = [(np.nan, np.nan)] * len(percentiles)
+        results.append(result)
+
+    df_failures = pd.DataFrame(failures, columns=id_cols + ['error'])
+    df_failures.to_csv(TEMP_DIR / f'ppp_{ppp}/raw/percentile_search_failures.csv', index=False)
+    if len(failures) > 0:
+        print(f'Percentile search failed for {len(failures)} entities (set to null). '
+              f'See percentile_search_failures.csv for details.')
+
+    # Same structure as the output of generate_percentiles_countries (all entities for P1, then for P2, etc.)
+    df_closest_complete = pd.DataFrame({
+        'Entity': np.tile(entities['Entity'], len(percentiles)),
+        'Year': np.tile(entities['Year'], len(percentiles)),
+        'reporting_level': np.tile(entities['reporting_level'], len(percentiles)),
+        'welfare_type': np.tile(entities['welfare_type'], len(percentiles)),
+        'target_percentile': np.repeat([f'P{p}' for p in percentiles], len(entities)),
+        'poverty_line': [result[j][0] for j in range(len(percentiles)) for result in results],
+        'headcount': [result[j][1] for j in range(len(percentiles)) for result in results],
+    })
+    df_closest_complete['distance_to_p'] = abs(df_closest_complete['headcount'] -
+                                               np.repeat([p/100 for p in percentiles], len(entities)))
+
+    # The search of a subset of entities is combined with the previous percentiles by the caller
+    if search_all:
+        write_intermediate(df_closest_complete, TEMP_DIR / f'ppp_{ppp}/full_dist/percentiles_countries')
+    checkpoint.clear()
+
+    end_time = time.time()
+    print(f'Execution time: {(end_time - start_time)/3600} hours')
 
-        for povline in povline_list_dict[key]:
+    return df_closest_complete
 
-            start_time = time.time()
 
-            povline_dollars = povline/100
-            print(f'Fetching regional headcounts for: ${povline_dollars} a day')
+def generate_percentiles_regions(povline_list_dict, ppp, max_workers=DEFAULT_MAX_WORKERS, resume=False, client=None):
 
-            df = regional_data(povline, ppp)
-            df_complete_regions = pd.concat([df_complete_regions, df],ignore_index=True)
+    start_time_overall = time.time()
+    query_durations_regions = {"povline":[],"duration":[]}
 
-            end_time = time.time()
-            query_durations_regions["povline"].append(povline_dollars)
-            query_durations_regions["duration"].append(end_time - start_time)
+    def fetch_regional_headcounts(povline):
+        povline_dollars = povline/100
+        print(f'Fetching regional headcounts for: ${povline_dollars} a day')
 
+        return regional_data(povline, ppp, client=client)
 
-        #Write the complete data to csv
-        df_complete_regions.to_csv(TEMP_DIR / f'ppp_{ppp}/full_dist_regions/{key}_regions.csv', index=False)
+    fetch_povline_groups(fetch_regional_headcounts, povline_list_dict, TEMP_DIR / f'ppp_{ppp}/full_dist_regions', ppp,
+                         query_durations_regions, max_workers=max_workers, resume=resume, file_suffix='_regions')
 
     end_time_overall = time.time()
     elapsed_time_overall = end_time_overall - start_time_overall
     print(f'Execution time: {elapsed_time_overall/3600} hours')
 
-    # Take a look at how long each query took
-    df_query_durations_regions = pd.DataFrame.from_dict(query_durations_regions)
-
-    fig = px.line(df_query_durations_regions, x="povline", y="duration", title=f'Execution time for poverty line queries (regions)')
-
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/time_plot_regions.svg')
-    
-    df_complete_regions = pd.DataFrame()
-    for key in povline_list_dict:
-        df = pd.read_csv(TEMP_DIR / f'ppp_{ppp}/full_dist_regions/{key}_regions.csv')
-        df_complete_regions = pd.concat([df_complete_regions, df], ignore_index=True)
+    dfs = [read_intermediate(TEMP_DIR / f'ppp_{ppp}/full_dist_regions/{key}_regions') for key in povline_list_dict]
+    df_complete_regions = pd.concat(dfs, ignore_index=True)
 
     # Find closest to percentiles
 
     start_time = time.time()
 
     percentiles = range(1, 100, 1)
-
-    df_closest_complete_regions = pd.DataFrame()
-
-    for p in percentiles:
-
-        df_complete_regions['distance_to_p'] = abs(df_complete_regions['headcount']-p/100)
-
-        df_closest = df_complete_regions.sort_values("distance_to_p").groupby(['Entity', 'Year'], as_index=False).first()
-
-        df_closest['target_percentile'] = f'P{p}'
-
-        df_closest = df_closest[['Entity', 'Year', 'target_percentile', 'poverty_line', 'headcount', 'distance_to_p']]
-
-        df_closest_complete_regions = pd.concat([df_closest_complete_regions, df_closest],ignore_index=True)
+    df_closest_complete_regions = find_closest_percentiles(df_complete_regions, ['Entity', 'Year'],
+                                                           percentiles=percentiles)
 
     end_time = time.time()
     print(f'Execution time: {end_time - start_time} seconds')
 
-    fig = px.scatter(df_closest_complete_regions, x="target_percentile", y="distance_to_p", color="Entity",
-                     hover_data=['poverty_line', 'headcount', 'Year'], opacity=0.5,
-                     title="<b>Target p vs. Distance to p for regions</b><br>Percentiles",
-                     log_y=False,
-                     height=600)
-    fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/target_p_vs_distance_percentiles_regions.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/target_p_vs_distance_percentiles_regions.html')
-
-    fig = px.scatter(df_closest_complete_regions, x="poverty_line", y="distance_to_p", color="Entity",
-                     hover_data=['poverty_line', 'headcount', 'Year', 'target_percentile'], opacity=0.5,
-                     title="<b>Poverty line vs. Distance to p for regions</b><br>Percentiles",
-                     log_y=False,
-                     height=600)
-    fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/povline_vs_distance_percentiles_regions.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/povline_vs_distance_percentiles_regions.html')
-
-    fig = px.histogram(df_closest_complete_regions, x="distance_to_p", histnorm="percent", marginal="box")
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/distance_percentiles_histogram_regions.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/distance_percentiles_histogram_regions.html')
-
-    deciles = []
-
-    for i in range(10,100,10):
-        deciles.append(f'P{i}')
+    #Charts to check results (rendered off the critical path, see scripts/diagnostics.py)
+    save_percentile_diagnostics(pd.DataFrame.from_dict(query_durations_regions), df_closest_complete_regions,
+                                *diagnostics_dirs(ppp), scope="regions")
 
-    df_closest_deciles_regions = df_closest_complete_regions[df_closest_complete_regions['target_percentile'].isin(deciles)].copy().reset_index(drop=True)
-
-    fig = px.scatter(df_closest_deciles_regions, x="target_percentile", y="distance_to_p", color="Entity",
-                     hover_data=['poverty_line', 'headcount', 'Year'], opacity=0.5,
-                     title="<b>Target p vs. Distance to p for regions</b><br>Deciles",
-                     log_y=False,
-                     height=600)
-    fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/target_p_vs_distance_deciles_regions.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/target_p_vs_distance_deciles_regions.html')
-
-    fig = px.scatter(df_closest_deciles_regions, x="poverty_line", y="distance_to_p", color="Entity",
-                     hover_data=['poverty_line', 'headcount', 'Year', 'target_percentile'], opacity=0.5,
-                     title="<b>Poverty line vs. Distance to p for regions</b><br>Deciles",
-                     log_y=False,
-                     height=600)
-    fig.update_traces(marker=dict(size=10, line=dict(width=0, color='blue')))
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/povline_vs_distance_deciles_regions.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/povline_vs_distance_deciles_regions.html')
-
-    fig = px.histogram(df_closest_deciles_regions, x="distance_to_p", histnorm="percent", marginal="box")
-    fig.write_image(GRAPHICS_DIR / f'ppp_{ppp}/distance_deciles_histogram_regions.svg')
-    fig.write_html(GRAPHICS_DIR / f'ppp_{ppp}/distance_deciles_histogram_regions.html')
-
-    df_closest_complete_regions.to_csv(TEMP_DIR / f'ppp_{ppp}/full_dist_regions/percentiles_regions.csv', index=False)
+    write_intermediate(df_closest_complete_regions, TEMP_DIR / f'ppp_{ppp}/full_dist_regions/percentiles_regions')
     
     return df_closest_complete_regions
 
 
 # ## Data transformations
-def additional_variables_and_check(df_final, poverty_lines_cents, col_relative, ppp):
+# Return a dataframe with the columns of 2-D arrays (of the same shape) interleaved: the first column of each array,
+# then the second column of each array, and so on. Names are given as one list per array
+def interleaved_frame(blocks, names):
+    n_rows, n_columns = blocks[0].shape
+    values = np.stack(blocks, axis=2).reshape(n_rows, n_columns * len(blocks))
+
+    return pd.DataFrame(values, columns=[name for group in zip(*names) for name in group])
+
+
+# Stacked bands use the lines of stacked_povlines_cents (by default, all but the line of high income countries), and the
+# people between each pair of lines (low, high) of stacked_between_cents (by default, the pairs of STACKED_BETWEEN_CENTS)
+# are counted as well
+def additional_variables_and_check(df_final, poverty_lines_cents, col_relative, ppp, stacked_povlines_cents=None,
+                                   stacked_between_cents=None):
     
     #Define groups of columns
     col_ids = ['Entity', 'Year', 'reporting_level', 'welfare_type']
@@ -935,6 +1120,14 @@ def additional_variables_and_check(df_final, poverty_lines_cents, col_relative,
         col_tot_shortfall.append(f'total_shortfall_{poverty_lines_cents[i]}')
         col_poverty_severity.append(f'poverty_severity_{poverty_lines_cents[i]}')
         col_watts.append(f'watts_{poverty_lines_cents[i]}')
+
+    # Each family of variables is computed as a 2-D array (one row per row of df_final, one column per variable) and
+    # kept in a dataframe of its own. They are all attached to df_final at the end with a single concat, after dropping
+    # the rows with issues (inserting the variables one column at a time fragments the dataframe, and filtering it after
+    # each check copies all of it every time).
+    families = []
+    population = df_final['reporting_pop'].to_numpy()[:, np.newaxis]
+    headcounts = df_final[col_headcount].to_numpy()
         
     #///////////////////////////////////////////////////////////////////////////////
     #//////////////////////////////////////////////////////////////////////////////
@@ -944,21 +1137,15 @@ def additional_variables_and_check(df_final, poverty_lines_cents, col_relative,
     print('Calculating number of people above poverty lines...')
     start_time = time.time()
     
-    col_above_n = []
-    col_above_pct = []
+    col_above_n = [f'headcount_above_{i}' for i in poverty_lines_cents]
+    col_above_pct = [f'headcount_ratio_above_{i}' for i in poverty_lines_cents]
 
-    #For each poverty line in poverty_lines_cents
-    for i in poverty_lines_cents:
-        
-        varname_n = f'headcount_above_{i}'
-        df_final[varname_n] = df_final['reporting_pop'] - df_final[f'headcount_{i}']
-        col_above_n.append(varname_n)
-        
-        varname_pct = f'headcount_ratio_above_{i}'
-        df_final[varname_pct] = (df_final['reporting_pop'] - df_final[f'headcount_{i}']) / df_final['reporting_pop']
-        col_above_pct.append(varname_pct)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        above_n = population - headcounts
+        above_pct = above_n / population * 100
 
-    df_final.loc[:, col_above_pct] = df_final[col_above_pct] * 100
+    #Variables are interleaved as number and percentage for each poverty line
+    families.append(interleaved_frame([above_n, above_pct], [col_above_n, col_above_pct]))
     
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -974,81 +1161,27 @@ def additional_variables_and_check(df_final, poverty_lines_cents, col_relative,
 
     #Calculate numbers in poverty between pov lines for stacked area charts
     
-    #Remove the high income countries poverty line to the in-between calculations
-    if ppp == 2011:
-        poverty_lines_cents = [e for e in poverty_lines_cents if e not in [2170]]
-    elif ppp == 2017:
-        poverty_lines_cents = [e for e in poverty_lines_cents if e not in [2435]]
+    #By default, remove the high income countries poverty line to the in-between calculations
+    if stacked_povlines_cents is None:
+        stacked_povlines_cents = sorted(e for e in poverty_lines_cents if e != HIGH_INCOME_POVLINE_CENTS[ppp])
+    if stacked_between_cents is None:
+        stacked_between_cents = STACKED_BETWEEN_CENTS[ppp]
+    check_sorted_povlines(stacked_povlines_cents)
+
+    #People below the first poverty line, between each poverty line and the previous one, and above the last one
+    col_stacked_n, col_stacked_pct = stacked_band_names(stacked_povlines_cents)
+    stacked_n, stacked_pct = stacked_bands(df_final[[f'headcount_{i}' for i in stacked_povlines_cents]].to_numpy(),
+                                           population)
     
-    #Make sure the poverty lines are in order, lowest to highest
-    poverty_lines_cents.sort()
-
-    col_stacked_n = []
-    col_stacked_pct = []
-
-    #For each poverty line in poverty_lines_cents
-    for i in range(len(poverty_lines_cents)):
-        #if it's the first value only get people below this poverty line (and percentage)
-        if i == 0:
-            varname_n = f'headcount_stacked_below_{poverty_lines_cents[i]}'
-            df_final[varname_n] = df_final[f'headcount_{poverty_lines_cents[i]}']
-            col_stacked_n.append(varname_n)
-
-            varname_pct = f'headcount_ratio_stacked_below_{poverty_lines_cents[i]}'
-            df_final[varname_pct] = df_final[varname_n] / df_final['reporting_pop']
-            col_stacked_pct.append(varname_pct)
-
-        #If it's the last value calculate the people between this value and the previous 
-        #and also the people over this poverty line (and percentages)
-        elif i == len(poverty_lines_cents)-1:
+    #Calculate stacked variables which "jump" the original order (the percentages from the headcount ratios)
+    col_stacked_n_extra, col_stacked_pct_extra = between_band_names(stacked_between_cents)
+    stacked_n_extra = between_bands(headcounts, poverty_lines_cents, stacked_between_cents)
+    stacked_pct_extra = between_bands(df_final[col_headcount_ratio].to_numpy(), poverty_lines_cents,
+                                      stacked_between_cents)
 
-            varname_n = f'headcount_stacked_below_{poverty_lines_cents[i]}'
-            df_final[varname_n] = df_final[f'headcount_{poverty_lines_cents[i]}'] - df_final[f'headcount_{poverty_lines_cents[i-1]}']
-            col_stacked_n.append(varname_n)
-
-            varname_pct = f'headcount_ratio_stacked_below_{poverty_lines_cents[i]}'
-            df_final[varname_pct] = df_final[varname_n] / df_final['reporting_pop']
-            col_stacked_pct.append(varname_pct)
-
-            varname_n = f'headcount_stacked_above_{poverty_lines_cents[i]}'
-            df_final[varname_n] = df_final['reporting_pop'] - df_final[f'headcount_{poverty_lines_cents[i]}']
-            col_stacked_n.append(varname_n)
-
-            varname_pct = f'headcount_ratio_stacked_above_{poverty_lines_cents[i]}'
-            df_final[varname_pct] = df_final[varname_n] / df_final['reporting_pop']
-            col_stacked_pct.append(varname_pct)
-
-        #If it's any value between the first and the last calculate the people between this value and the previous (and percentage)
-        else:
-            varname_n = f'headcount_stacked_below_{poverty_lines_cents[i]}'
-            df_final[varname_n] = df_final[f'headcount_{poverty_lines_cents[i]}'] - df_final[f'headcount_{poverty_lines_cents[i-1]}']
-            col_stacked_n.append(varname_n)
-
-            varname_pct = f'headcount_ratio_stacked_below_{poverty_lines_cents[i]}'
-            df_final[varname_pct] = df_final[varname_n] / df_final['reporting_pop']
-            col_stacked_pct.append(varname_pct)
-
-    df_final.loc[:, col_stacked_pct] = df_final[col_stacked_pct] * 100
-    
-    #Calculate stacked variables which "jump" the original order
-    
-    df_final[f'headcount_stacked_between_{poverty_lines_cents[1]}_{poverty_lines_cents[4]}'] = df_final[f'headcount_{poverty_lines_cents[4]}'] - df_final[f'headcount_{poverty_lines_cents[1]}']
-    df_final[f'headcount_stacked_between_{poverty_lines_cents[4]}_{poverty_lines_cents[6]}'] = df_final[f'headcount_{poverty_lines_cents[6]}'] - df_final[f'headcount_{poverty_lines_cents[4]}']
-    col_stacked_n_extra = [f'headcount_stacked_between_{poverty_lines_cents[1]}_{poverty_lines_cents[4]}', f'headcount_stacked_between_{poverty_lines_cents[4]}_{poverty_lines_cents[6]}']
-    
-    df_final[f'headcount_ratio_stacked_between_{poverty_lines_cents[1]}_{poverty_lines_cents[4]}'] = df_final[f'headcount_ratio_{poverty_lines_cents[4]}'] - df_final[f'headcount_ratio_{poverty_lines_cents[1]}']
-    df_final[f'headcount_ratio_stacked_between_{poverty_lines_cents[4]}_{poverty_lines_cents[6]}'] = df_final[f'headcount_ratio_{poverty_lines_cents[6]}'] - df_final[f'headcount_ratio_{poverty_lines_cents[4]}']
-    col_stacked_pct_extra = [f'headcount_ratio_stacked_between_{poverty_lines_cents[1]}_{poverty_lines_cents[4]}', f'headcount_ratio_stacked_between_{poverty_lines_cents[4]}_{poverty_lines_cents[6]}']
-
-    
-
-#     df_final['headcount_stacked_between_190_1000'] = df_final['headcount_1000'] - df_final['headcount_190']
-#     df_final['headcount_stacked_between_1000_3000'] = df_final['headcount_3000'] - df_final['headcount_1000']
-#     col_stacked_n_extra = ['headcount_stacked_between_190_1000', 'headcount_stacked_between_1000_3000']
-
-#     df_final['headcount_ratio_stacked_between_190_1000'] = df_final['headcount_ratio_1000'] - df_final['headcount_ratio_190']
-#     df_final['headcount_ratio_stacked_between_1000_3000'] = df_final['headcount_ratio_3000'] - df_final['headcount_ratio_1000']
-#     col_stacked_pct_extra = ['headcount_ratio_stacked_between_190_1000', 'headcount_ratio_stacked_between_1000_3000']
+    families.append(pd.concat([interleaved_frame([stacked_n, stacked_pct], [col_stacked_n, col_stacked_pct]),
+                               pd.DataFrame(stacked_n_extra, columns=col_stacked_n_extra),
+                               pd.DataFrame(stacked_pct_extra, columns=col_stacked_pct_extra)], axis=1))
 
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -1062,42 +1195,35 @@ def additional_variables_and_check(df_final, poverty_lines_cents, col_relative,
     print('Calculating decile averages and inequality ratios...')
     start_time = time.time()
     # Create average decile income/consumption
-    col_decile_share = []
-    col_decile_avg = []
-    col_decile_thr = []
+    col_decile_share = [f'decile{i}_share' for i in range(1, 11)]
+    col_decile_avg = [f'decile{i}_avg' for i in range(1, 11)]
+    col_decile_thr = [f'decile{i}_thr' for i in range(1, 10)]
 
-    for i in range(1,11):
-
-        if i !=10:
-            varname_thr = f'decile{i}_thr'
-            col_decile_thr.append(varname_thr)
-
-        varname_share = f'decile{i}_share'
-        varname_avg = f'decile{i}_avg'
-        df_final[varname_avg] = df_final[varname_share] * df_final['mean'] / 0.1
-
-        col_decile_share.append(varname_share)
-        col_decile_avg.append(varname_avg)
+    decile_share = df_final[col_decile_share].to_numpy()
+    decile_thr = df_final[col_decile_thr].to_numpy()
+    families.append(pd.DataFrame(decile_share * df_final['mean'].to_numpy()[:, np.newaxis] / 0.1,
+                                 columns=col_decile_avg))
 
     #Multiplies decile columns by 100
-    df_final.loc[:, col_decile_share] = df_final[col_decile_share] * 100
+    decile_share = decile_share * 100
     
     #Quintile shares
+    col_quintile_share = [f'quintile{q}_share' for q in range(1, 6)]
+    quintile_share = decile_share[:, 0::2] + decile_share[:, 1::2]
+
+    #Palma ratio and other average/share ratios (deciles are numbered from 1, columns from 0)
+    col_ratios = ['palma_ratio', 's80_s20_ratio', 'p90_p10_ratio', 'p90_p50_ratio', 'p50_p10_ratio']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.column_stack([
+            decile_share[:, 9] / (decile_share[:, 0] + decile_share[:, 1] + decile_share[:, 2] + decile_share[:, 3]),
+            (decile_share[:, 8] + decile_share[:, 9]) / (decile_share[:, 0] + decile_share[:, 1]),
+            decile_thr[:, 8] / decile_thr[:, 0],
+            decile_thr[:, 8] / decile_thr[:, 4],
+            decile_thr[:, 4] / decile_thr[:, 0],
+        ])
+    families.append(pd.DataFrame(np.hstack([quintile_share, ratios]), columns=col_quintile_share + col_ratios))
     
-    col_quintile_share = []
-    for q in range(1,6):
-        varname_share = f'quintile{q}_share'
-        df_final[varname_share] = df_final[f'decile{2*q-1}_share'] + df_final[f'decile{2*q}_share']
-        col_quintile_share.append(varname_share)
-
-    #Palma ratio and other average/share ratios
-    df_final['palma_ratio'] = df_final['decile10_share'] / (df_final['decile1_share'] + df_final['decile2_share'] + df_final['decile3_share'] + df_final['decile4_share'])
-    df_final['s80_s20_ratio'] =  (df_final['decile9_share'] + df_final['decile10_share']) / (df_final['decile1_share'] + df_final['decile2_share'])
-    df_final['p90_p10_ratio'] =  df_final['decile9_thr'] / df_final['decile1_thr']
-    df_final['p90_p50_ratio'] =  df_final['decile9_thr'] / df_final['decile5_thr']
-    df_final['p50_p10_ratio'] =  df_final['decile5_thr'] / df_final['decile1_thr']
-    
-    col_inequality = ['mld', 'gini', 'polarization', 'palma_ratio', 's80_s20_ratio', 'p90_p10_ratio', 'p90_p50_ratio', 'p50_p10_ratio']
+    col_inequality = ['mld', 'gini', 'polarization'] + col_ratios
 
 
     end_time = time.time()
@@ -1120,34 +1246,38 @@ def additional_variables_and_check(df_final, poverty_lines_cents, col_relative,
     
     #######################################################################################
     
-    #Dropping errors
+    #Dropping errors (the checks are combined, and the rows dropped once at the end)
     
     print('Dropping rows with issues...')
     start_time = time.time()
 
     # stacked values not adding up to 100%
     print(f'{len(df_final)} rows before stacked values check')
-    df_final['sum_pct'] = df_final[col_stacked_pct].sum(axis=1)
-    df_final = df_final[~((df_final['sum_pct'] >= 100.1) | (df_final['sum_pct'] <= 99.9))].reset_index(drop=True)
-    print(f'{len(df_final)} rows after stacked values check')
+    sum_pct = pd.DataFrame(stacked_pct).sum(axis=1).to_numpy()
+    keep = ~((sum_pct >= 100.1) | (sum_pct <= 99.9))
+    print(f'{keep.sum()} rows after stacked values check')
 
     #missing poverty values (headcount, poverty gap, total shortfall)
-    print(f'{len(df_final)} rows before missing values check')
-    cols_to_check = col_headcount + col_headcount_ratio + col_povertygap + col_tot_shortfall + col_stacked_n + col_stacked_pct
-    df_final = df_final[~df_final[cols_to_check].isna().any(1)].reset_index(drop=True)
-    print(f'{len(df_final)} rows after missing values check')
+    print(f'{keep.sum()} rows before missing values check')
+    cols_to_check = col_headcount + col_headcount_ratio + col_povertygap + col_tot_shortfall
+    keep &= ~(df_final[cols_to_check].isna().any(axis=1).to_numpy() | np.isnan(stacked_n).any(axis=1) |
+              np.isnan(stacked_pct).any(axis=1))
+    print(f'{keep.sum()} rows after missing values check')
 
     # headcount monotonicity check
-    print(f'{len(df_final)} rows before headcount monotonicity check')
-    m_check_vars = []
-    for i in range(len(col_headcount)):
-        if i > 0:
-            check_varname = f'm_check_{i}'
-            df_final[check_varname] = df_final[f'{col_headcount[i]}'] >= df_final[f'{col_headcount[i-1]}']
-            m_check_vars.append(check_varname)       
-    df_final['check_total'] = df_final[m_check_vars].all(1)
-    df_final = df_final[df_final['check_total'] == True].reset_index(drop=True)
-    print(f'{len(df_final)} rows after headcount monotonicity check')
+    print(f'{keep.sum()} rows before headcount monotonicity check')
+    m_check = headcounts[:, 1:] >= headcounts[:, :-1]
+    check_total = m_check.all(axis=1)
+    m_check_vars = [f'm_check_{i}' for i in range(1, len(col_headcount))]
+    families.append(pd.concat([pd.DataFrame({'sum_pct': sum_pct}), pd.DataFrame(m_check, columns=m_check_vars),
+                               pd.DataFrame({'check_total': check_total})], axis=1))
+    keep &= check_total
+    print(f'{keep.sum()} rows after headcount monotonicity check')
+
+    # Rows with issues are dropped, the shares of deciles replaced by percentages, and each family of variables attached
+    df_final = df_final[keep].reset_index(drop=True)
+    df_final[col_decile_share] = decile_share[keep]
+    df_final = pd.concat([df_final] + [family[keep].reset_index(drop=True) for family in families], axis=1)
 
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -1161,8 +1291,8 @@ def median_patch(df_final, ppp):
     print('Patching missing median values...')
     start_time = time.time()
 
-    input_file = TEMP_DIR / f'ppp_{ppp}/raw/percentiles.csv'
-    df_median = pd.read_csv(input_file)
+    input_file = TEMP_DIR / f'ppp_{ppp}/raw/percentiles'
+    df_median = read_intermediate(input_file)
     df_median = df_median[df_median['target_percentile'] == "P50"].reset_index(drop=True)
 
     df_final = pd.merge(df_final, 
@@ -1238,18 +1368,18 @@ def standardise(df_final, cols, ppp):
     #Add ppp_version column
     df_final['ppp_version'] = ppp
     
-    df_final.to_csv(TEMP_DIR / f'pip_dataset_ppp{ppp}.csv', index=False)
+    write_intermediate(df_final, TEMP_DIR / f'pip_dataset_ppp{ppp}')
     
     return df_final
 
 def combine_2011_and_2011_data():
     #Read the respective 2011 and 2017 PPP file
-    input_2011_file = TEMP_DIR / 'pip_dataset_ppp2011.csv'
-    input_2017_file = TEMP_DIR / 'pip_dataset_ppp2017.csv'
+    input_2011_file = TEMP_DIR / 'pip_dataset_ppp2011'
+    input_2017_file = TEMP_DIR / 'pip_dataset_ppp2017'
 
-    if input_2011_file.is_file() and input_2017_file.is_file():
-        df_2011 = pd.read_csv(input_2011_file)
-        df_2017 = pd.read_csv(input_2017_file)
+    if intermediate_exists(input_2011_file) and intermediate_exists(input_2017_file):
+        df_2011 = read_intermediate(input_2011_file)
+        df_2017 = read_intermediate(input_2017_file)
         
         #Replace international lines numbers to text
         df_2011.columns = df_2011.columns.str.replace("190", "international_povline")
@@ -0,0 +1,369 @@
+"""Pipeline declared as a graph of stages, rebuilt incrementally.
+
+Each stage calls a function of the pipeline with the outputs of other stages as inputs, and declares its parameters
+(e.g. poverty lines or the PIP data version) and the files it reads (e.g. mapping tables). The fingerprint of a stage
+is a hash of its parameters, the source code of its function and of the modules of the package it relies on (e.g. the
+helpers it calls), the content of its inputs and the content of the files it reads. Outputs are stored (with their content hash) after each stage runs, so a stage only runs again when its
+fingerprint changes, and a stage whose inputs are rebuilt with an identical content is not run again either.
+
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import pandas as pd
+
+from scripts.profiling import StageProfiler
+from scripts.storage import find_intermediate, read_intermediate, write_intermediate
+
+
+class Stage:
+    """A step of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage (used to select it with --stages).
+    function : callable
+        Function run by the stage.
+    outputs : sequence of str
+        Names of the values returned by the function (in order, if it returns a tuple).
+    inputs : dict, optional
+        Argument of the function given by each output of another stage, e.g. {"df_final": "poverty"}.
+    params : dict, optional
+        Arguments of the function that are part of the fingerprint of the stage.
+    options : dict, optional
+        Arguments of the function that do not change its result (e.g. number of workers or API client), and hence are
+        not part of its fingerprint. Arguments that change the result (e.g. the method used to compute it) must be
+        given as `params` instead.
+    context : dict, optional
+        Other values that the result of the function depends on (e.g. the PIP data version), which are part of its
+        fingerprint but are not passed to the function.
+    input_files : sequence of Path, optional
+        Files read by the function (intermediate files can be given without suffix).
+    output_files : sequence of Path, optional
+        Files written by the function, which is run again if any of them is missing.
+    after : sequence of str, optional
+        Stages that must run before this one, even if none of their outputs are inputs of this one.
+    always_run : bool, optional
+        True to run the stage even if its fingerprint did not change (e.g. to download data again).
+
+    """
+
+    def __init__(self, name: str, function: Callable, outputs: Sequence[str] = (),
+                 inputs: Optional[Dict[str, str]] = None, params: Optional[Dict[str, Any]] = None,
+                 options: Optional[Dict[str, Any]] = None, context: Optional[Dict[str, Any]] = None,
+                 input_files: Sequence[Path] = (), output_files: Sequence[Path] = (), after: Sequence[str] = (),
+                 always_run: bool = False) -> None:
+        self.name = name
+        self.function = function
+        self.outputs = list(outputs)
+        self.inputs = dict(inputs or {})
+        self.params = dict(params or {})
+        self.options = dict(options or {})
+        self.context = dict(context or {})
+        self.input_files = [Path(file) for file in input_files]
+        self.output_files = [Path(file) for file in output_files]
+        self.after = list(after)
+        self.always_run = always_run
+
+
+def _hash_bytes(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def hash_value(value: Any) -> str:
+    """Return a hash of the content of an output of a stage (a dataframe, or any value that can be stored as json)."""
+    if isinstance(value, pd.DataFrame):
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps([[str(column), str(dtype)] for column, dtype in value.dtypes.items()]).encode())
+        hasher.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+        return hasher.hexdigest()
+
+    return _hash_bytes(json.dumps(value, sort_keys=True).encode())
+
+
+def hash_file(file: Path) -> Optional[str]:
+    """Return a hash of the content of a file (or of an intermediate file given without suffix), or None if missing."""
+    file = Path(file)
+    if not file.is_file():
+        file = find_intermediate(file)
+    if file is None:
+        return None
+
+    hasher = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def hash_function(function: Callable) -> str:
+    """Return a hash of the source code of a function (so that a stage runs again when its code changes)."""
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        source = getattr(function, "__qualname__", repr(function))
+
+    return _hash_bytes(source.encode())
+
+
+def _package_modules(function: Callable) -> List[ModuleType]:
+    # Modules of the package of a function that it may rely on: its own module, and the modules of the same package
+    # that it imports (or imports objects from), transitively.
+    module = inspect.getmodule(function)
+    if module is None:
+        return []
+    package = module.__name__.split(".")[0]
+
+    modules = {module.__name__: module}
+    pending = [module]
+    while pending:
+        for value in list(vars(pending.pop()).values()):
+            if isinstance(value, ModuleType):
+                dependency = value
+            else:
+                dependency = sys.modules.get(getattr(value, "__module__", None) or "")
+            if (dependency is not None) and (dependency.__name__.split(".")[0] == package) and \
+                    (dependency.__name__ not in modules):
+                modules[dependency.__name__] = dependency
+                pending.append(dependency)
+
+    return [modules[name] for name in sorted(modules)]
+
+
+def hash_code(function: Callable) -> str:
+    """Return a hash of the source code of a function and of the modules of its package that it relies on.
+
+    A change in any helper called by the function (e.g. in another module of the package) changes the hash, so that the
+    stage runs again instead of reusing outputs computed with the old code.
+
+    """
+    hashes = [hash_function(function)]
+    for module in _package_modules(function):
+        try:
+            hashes.append(_hash_bytes(inspect.getsource(module).encode()))
+        except (OSError, TypeError):
+            hashes.append(module.__name__)
+
+    return _hash_bytes("".join(hashes).encode())
+
+
+class StageGraph:
+    """Graph of the stages of a pipeline, with their stored outputs and fingerprints.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        Stages of the pipeline (in any order compatible with their dependencies, which is the order they run in).
+    state_dir : Path
+        Directory where the outputs of the stages and the manifest of their fingerprints will be stored.
+    profiler : StageProfiler, optional
+        Profiler recording the time and memory of each stage that runs.
+
+    """
+
+    def __init__(self, stages: List[Stage], state_dir: Path, profiler: Optional[StageProfiler] = None) -> None:
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_dir = Path(state_dir)
+        self.profiler = profiler
+        self.producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f"Output {output} is produced by both {self.producers[output]} and {stage.name}.")
+                self.producers[output] = stage.name
+        for stage in stages:
+            for output in stage.inputs.values():
+                if output not in self.producers:
+                    raise ValueError(f"Input {output} of stage {stage.name} is not produced by any stage.")
+            for name in stage.after:
+                if name not in self.stages:
+                    raise ValueError(f"Stage {stage.name} runs after unknown stage {name}.")
+        self.order = self._sort()
+
+    def dependencies(self, name: str) -> List[str]:
+        """Return the stages that a stage directly depends on."""
+        stage = self.stages[name]
+        return sorted({self.producers[output] for output in stage.inputs.values()} | set(stage.after))
+
+    def _sort(self) -> List[str]:
+        # Topological sort, keeping the declaration order among stages that do not depend on each other.
+        order = []
+        pending = list(self.stages)
+        while pending:
+            ready = [name for name in pending if all(dependency in order for dependency in self.dependencies(name))]
+            if len(ready) == 0:
+                raise ValueError(f"Stages {pending} have circular dependencies.")
+            order.append(ready[0])
+            pending.remove(ready[0])
+
+        return order
+
+    def downstream(self, name: str) -> List[str]:
+        """Return a stage and all the stages that depend on it (directly or not), in running order."""
+        selected = {name}
+        for other in self.order:
+            if any(dependency in selected for dependency in self.dependencies(other)):
+                selected.add(other)
+
+        return [other for other in self.order if other in selected]
+
+    def select(self, selectors: Optional[Iterable[str]] = None) -> List[str]:
+        """Return the stages picked by a list of selectors, in running order.
+
+        Each selector is either the name of a stage, or the name of a stage followed by "+" to also pick all stages
+        downstream of it. If no selectors are given, all stages are picked.
+
+        """
+        if not selectors:
+            return list(self.order)
+
+        selected = set()
+        for selector in selectors:
+            name = selector[:-1] if selector.endswith("+") else selector
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}. Choose among {self.order}.")
+            selected.update(self.downstream(name) if selector.endswith("+") else [name])
+
+        return [name for name in self.order if name in selected]
+
+    @property
+    def manifest_file(self) -> Path:
+        return self.state_dir / "manifest.json"
+
+    def _read_manifest(self) -> Dict[str, dict]:
+        if not self.manifest_file.is_file():
+            return {}
+        with open(self.manifest_file) as file:
+            return json.load(file)
+
+    def _write_manifest(self, manifest: Dict[str, dict]) -> None:
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        temp_manifest_file = self.manifest_file.with_suffix(".json.tmp")
+        with open(temp_manifest_file, "w") as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+        os.replace(temp_manifest_file, self.manifest_file)
+
+    def _output_path(self, output: str) -> Path:
+        return self.state_dir / "outputs" / output
+
+    def _store_output(self, output: str, value: Any) -> str:
+        path = self._output_path(output)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(value, pd.DataFrame):
+            write_intermediate(value, path)
+        else:
+            temp_file = path.with_name(f"{path.name}.json.tmp")
+            with open(temp_file, "w") as file:
+                json.dump(value, file)
+            os.replace(temp_file, path.with_name(f"{path.name}.json"))
+
+        return hash_value(value)
+
+    def _output_stored(self, output: str) -> bool:
+        path = self._output_path(output)
+        return path.with_name(f"{path.name}.json").is_file() or (find_intermediate(path) is not None)
+
+    def _load_output(self, output: str) -> Any:
+        path = self._output_path(output)
+        json_file = path.with_name(f"{path.name}.json")
+        if json_file.is_file():
+            with open(json_file) as file:
+                return json.load(file)
+
+        return read_intermediate(path)
+
+    def fingerprint(self, name: str, output_hashes: Dict[str, str]) -> str:
+        """Return the fingerprint of a stage, given the content hashes of the outputs of the stages it depends on."""
+        stage = self.stages[name]
+        content = {
+            "params": stage.params,
+            "context": stage.context,
+            "code": hash_code(stage.function),
+            "inputs": {argument: output_hashes.get(output) for argument, output in sorted(stage.inputs.items())},
+            "files": {str(file): hash_file(file) for file in stage.input_files},
+        }
+
+        return _hash_bytes(json.dumps(content, sort_keys=True, default=str).encode())
+
+    def run(self, selectors: Optional[Iterable[str]] = None, force: bool = False) -> Dict[str, Any]:
+        """Run the selected stages whose fingerprint changed since they last ran.
+
+        Stages that are not selected are never run, and their stored outputs are used instead.
+
+        Parameters
+        ----------
+        selectors : list of str, optional
+            Stages to run (see `select`). All stages if not given.
+        force : bool, optional
+            True to run the selected stages even if their fingerprint did not change.
+
+        Returns
+        -------
+        values : dict
+            Outputs of the stages that were run or loaded, by name.
+
+        """
+        selected = self.select(selectors)
+        manifest = self._read_manifest()
+        output_hashes = {output: hash_ for state in manifest.values() for output, hash_ in state["outputs"].items()}
+        values = {}
+
+        def get_value(output):
+            if output not in values:
+                values[output] = self._load_output(output)
+            return values[output]
+
+        for name in self.order:
+            stage = self.stages[name]
+            fingerprint = self.fingerprint(name, output_hashes)
+            state = manifest.get(name)
+            missing = [output for output in stage.outputs if not self._output_stored(output)] + \
+                [str(file) for file in stage.output_files if not file.exists()]
+            up_to_date = (state is not None) and (state["fingerprint"] == fingerprint) and (len(missing) == 0)
+
+            if name not in selected:
+                if any(not self._output_stored(output) for output in stage.outputs):
+                    raise RuntimeError(f"Stage {name} has not been run yet, and it is needed by the selected stages. "
+                                       f"Select it too (e.g. --stages {name}+).")
+                if not up_to_date:
+                    print(f"Stage {name}: not selected, using its stored outputs (which are out of date).")
+                if self.profiler is not None:
+                    self.profiler.skipped(name, reason="not selected")
+                continue
+            if up_to_date and not (force or stage.always_run):
+                print(f"Stage {name}: up to date, skipped.")
+                if self.profiler is not None:
+                    self.profiler.skipped(name, reason="up to date")
+                continue
+
+            print(f"Stage {name}: running...")
+            arguments = {argument: get_value(output) for argument, output in stage.inputs.items()}
+            arguments.update(stage.params)
+            arguments.update(stage.options)
+            if self.profiler is not None:
+                result = self.profiler.run(name, stage.function, arguments)
+            else:
+                result = stage.function(**arguments)
+            results = result if len(stage.outputs) > 1 else (result,)
+            for output, value in zip(stage.outputs, results):
+                values[output] = value
+                output_hashes[output] = self._store_output(output, value)
+
+            # The stage may have (re)written some of the files it reads (e.g. the downloaded percentiles), so its
+            # fingerprint is taken again after it runs.
+            manifest[name] = {
+                "fingerprint": self.fingerprint(name, output_hashes),
+                "outputs": {output: output_hashes[output] for output in stage.outputs},
+            }
+            self._write_manifest(manifest)
+
+        return values
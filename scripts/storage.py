@@ -0,0 +1,166 @@
+"""Storage of the intermediate files of the pipeline (under the temporary folder).
+
+Intermediate files are written in a columnar binary format (Parquet by default, or Feather), which is much faster to
+read back and smaller on disk than csv, and keeps the types of all columns. Files are referred to by their path
+without a suffix; the suffix is given by the storage format. A csv copy of every file can also be exported, to inspect
+intermediate results while debugging. Writing a file removes its copies in other formats (but the csv export), so that
+a file written in an earlier format is never read instead of the latest one.
+
+"""
+
+import os
+from pathlib import Path
+from typing import List, Optional
+
+import pandas as pd
+
+# Suffix of the files of each storage format.
+FORMAT_SUFFIXES = {
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "csv": ".csv",
+}
+# Types of the identifier columns, enforced when reading files stored as csv (binary formats keep their own types).
+CSV_DTYPES = {
+    "Entity": "str",
+    "country": "str",
+    "country_code": "str",
+    "reporting_level": "str",
+    "welfare_type": "str",
+    "target_percentile": "str",
+    "poverty line": "str",
+}
+
+# Current storage settings (see configure_storage).
+_storage_format = "parquet"
+_export_csv = False
+
+
+def configure_storage(storage_format: str = "parquet", export_csv: bool = False) -> None:
+    """Set the format of the intermediate files, and whether to also export a csv copy of each of them.
+
+    Parameters
+    ----------
+    storage_format : str, optional
+        Either "parquet", "feather" or "csv".
+    export_csv : bool, optional
+        True to also write a csv copy of each intermediate file, to inspect it while debugging (it is only read if the
+        file in the storage format is missing).
+
+    """
+    global _storage_format, _export_csv
+
+    if storage_format not in FORMAT_SUFFIXES:
+        raise ValueError(f"Unknown storage format {storage_format}. Choose one of {list(FORMAT_SUFFIXES)}.")
+    _storage_format = storage_format
+    _export_csv = export_csv
+
+
+def _read_file(file: Path, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    if file.suffix == ".parquet":
+        return pd.read_parquet(file, columns=columns)
+    if file.suffix == ".feather":
+        return pd.read_feather(file, columns=columns)
+    header = pd.read_csv(file, nrows=0).columns
+    dtypes = {column: dtype for column, dtype in CSV_DTYPES.items() if column in header}
+
+    return pd.read_csv(file, usecols=columns, dtype=dtypes)
+
+
+def write_intermediate(df: pd.DataFrame, path: Path) -> Path:
+    """Write a dataframe to an intermediate file (atomically).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data to write (its index is not stored).
+    path : Path
+        Path of the file, without suffix.
+
+    Returns
+    -------
+    file : Path
+        Path of the written file (with the suffix of the storage format).
+
+    """
+    path = Path(path)
+    file = path.with_name(path.name + FORMAT_SUFFIXES[_storage_format])
+    # Write to a temporary file first and then rename it, so that an interruption never leaves a partial file.
+    temp_file = file.with_name(file.name + ".tmp")
+    df = df.reset_index(drop=True)
+    if _storage_format == "parquet":
+        df.to_parquet(temp_file, index=False)
+    elif _storage_format == "feather":
+        df.to_feather(temp_file)
+    else:
+        df.to_csv(temp_file, index=False)
+    os.replace(temp_file, file)
+
+    kept_suffixes = {FORMAT_SUFFIXES[_storage_format]}
+    if _export_csv and (_storage_format != "csv"):
+        df.to_csv(path.with_name(path.name + ".csv"), index=False)
+        kept_suffixes.add(".csv")
+
+    # Copies in other formats are out of date now.
+    for suffix in set(FORMAT_SUFFIXES.values()) - kept_suffixes:
+        stale_file = path.with_name(path.name + suffix)
+        if stale_file.is_file():
+            stale_file.unlink()
+
+    return file
+
+
+def find_intermediate(path: Path) -> Optional[Path]:
+    """Return the file of an intermediate file, preferably in the current storage format, or None if there is none.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the file, without suffix.
+
+    Returns
+    -------
+    file : Path or None
+        Path of the file (with its suffix).
+
+    """
+    path = Path(path)
+    storage_formats = [_storage_format] + [storage_format for storage_format in FORMAT_SUFFIXES
+                                           if storage_format != _storage_format]
+    for storage_format in storage_formats:
+        file = path.with_name(path.name + FORMAT_SUFFIXES[storage_format])
+        if file.is_file():
+            return file
+
+    return None
+
+
+def read_intermediate(path: Path, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read an intermediate file.
+
+    The file in the current storage format is read if it exists; otherwise, the file in any other format (e.g. the csv
+    files written by previous versions of the pipeline).
+
+    Parameters
+    ----------
+    path : Path
+        Path of the file, without suffix.
+    columns : list of str, optional
+        Columns to read (all if not given).
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Data read from the file.
+
+    """
+    file = find_intermediate(path)
+    if file is None:
+        raise FileNotFoundError(f"No intermediate file found for {path} (in any of the formats {list(FORMAT_SUFFIXES)}).")
+
+    return _read_file(file, columns=columns)
+
+
+def intermediate_exists(path: Path) -> bool:
+    """Return True if an intermediate file exists (in any format)."""
+    return find_intermediate(path) is not None
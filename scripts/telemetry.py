@@ -0,0 +1,229 @@
+"""Metrics of the requests made to the PIP API.
+
+A `FetchMetrics` records, for each endpoint of the API (e.g. "pip" for countries and "pip-grp" for regions), a
+histogram of the latency of request attempts, the bytes received (over the network, i.e. compressed, and once
+decompressed), the number of retries, the count of each response
+status (or connection error), and the requests that failed for good, together with the hits and misses of the response
+cache. Metrics can be exported as a JSON summary and as a Prometheus textfile (to be picked up by the textfile
+collector of a node exporter), at the end of a run or periodically during it, so that a run that slows down can be
+spotted, and the throughput of the API compared between releases.
+
+"""
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+from urllib.parse import urlsplit
+
+# Upper bounds (in seconds) of the buckets of the latency histograms.
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Prefix of the names of all exported metrics.
+METRIC_PREFIX = "pip"
+
+
+def endpoint_of(request_url: str) -> str:
+    """Return the endpoint of a request URL (the last part of its path, e.g. "pip" or "pip-grp")."""
+    parts = [part for part in urlsplit(request_url).path.split("/") if part != ""]
+
+    return parts[-1] if parts else ""
+
+
+def _write_atomically(file: Path, content: str) -> None:
+    file = Path(file)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = file.with_name(f"{file.name}.tmp")
+    temp_file.write_text(content)
+    os.replace(temp_file, file)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    values = ",".join(f'{name}="{str(value)}"' for name, value in sorted(labels.items()))
+
+    return "{" + values + "}"
+
+
+class EndpointMetrics:
+    """Metrics of the requests made to one endpoint of the API."""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.bytes_received = 0
+        self.content_bytes = 0
+        self.retries = 0
+        self.failures = 0
+        self.statuses: Dict[str, int] = {}
+
+    def observe(self, latency: float, status: str, n_bytes: int, n_content_bytes: int) -> None:
+        for i, bound in enumerate(self.buckets):
+            if latency <= bound:
+                self.bucket_counts[i] += 1
+        self.latency_count += 1
+        self.latency_sum += latency
+        self.bytes_received += n_bytes
+        self.content_bytes += n_content_bytes
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self) -> dict:
+        return {
+            "attempts": self.latency_count,
+            "latency_seconds": {
+                "sum": self.latency_sum,
+                "mean": self.latency_sum / self.latency_count if self.latency_count > 0 else None,
+                "buckets": {str(bound): count for bound, count in zip(self.buckets, self.bucket_counts)},
+            },
+            "bytes_received": self.bytes_received,
+            "content_bytes": self.content_bytes,
+            "retries": self.retries,
+            "failures": self.failures,
+            "statuses": dict(sorted(self.statuses.items())),
+        }
+
+
+class FetchMetrics:
+    """Thread-safe metrics of the requests made to the PIP API during a run.
+
+    Parameters
+    ----------
+    labels : dict, optional
+        Labels added to all exported metrics (e.g. the PPP version and PIP data version of the run), to tell apart the
+        metrics of different runs.
+    buckets : sequence of float, optional
+        Upper bounds (in seconds) of the buckets of the latency histograms.
+
+    """
+
+    def __init__(self, labels: Optional[Dict[str, str]] = None,
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self.labels = dict(labels or {})
+        self.buckets = tuple(sorted(buckets))
+        self.endpoints: Dict[str, EndpointMetrics] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._stop_export: Optional[threading.Event] = None
+        self._export_thread: Optional[threading.Thread] = None
+
+    def _endpoint(self, request_url: str) -> EndpointMetrics:
+        endpoint = endpoint_of(request_url)
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = EndpointMetrics(self.buckets)
+        return self.endpoints[endpoint]
+
+    def record_attempt(self, request_url: str, latency: float, status: str, n_bytes: int = 0,
+                       n_content_bytes: Optional[int] = None) -> None:
+        """Record a request attempt, with its latency (in seconds), status (e.g. "200" or "ConnectionError") and size.
+
+        `n_bytes` is the size of the response received over the network (compressed, if it was), and `n_content_bytes`
+        the size of its content once decompressed (the same as `n_bytes` if not given).
+
+        """
+        if n_content_bytes is None:
+            n_content_bytes = n_bytes
+        with self._lock:
+            self._endpoint(request_url).observe(latency, status, n_bytes, n_content_bytes)
+
+    def record_retry(self, request_url: str) -> None:
+        """Record that a request is being retried."""
+        with self._lock:
+            self._endpoint(request_url).retries += 1
+
+    def record_failure(self, request_url: str) -> None:
+        """Record a request that failed for good."""
+        with self._lock:
+            self._endpoint(request_url).failures += 1
+
+    def record_cache(self, hit: bool) -> None:
+        """Record a lookup in the response cache."""
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def summary(self) -> dict:
+        """Return a summary of all metrics (that can be stored as JSON)."""
+        with self._lock:
+            elapsed = time.time() - self.started_at
+            endpoints = {endpoint: metrics.summary() for endpoint, metrics in sorted(self.endpoints.items())}
+            attempts = sum(metrics["attempts"] for metrics in endpoints.values())
+            return {
+                "labels": self.labels,
+                "elapsed_seconds": elapsed,
+                "attempts_per_second": attempts / elapsed if elapsed > 0 else None,
+                "cache": {"hits": self.cache_hits, "misses": self.cache_misses},
+                "endpoints": endpoints,
+            }
+
+    def to_prometheus(self) -> str:
+        """Return all metrics in the text exposition format of Prometheus."""
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            for suffix, labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{suffix}{_format_labels({**self.labels, **labels})} {value}")
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            latency_samples = []
+            for endpoint, metrics in endpoints:
+                for bound, count in zip(metrics.buckets, metrics.bucket_counts):
+                    latency_samples.append(("_bucket", {"endpoint": endpoint, "le": str(bound)}, count))
+                latency_samples.append(("_bucket", {"endpoint": endpoint, "le": "+Inf"}, metrics.latency_count))
+                latency_samples.append(("_sum", {"endpoint": endpoint}, metrics.latency_sum))
+                latency_samples.append(("_count", {"endpoint": endpoint}, metrics.latency_count))
+            add_metric("request_duration_seconds", "histogram", "Latency of the request attempts to the PIP API.",
+                       latency_samples)
+            add_metric("response_bytes_total", "counter",
+                       "Bytes received from the PIP API over the network (compressed).",
+                       [("", {"endpoint": endpoint}, metrics.bytes_received) for endpoint, metrics in endpoints])
+            add_metric("response_content_bytes_total", "counter",
+                       "Bytes of the responses of the PIP API once decompressed.",
+                       [("", {"endpoint": endpoint}, metrics.content_bytes) for endpoint, metrics in endpoints])
+            add_metric("responses_total", "counter", "Responses of the PIP API by status (or connection error).",
+                       [("", {"endpoint": endpoint, "status": status}, count)
+                        for endpoint, metrics in endpoints for status, count in sorted(metrics.statuses.items())])
+            add_metric("request_retries_total", "counter", "Retries of requests to the PIP API.",
+                       [("", {"endpoint": endpoint}, metrics.retries) for endpoint, metrics in endpoints])
+            add_metric("request_failures_total", "counter", "Requests to the PIP API that failed after all retries.",
+                       [("", {"endpoint": endpoint}, metrics.failures) for endpoint, metrics in endpoints])
+            add_metric("cache_lookups_total", "counter", "Lookups in the response cache of the PIP API.",
+                       [("", {"result": "hit"}, self.cache_hits), ("", {"result": "miss"}, self.cache_misses)])
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_file: Optional[Path] = None, prometheus_file: Optional[Path] = None) -> None:
+        """Write the JSON summary and/or the Prometheus textfile of the metrics (atomically)."""
+        if json_file is not None:
+            _write_atomically(json_file, json.dumps(self.summary(), indent=2))
+        if prometheus_file is not None:
+            _write_atomically(prometheus_file, self.to_prometheus())
+
+    def start_periodic_export(self, interval: float, json_file: Optional[Path] = None,
+                              prometheus_file: Optional[Path] = None) -> None:
+        """Export the metrics every `interval` seconds (in a background thread), until `stop_periodic_export`."""
+        self._stop_export = threading.Event()
+
+        def export_periodically(stop):
+            while not stop.wait(interval):
+                self.export(json_file=json_file, prometheus_file=prometheus_file)
+
+        self._export_thread = threading.Thread(target=export_periodically, args=(self._stop_export,), daemon=True)
+        self._export_thread.start()
+
+    def stop_periodic_export(self) -> None:
+        """Stop exporting the metrics periodically."""
+        if self._export_thread is not None:
+            self._stop_export.set()
+            self._export_thread.join()
+            self._export_thread = None
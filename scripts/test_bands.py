@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+
+from scripts.bands import between_band_names, between_bands, check_sorted_povlines, stacked_band_names, stacked_bands
+
+
+class TestStackedBands(unittest.TestCase):
+    """Unit tests for the stacked bands of the population between poverty lines."""
+
+    def setUp(self):
+        self.povlines = [100, 215, 365, 1000]
+        self.headcounts = np.array([
+            [10.0, 30.0, 60.0, 90.0],
+            [0.0, 0.0, 5.0, 50.0],
+            [10.0, np.nan, 60.0, 90.0],
+        ])
+        self.population = np.array([100.0, 50.0, 100.0])
+
+    def test_bands_add_up_to_population(self):
+        """People below the first line, between consecutive lines and above the last should add up to everyone."""
+        counts, shares = stacked_bands(self.headcounts, self.population)
+        np.testing.assert_array_equal(counts[0], [10, 20, 30, 30, 10])
+        np.testing.assert_array_equal(counts[1], [0, 0, 5, 45, 0])
+        np.testing.assert_array_equal(counts[:2].sum(axis=1), self.population[:2])
+        np.testing.assert_allclose(shares[:2].sum(axis=1), [100, 100])
+        np.testing.assert_array_equal(shares[1], [0, 0, 10, 90, 0])
+        # A missing headcount leaves the two bands next to it missing.
+        self.assertEqual(np.isnan(counts[2]).tolist(), [False, True, True, False, False])
+
+    def test_any_number_of_lines(self):
+        """Any set of sorted lines should give one band more than lines, with matching names."""
+        for n_lines in [1, 2, 40]:
+            headcounts = np.sort(np.random.default_rng(n_lines).uniform(0, 100, (5, n_lines)), axis=1)
+            counts, shares = stacked_bands(headcounts, np.full(5, 100.0))
+            col_n, col_pct = stacked_band_names(list(range(n_lines)))
+            self.assertEqual(counts.shape, (5, n_lines + 1))
+            self.assertEqual(len(col_n), n_lines + 1)
+            np.testing.assert_allclose(shares.sum(axis=1), 100)
+
+    def test_names(self):
+        """Names should follow the columns of the dataset."""
+        self.assertEqual(stacked_band_names([40, 50], suffix='_median'),
+                         (['headcount_stacked_below_40_median', 'headcount_stacked_below_50_median',
+                           'headcount_stacked_above_50_median'],
+                          ['headcount_ratio_stacked_below_40_median', 'headcount_ratio_stacked_below_50_median',
+                           'headcount_ratio_stacked_above_50_median']))
+        self.assertEqual(between_band_names([(215, 1000)]),
+                         (['headcount_stacked_between_215_1000'], ['headcount_ratio_stacked_between_215_1000']))
+
+    def test_between_bands(self):
+        """People between any pair of lines should be the difference of their headcounts."""
+        between = between_bands(self.headcounts, self.povlines, [(215, 1000), (100, 365)])
+        np.testing.assert_array_equal(between[:2], [[60, 50], [50, 5]])
+        with self.assertRaises(ValueError):
+            between_bands(self.headcounts, self.povlines, [(1000, 215)])
+        with self.assertRaises(ValueError):
+            between_bands(self.headcounts, self.povlines, [(100, 320)])
+
+    def test_unsorted_lines_raise(self):
+        """Lines that are not sorted from lowest to highest should raise an error."""
+        check_sorted_povlines(self.povlines)
+        with self.assertRaises(ValueError):
+            check_sorted_povlines([100, 365, 215])
+        with self.assertRaises(ValueError):
+            check_sorted_povlines([100, 100])
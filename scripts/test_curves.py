@@ -0,0 +1,76 @@
+import unittest
+from math import erf, pi, sqrt
+
+import numpy as np
+import pandas as pd
+
+from scripts.curves import headcount_curves, interpolate_headcounts, poverty_measures
+
+normal_cdf = np.vectorize(lambda x: 0.5 * (1 + erf(x / sqrt(2))))
+
+
+def normal_pdf(x):
+    return np.exp(-x ** 2 / 2) / sqrt(2 * pi)
+
+
+class TestPovertyMeasures(unittest.TestCase):
+    """Unit tests for the poverty measures computed from headcount curves."""
+
+    def setUp(self):
+        # Grid of poverty lines of one cent below $10, and of two cents up to $20 (as the grid fetched from the API).
+        self.povlines = np.concatenate([np.arange(1, 1000), np.arange(1000, 2000, 2)]) / 100
+        self.mu = np.array([0.5, 1.0, 1.5, 2.0])
+        self.sigma = np.array([0.5, 0.7, 0.9, 0.6])
+        headcounts = normal_cdf((np.log(self.povlines) - self.mu[:, np.newaxis]) / self.sigma[:, np.newaxis])
+        self.df = pd.DataFrame({
+            "Entity": np.repeat(["D", "C", "B", "A"], len(self.povlines)),
+            "poverty_line": np.tile(self.povlines, 4),
+            "headcount": headcounts.ravel(),
+        })
+
+    def test_lognormal_measures(self):
+        """Measures should match the closed forms of lognormal distributions."""
+        entities, povlines, curves = headcount_curves(self.df, ["Entity"])
+        self.assertEqual(entities["Entity"].tolist(), ["A", "B", "C", "D"])
+        # Entities are sorted, so the parameters of each curve are the reverse of the ones of the data.
+        mu, sigma = self.mu[::-1, np.newaxis], self.sigma[::-1, np.newaxis]
+        lines = np.exp(mu) * np.array([0.4, 0.5, 0.6])
+        rows = np.repeat(np.arange(4)[:, np.newaxis], 3, axis=1)
+        values = poverty_measures(povlines, curves, rows, lines)
+
+        z = (np.log(lines) - mu) / sigma
+        headcount = normal_cdf(z)
+
+        def partial_moment(k):
+            return np.exp(k * mu + (k * sigma) ** 2 / 2) * normal_cdf(z - k * sigma)
+
+        expected = {
+            "headcount": headcount,
+            "poverty_gap": headcount - partial_moment(1) / lines,
+            "poverty_severity": headcount - 2 * partial_moment(1) / lines + partial_moment(2) / lines ** 2,
+            "watts": headcount * np.log(lines) - (mu * headcount - sigma * normal_pdf(z)),
+        }
+        for measure, expected_values in expected.items():
+            np.testing.assert_allclose(values[measure], expected_values, atol=1e-4, err_msg=measure)
+        np.testing.assert_array_equal(interpolate_headcounts(povlines, curves, rows, lines), values["headcount"])
+
+    def test_uniform_distribution_is_exact(self):
+        """Measures of a linear headcount curve should be exact, also below the lowest line of the grid."""
+        povlines = np.array([0.5, 1.0, 2.0, 4.0])
+        curves = (povlines / 4)[np.newaxis]
+        lines = np.array([0.25, 1.5, 4.0])
+        values = poverty_measures(povlines, curves, np.zeros(3, dtype=int), lines)
+        np.testing.assert_allclose(values["headcount"], lines / 4)
+        np.testing.assert_allclose(values["poverty_gap"], lines / 8)
+        np.testing.assert_allclose(values["poverty_severity"], lines / 12)
+        np.testing.assert_allclose(values["watts"], lines / 4)
+
+    def test_missing_values(self):
+        """Lines missing for an entity should be interpolated, and lines outside of the grid give missing values."""
+        df = self.df.drop(index=[500, 501, 502]).reset_index(drop=True)
+        _, povlines, curves = headcount_curves(df, ["Entity"])
+        _, _, complete_curves = headcount_curves(self.df, ["Entity"])
+        np.testing.assert_allclose(curves, complete_curves, atol=1e-4)
+        values = poverty_measures(povlines, curves, np.array([0, 0, 0]), np.array([0.0, 25.0, np.nan]))
+        for measure in values:
+            self.assertTrue(np.isnan(values[measure]).all())
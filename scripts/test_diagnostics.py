@@ -0,0 +1,52 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.diagnostics import configure_diagnostics, save_percentile_diagnostics
+from scripts.storage import intermediate_exists, read_intermediate
+
+
+class TestSavePercentileDiagnostics(unittest.TestCase):
+    """Unit tests for the data saved to render the diagnostic charts."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = Path(self.temp_dir.name) / "diagnostics"
+        self.graphics_dir = Path(self.temp_dir.name) / "graphics"
+        self.df_query_durations = pd.DataFrame({"povline": [100, 200], "duration": [1.5, 2.5]})
+        self.df_closest = pd.DataFrame({
+            "Entity": ["Chile", "Chile"],
+            "Year": [2000, 2000],
+            "reporting_level": ["national", "national"],
+            "welfare_type": ["income", "income"],
+            "target_percentile": ["P1", "P2"],
+            "poverty_line": [1.0, 2.0],
+            "headcount": [0.011, 0.019],
+            "distance_to_p": [0.001, 0.001],
+        })
+
+    def tearDown(self):
+        configure_diagnostics()
+        self.temp_dir.cleanup()
+
+    def test_deferred_mode_only_saves_data(self):
+        """In deferred mode, the data of the charts should be saved, but no chart rendered."""
+        configure_diagnostics("deferred")
+        save_percentile_diagnostics(self.df_query_durations, self.df_closest, self.data_dir, self.graphics_dir,
+                                    scope="regions")
+        pd.testing.assert_frame_equal(read_intermediate(self.data_dir / "query_durations_regions"),
+                                      self.df_query_durations)
+        self.assertEqual(read_intermediate(self.data_dir / "closest_percentiles_regions").columns.tolist(),
+                         ["Entity", "Year", "target_percentile", "poverty_line", "headcount", "distance_to_p"])
+        self.assertFalse(self.graphics_dir.exists())
+
+    def test_off_mode_saves_nothing(self):
+        """In off mode, nothing should be saved."""
+        configure_diagnostics("off")
+        save_percentile_diagnostics(self.df_query_durations, self.df_closest, self.data_dir, self.graphics_dir,
+                                    scope="countries")
+        self.assertFalse(intermediate_exists(self.data_dir / "closest_percentiles"))
+        self.assertFalse(self.graphics_dir.exists())
+
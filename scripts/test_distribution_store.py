@@ -0,0 +1,62 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scripts.curves import headcount_curves, poverty_measures
+from scripts.distribution_store import DistributionStore, write_distribution_store
+
+
+class TestDistributionStore(unittest.TestCase):
+    """Unit tests for the memory-mapped store of headcount curves."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / "distribution_store"
+        povlines = np.arange(1, 201) / 10
+        entities = [("Chile", 2000, "national", "income"), ("Chile", 2000, "national", "consumption"),
+                    ("Peru", 2010, "national", "income"), ("Peru", 2010, "urban", "income")]
+        scales = np.array([2.0, 3.0, 5.0, 8.0])
+        self.df = pd.DataFrame(
+            [entity + (povline, 1 - np.exp(-povline / scale))
+             for entity, scale in zip(entities, scales) for povline in povlines],
+            columns=["Entity", "Year", "reporting_level", "welfare_type", "poverty_line", "headcount"],
+        ).astype({"Entity": "category", "Year": "int16"})
+        write_distribution_store(self.df, self.path, pip_version="v1", ppp=2017, dtype=np.float64)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_headcount_at_matches_curves(self):
+        """Headcounts read from the store should be the interpolated headcount curves, for any shape of batch."""
+        store = DistributionStore(self.path, pip_version="v1")
+        self.assertIsInstance(store.headcounts, np.memmap)
+        _, povlines, curves = headcount_curves(self.df, ["Entity", "Year", "reporting_level", "welfare_type"])
+        lines = np.array([0.05, 1.234, 7.77, 19.99])
+
+        # Entities are sorted: (Chile, consumption), (Chile, income), (Peru, national), (Peru, urban).
+        values = store.headcount_at("Chile", 2000, lines, welfare_type="income")
+        expected = poverty_measures(povlines, curves, 1, lines)["headcount"]
+        np.testing.assert_allclose(values, expected)
+
+        values = store.headcount_at(["Peru"], [2010], lines[:, np.newaxis], reporting_level=["national", "urban"])
+        self.assertEqual(values.shape, (4, 2))
+        expected = poverty_measures(povlines, curves, np.array([[2, 3]]), lines[:, np.newaxis])["headcount"]
+        np.testing.assert_allclose(values, expected)
+
+        values = store.measures_at(["Peru", "Chile"], 2010, 2.0, welfare_type="income", chunk_size=1)
+        self.assertTrue(np.isnan(values["watts"][1]))
+        self.assertAlmostEqual(values["headcount"][0], 1 - np.exp(-2.0 / 5.0))
+
+    def test_ambiguous_and_outdated_stores(self):
+        """Entities matching several rows, and stores of other PIP versions, should raise an error."""
+        store = DistributionStore(self.path)
+        with self.assertRaises(ValueError):
+            store.headcount_at("Chile", 2000, 1.0)
+        with self.assertRaises(ValueError):
+            DistributionStore(self.path, pip_version="v2")
+        (self.path / "meta.json").unlink()
+        with self.assertRaises(FileNotFoundError):
+            DistributionStore(self.path)
@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from scripts.dtypes import compact_dtypes, memory_usage_mb
+from scripts.percentiles import find_closest_percentiles
+
+
+class TestCompactDtypes(unittest.TestCase):
+    """Unit tests for the compact types of the data parsed from the PIP API."""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            "country_name": ["B", "B", "A", "C"] * 25,
+            "reporting_level": ["national", "urban", "national", "national"] * 25,
+            "welfare_type": ["income", "consumption", "income", "income"] * 25,
+            "reporting_year": np.repeat(np.arange(1990, 2015), 4),
+            "headcount": np.linspace(0, 1, 100),
+            "comment": ["x"] * 100,
+        })
+
+    def test_values_unchanged(self):
+        """Identifiers should become categoricals and years small integers, without changing any value."""
+        df = compact_dtypes(self.df)
+        self.assertIsInstance(df["country_name"].dtype, pd.CategoricalDtype)
+        self.assertEqual(df["reporting_year"].dtype, np.int16)
+        self.assertEqual(df["headcount"].dtype, np.float64)
+        # Columns that are not identifiers are left as they are.
+        self.assertEqual(df["comment"].dtype, object)
+        pd.testing.assert_frame_equal(df.astype(self.df.dtypes.to_dict()), self.df)
+        self.assertLess(memory_usage_mb(df), memory_usage_mb(self.df))
+
+    def test_float32(self):
+        """Metrics should be stored as 32-bit floats only if requested."""
+        df = compact_dtypes(self.df, float32=True)
+        self.assertEqual(df["headcount"].dtype, np.float32)
+        np.testing.assert_allclose(df["headcount"], self.df["headcount"], rtol=1e-6)
+
+    def test_closest_percentiles_with_categoricals(self):
+        """The closest percentiles should be the same for categorical and string identifiers."""
+        df = pd.DataFrame({
+            "Entity": np.repeat(["C", "A", "B"], 50),
+            "Year": np.tile(np.repeat([2001, 2000], 25), 3),
+            "poverty_line": np.tile(np.arange(1, 26, dtype=float), 6),
+            "headcount": np.tile(np.linspace(0.01, 0.99, 25), 6),
+        })
+        df_compact = compact_dtypes(df)
+        self.assertIsInstance(df_compact["Entity"].dtype, pd.CategoricalDtype)
+        expected = find_closest_percentiles(df, ["Entity", "Year"], [10, 50, 90])
+        result = find_closest_percentiles(df_compact, ["Entity", "Year"], [10, 50, 90])
+        pd.testing.assert_frame_equal(result.astype(expected.dtypes.to_dict()), expected)
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from scripts.incremental import carry_forward, changed_rows
+
+
+class TestIncrementalRefresh(unittest.TestCase):
+    """Unit tests for the incremental refresh of extractions for a new PIP data version."""
+
+    ID_COLS = ["Entity", "Year"]
+
+    def setUp(self):
+        self.df_previous = pd.DataFrame({
+            "Entity": ["A", "A", "B", "C"],
+            "Year": [2000, 2001, 2000, 2000],
+            "survey_year": [2000.0, 2001.0, np.nan, 2000.0],
+            "mean": [1.0, 2.0, 3.0, 4.0],
+        })
+
+    def test_changed_rows(self):
+        """Only new rows, and rows whose compared values changed, should be returned."""
+        df_current = pd.DataFrame({
+            "Entity": ["A", "A", "B", "D"],
+            "Year": [2000, 2001, 2000, 2000],
+            "survey_year": [2000.0, 2001.0, np.nan, 2000.0],
+            "mean": [1.0 + 1e-12, 2.5, 3.0, 5.0],
+            "gini": [0.3, 0.3, 0.3, 0.3],
+        })
+        df_changed = changed_rows(self.df_previous, df_current, self.ID_COLS, ["survey_year", "mean", "gini"])
+        self.assertEqual(df_changed[self.ID_COLS].values.tolist(), [["A", 2001], ["D", 2000]])
+        pd.testing.assert_frame_equal(df_changed, df_current.iloc[[1, 3]])
+
+    def test_carry_forward(self):
+        """Refreshed rows should replace the previous ones, and rows of entities that disappeared should be dropped."""
+        df_previous = pd.DataFrame({
+            "Entity": ["A", "A", "B", "C"],
+            "Year": [2000, 2000, 2000, 2000],
+            "target_percentile": ["P1", "P2", "P1", "P1"],
+            "poverty_line": [1.0, 2.0, 3.0, 4.0],
+        })
+        df_refreshed = pd.DataFrame({
+            "Entity": ["A", "A"],
+            "Year": [2000, 2000],
+            "target_percentile": ["P1", "P2"],
+            "poverty_line": [1.5, 2.5],
+        })
+        df_entities = pd.DataFrame({"Entity": ["A", "B"], "Year": [2000, 2000]})
+        df = carry_forward(df_previous, df_refreshed, df_entities, self.ID_COLS)
+        self.assertEqual(df["poverty_line"].tolist(), [1.5, 2.5, 3.0])
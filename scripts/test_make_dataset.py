@@ -1,6 +1,6 @@
 import unittest
 import pandas as pd
-from scripts.shared import OUTPUT_CSV_FILE, PIP_CODEBOOK_FILE
+from scripts.constants import OUTPUT_CSV_FILE, PIP_CODEBOOK_FILE
 
 
 class TestMakeDataset(unittest.TestCase):
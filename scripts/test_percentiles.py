@@ -0,0 +1,68 @@
+import unittest
+from math import erf, log, sqrt
+
+import numpy as np
+import pandas as pd
+
+from scripts.percentiles import entity_codes, find_closest_percentiles, search_percentile_thresholds
+
+
+def lognormal_headcount(povline, median=8.0, sigma=0.8):
+    return 0.5 * (1 + erf((log(povline) - log(median)) / (sigma * sqrt(2))))
+
+
+class TestSearchPercentileThresholds(unittest.TestCase):
+    """Unit tests for the search of percentile thresholds of one entity."""
+
+    def test_smooth_distribution_within_tolerance(self):
+        """For a smooth distribution, all percentiles should be found within the tolerance."""
+        targets = [p / 100 for p in range(1, 100)]
+        known_points = {1.0: lognormal_headcount(1.0)}
+        thresholds = search_percentile_thresholds(lognormal_headcount, targets, known_points=known_points,
+                                                  tolerance=0.0005)
+        distances = [abs(headcount - target) for (_, headcount), target in zip(thresholds, targets)]
+        self.assertLessEqual(max(distances), 0.0005)
+        # Poverty lines should be increasing with the percentile.
+        povlines = [povline for povline, _ in thresholds]
+        self.assertTrue(np.all(np.diff(povlines) > 0))
+
+    def test_step_distribution_terminates(self):
+        """For a step distribution (e.g. microdata), the search should stop at the closest reachable headcount."""
+        incomes = np.array([2.0, 4.0, 6.0, 8.0])
+
+        def step_headcount(povline):
+            return (incomes < povline).mean()
+
+        thresholds = search_percentile_thresholds(step_headcount, [0.1, 0.5, 0.6], tolerance=0.0005)
+        self.assertEqual([headcount for _, headcount in thresholds], [0.0, 0.5, 0.5])
+        self.assertTrue(4.0 < thresholds[1][0] <= 6.0)
+
+
+class TestFindClosestPercentiles(unittest.TestCase):
+    """Unit tests for the search of the grid points closest to each percentile."""
+
+    def test_closest_grid_points(self):
+        """The closest grid point to each percentile should be found for each entity, sorted by percentile."""
+        df = pd.DataFrame({
+            "Entity": ["B", "A", "B", "A", "B", "A", "A"],
+            "Year": [2000] * 7,
+            "poverty_line": [1.0, 1.0, 2.0, 2.0, 3.0, 3.0, 4.0],
+            "headcount": [0.2, 0.05, 0.45, 0.3, 0.9, np.nan, 0.6],
+        })
+        df_closest = find_closest_percentiles(df, ["Entity", "Year"], percentiles=[10, 50])
+        self.assertEqual(df_closest.columns.tolist(),
+                         ["Entity", "Year", "target_percentile", "poverty_line", "headcount", "distance_to_p"])
+        self.assertEqual(df_closest["Entity"].tolist(), ["A", "B", "A", "B"])
+        self.assertEqual(df_closest["target_percentile"].tolist(), ["P10", "P10", "P50", "P50"])
+        self.assertEqual(df_closest["poverty_line"].tolist(), [1.0, 1.0, 4.0, 2.0])
+        np.testing.assert_allclose(df_closest["distance_to_p"], [0.05, 0.1, 0.1, 0.05])
+
+    def test_entity_codes_sorted_by_value(self):
+        """Entities should be numbered in the order of their identifiers, even if their categories are not sorted."""
+        df = pd.DataFrame({
+            "Entity": pd.Categorical(["B", "A", "B", "C", "A"], categories=["C", "B", "A"]),
+            "Year": [2001, 2000, 2000, 2000, 2000],
+        })
+        codes, first_rows = entity_codes(df, ["Entity", "Year"])
+        self.assertEqual(codes.tolist(), [2, 0, 1, 3, 0])
+        self.assertEqual(first_rows.tolist(), [1, 2, 0, 3])
@@ -0,0 +1,218 @@
+import os
+import pickle
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import requests
+
+from scripts.pip_client import Cassette, CassetteMissError, CircuitBreaker, PIPClient, PIPRequestError, ResponseCache,\
+    RetryPolicy, get_with_retries, normalize_url, parse_retry_after
+
+
+class TestResponseCache(unittest.TestCase):
+    """Unit tests for the on-disk cache of PIP API responses."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_hits_and_misses(self):
+        """Stored responses should be returned for the same URL only, and counted as hits."""
+        cache = ResponseCache(self.cache_dir)
+        self.assertIsNone(cache.get("https://example.com/pip?povline=1.9&version=a"))
+        cache.put("https://example.com/pip?povline=1.9&version=a", b"headcount\n0.1\n")
+        self.assertEqual(cache.get("https://example.com/pip?povline=1.9&version=a"), b"headcount\n0.1\n")
+        self.assertIsNone(cache.get("https://example.com/pip?povline=1.9&version=b"))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2})
+
+    def test_refresh_and_disabled(self):
+        """Refreshing should ignore stored responses, and a disabled cache should store nothing."""
+        ResponseCache(self.cache_dir).put("url", b"old")
+        refreshing_cache = ResponseCache(self.cache_dir, refresh=True)
+        self.assertIsNone(refreshing_cache.get("url"))
+        refreshing_cache.put("url", b"new")
+        self.assertEqual(ResponseCache(self.cache_dir).get("url"), b"new")
+
+        disabled_cache = ResponseCache(self.cache_dir, enabled=False)
+        disabled_cache.put("other_url", b"content")
+        self.assertIsNone(ResponseCache(self.cache_dir).get("other_url"))
+
+    def test_lru_eviction(self):
+        """When the cache is full, the least recently used responses should be evicted first."""
+        cache = ResponseCache(self.cache_dir, max_size_bytes=25)
+        cache.put("a", b"0123456789")
+        cache.put("b", b"0123456789")
+        # Make "a" the most recently used response.
+        os.utime(cache._path("b"), (0, 0))
+        cache.get("a")
+        cache.put("c", b"0123456789")
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+
+
+class TestRetries(unittest.TestCase):
+    """Unit tests for the retry policy and circuit breaker of PIP API requests."""
+
+    @staticmethod
+    def response(status_code, content=b"", headers=None):
+        return mock.Mock(status_code=status_code, content=content, headers=headers or {})
+
+    def test_retries_until_success(self):
+        """Retryable errors should be retried, honouring the Retry-After header."""
+        responses = [self.response(503), self.response(429, headers={"Retry-After": "3"}), self.response(200, b"ok")]
+        with mock.patch("scripts.pip_client.requests.get", side_effect=responses),\
+                mock.patch("scripts.pip_client.time.sleep") as sleep:
+            content = get_with_retries("url", RetryPolicy(backoff_base=0), CircuitBreaker())
+        self.assertEqual(content, b"ok")
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0, 3])
+
+    def test_retry_budget_exhausted(self):
+        """Requests should fail with an error once their retry budget is exhausted, instead of spinning forever."""
+        with mock.patch("scripts.pip_client.requests.get", return_value=self.response(500)) as get,\
+                mock.patch("scripts.pip_client.time.sleep"):
+            with self.assertRaises(PIPRequestError):
+                get_with_retries("url", RetryPolicy(max_retries=3, backoff_base=0), CircuitBreaker(min_attempts=100))
+        self.assertEqual(get.call_count, 4)
+
+    def test_responses_failing_mid_body_are_retried(self):
+        """Responses cut or corrupted while reading their body should be retried like connection errors."""
+        responses = [requests.exceptions.ChunkedEncodingError("cut"), requests.exceptions.ContentDecodingError("gzip"),
+                     self.response(200, b"ok")]
+        with mock.patch("scripts.pip_client.requests.get", side_effect=responses),\
+                mock.patch("scripts.pip_client.time.sleep"):
+            content = get_with_retries("url", RetryPolicy(backoff_base=0), CircuitBreaker())
+        self.assertEqual(content, b"ok")
+        with mock.patch("scripts.pip_client.requests.get", side_effect=requests.exceptions.MissingSchema("url")) as get:
+            with self.assertRaises(PIPRequestError):
+                get_with_retries("url", RetryPolicy(), CircuitBreaker())
+        self.assertEqual(get.call_count, 1)
+
+    def test_client_error_not_retried(self):
+        """Non-retryable errors (e.g. a bad URL) should fail straight away."""
+        with mock.patch("scripts.pip_client.requests.get", return_value=self.response(404)) as get:
+            with self.assertRaises(PIPRequestError):
+                get_with_retries("url", RetryPolicy(), CircuitBreaker())
+        self.assertEqual(get.call_count, 1)
+
+    def test_circuit_breaker_opens_on_high_error_rate(self):
+        """The circuit should open once the error rate of recent attempts exceeds the threshold."""
+        circuit_breaker = CircuitBreaker(window=10, error_rate_threshold=0.5, min_attempts=4, cooldown=60)
+        for success in [True, False, True, False]:
+            circuit_breaker.record(success)
+        self.assertFalse(circuit_breaker.is_open)
+        circuit_breaker.record(False)
+        self.assertTrue(circuit_breaker.is_open)
+        self.assertEqual(circuit_breaker.times_opened, 1)
+
+    def test_parse_retry_after(self):
+        """Retry-After headers can be given in seconds or as an HTTP date."""
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertIsNone(parse_retry_after(None))
+
+
+class TestPIPClient(unittest.TestCase):
+    """Unit tests for the client shared by all PIP API queries."""
+
+    def test_requests_reuse_session_and_cache(self):
+        """Requests should go through the pooled session, and repeated requests should be served from the cache."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            client = PIPClient(cache=ResponseCache(Path(temp_dir)), pool_maxsize=4)
+            self.assertIn("gzip", client.session.headers["Accept-Encoding"])
+            with mock.patch.object(client.session, "get", return_value=mock.Mock(status_code=200, content=b"ok")) as get:
+                self.assertEqual(client.get("url"), b"ok")
+                self.assertEqual(client.get("url"), b"ok")
+            self.assertEqual(get.call_count, 1)
+            self.assertEqual(client.cache.stats(), {"hits": 1, "misses": 1})
+            client.close()
+
+    def test_request_slots_held_during_requests(self):
+        """A request slot should be held while querying the API, and only then."""
+        request_slots = threading.BoundedSemaphore(1)
+        client = PIPClient(request_slots=request_slots)
+
+        def get(request_url, timeout):
+            # The only slot is taken by this request.
+            self.assertFalse(request_slots.acquire(blocking=False))
+            return mock.Mock(status_code=200, content=b"ok")
+
+        with mock.patch.object(client.session, "get", side_effect=get):
+            self.assertEqual(client.get("url"), b"ok")
+        self.assertTrue(request_slots.acquire(blocking=False))
+        client.close()
+
+    def test_request_slots_released_during_backoff(self):
+        """A request slot should not be held while waiting before a retry."""
+        request_slots = threading.BoundedSemaphore(1)
+
+        def sleep(delay):
+            # Other requests can take the slot during the backoff.
+            self.assertTrue(request_slots.acquire(blocking=False))
+            request_slots.release()
+
+        responses = [mock.Mock(status_code=503, content=b"", headers={}), mock.Mock(status_code=200, content=b"ok")]
+        with mock.patch("scripts.pip_client.requests.get", side_effect=responses),\
+                mock.patch("scripts.pip_client.time.sleep", side_effect=sleep) as mock_sleep:
+            content = get_with_retries("url", RetryPolicy(backoff_base=0), CircuitBreaker(),
+                                       request_slots=request_slots)
+        self.assertEqual(content, b"ok")
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    def test_errors_can_be_sent_between_processes(self):
+        """Request errors should keep their details when pickled (e.g. to be raised in a parent process)."""
+        error = pickle.loads(pickle.dumps(PIPRequestError("url", reason="status 404", attempts=1)))
+        self.assertEqual((error.request_url, error.reason, error.attempts), ("url", "status 404", 1))
+        self.assertIsInstance(pickle.loads(pickle.dumps(CassetteMissError("url"))), CassetteMissError)
+
+
+class TestCassette(unittest.TestCase):
+    """Unit tests for recording and replaying PIP API responses."""
+
+    def test_normalize_url(self):
+        """URLs differing only in the order of their parameters or in repeated slashes should be the same request."""
+        self.assertEqual(normalize_url("https://API.example.com/pip/v1//pip-grp?year=all&country=all"),
+                         normalize_url("https://api.example.com/pip/v1/pip-grp?country=all&year=all"))
+        self.assertNotEqual(normalize_url("https://api.example.com/pip?povline=1.9"),
+                            normalize_url("https://api.example.com/pip?povline=2.15"))
+
+    def test_record_and_replay(self):
+        """Recorded responses should be replayed without network access, and missing requests reported."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            recording_client = PIPClient(cassette=Cassette(Path(temp_dir), mode="record"))
+            with mock.patch.object(recording_client.session, "get",
+                                   return_value=mock.Mock(status_code=200, content=b"headcount\n0.1\n")):
+                recording_client.get("https://example.com/pip?povline=1.9&year=all")
+            recording_client.close()
+
+            replaying_client = PIPClient(cassette=Cassette(Path(temp_dir), mode="replay"))
+            with mock.patch.object(replaying_client.session, "get") as get:
+                self.assertEqual(replaying_client.get("https://example.com/pip?year=all&povline=1.9"),
+                                 b"headcount\n0.1\n")
+                with self.assertRaises(CassetteMissError):
+                    replaying_client.get("https://example.com/pip?povline=3.2&year=all")
+            get.assert_not_called()
+            self.assertEqual(replaying_client.cassette.missing, ["https://example.com/pip?povline=3.2&year=all"])
+            replaying_client.close()
+
+    def test_recordings_of_several_processes_are_merged(self):
+        """Cassettes recording at the same time (e.g. one per PPP version) should all keep their responses indexed."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cassette_2011 = Cassette(Path(temp_dir), mode="record")
+            cassette_2017 = Cassette(Path(temp_dir), mode="record")
+            cassette_2011.put("https://example.com/pip?ppp_version=2011", b"2011")
+            cassette_2017.put("https://example.com/pip?ppp_version=2017", b"2017")
+            # Each process writes its own index file, so closing at the same time never loses entries.
+            with mock.patch("scripts.pip_client.os.getpid", return_value=1):
+                cassette_2011.close()
+            with mock.patch("scripts.pip_client.os.getpid", return_value=2):
+                cassette_2017.close()
+            self.assertEqual(sorted(path.name for path in Path(temp_dir).glob("index*.json")),
+                             ["index-1.json", "index-2.json"])
+            self.assertEqual(len(Cassette(Path(temp_dir), mode="replay")._read_index()), 2)
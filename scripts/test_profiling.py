@@ -0,0 +1,44 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.profiling import StageProfiler
+from scripts.stages import Stage, StageGraph
+
+
+class TestStageProfiler(unittest.TestCase):
+    """Unit tests for the profiling of the stages of the pipeline."""
+
+    def test_run_report(self):
+        """The report should record the time, memory and shapes of the stages that ran, and the skipped ones."""
+        def query(povlines):
+            return pd.DataFrame({"Entity": ["A"] * len(povlines), "poverty_line": povlines})
+
+        def count(df_final):
+            return pd.DataFrame({"Entity": ["A"], "n_lines": [len(df_final)]}), ["Entity", "n_lines"]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir = Path(temp_dir)
+            stages = [
+                Stage("query", query, outputs=["lines"], params={"povlines": [1, 2, 3]}),
+                Stage("count", count, outputs=["counts", "cols"], inputs={"df_final": "lines"}),
+            ]
+            profiler = StageProfiler(temp_dir / "report.json", trace_memory=True, cprofile_dir=temp_dir / "profile")
+            StageGraph(stages, state_dir=temp_dir / "stages", profiler=profiler).run()
+            report = json.loads((temp_dir / "report.json").read_text())
+            self.assertTrue((temp_dir / "profile/query.prof").is_file())
+
+            profiler = StageProfiler(temp_dir / "report_rerun.json")
+            StageGraph(stages, state_dir=temp_dir / "stages", profiler=profiler).run()
+
+        self.assertEqual([record["stage"] for record in report["stages"]], ["query", "count"])
+        self.assertEqual(report["stages"][1]["inputs"], {"df_final": [3, 2]})
+        self.assertEqual(report["stages"][1]["outputs"], [[1, 2], None])
+        self.assertGreaterEqual(report["stages"][0]["wall_time_seconds"], 0)
+        self.assertIsNotNone(report["stages"][0]["peak_traced_mb"])
+        self.assertIn("process_max_rss_mb", report["stages"][0])
+        self.assertIn("Process max RSS so far (MB)", profiler.summary())
+        self.assertEqual([record["status"] for record in profiler.stages], ["skipped", "skipped"])
@@ -0,0 +1,251 @@
+import random
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from scripts.constants import PIP_VERSION
+from scripts.shared import additional_variables_and_check, build_distribution_store, fetch_concurrently,\
+    fetch_povline_groups, fetched_version, local_relative_poverty_values, search_percentiles_countries, unstack_strict
+from scripts.storage import read_intermediate
+
+
+class TestFetchPovlines(unittest.TestCase):
+    """Unit tests for the concurrent fetching of poverty lines."""
+
+    @staticmethod
+    def fake_fetch(povline):
+        # Make requests complete in a random order.
+        time.sleep(random.uniform(0, 0.01))
+        return pd.DataFrame({"poverty_line": [povline / 100], "headcount": [povline / 1000]})
+
+    def test_concurrent_output_matches_serial(self):
+        """Fetching concurrently should give the same results, in the same order, as fetching serially."""
+        povlines = list(range(1, 60))
+        dfs_serial, durations_serial = fetch_concurrently(self.fake_fetch, povlines, max_workers=1)
+        dfs_concurrent, durations_concurrent = fetch_concurrently(self.fake_fetch, povlines, max_workers=8)
+        pd.testing.assert_frame_equal(pd.concat(dfs_serial, ignore_index=True),
+                                      pd.concat(dfs_concurrent, ignore_index=True))
+        self.assertEqual(len(durations_serial), len(povlines))
+        self.assertEqual(len(durations_concurrent), len(povlines))
+
+
+class TestFetchPovlineGroups(unittest.TestCase):
+    """Unit tests for the checkpointed extraction of groups of poverty lines."""
+
+    @staticmethod
+    def fake_fetch(povline):
+        return pd.DataFrame({"poverty_line": [povline / 100], "headcount": [povline / 1000]})
+
+    def test_resume_fetches_only_missing_lines(self):
+        """After a failure, resuming should only fetch the missing lines, and give the same output as a full run."""
+        povline_list_dict = {"group_a": [1, 2, 3], "group_b": [4, 5, 6]}
+
+        def failing_fetch(povline):
+            if povline == 5:
+                raise ConnectionError("network dropped")
+            return self.fake_fetch(povline)
+
+        fetched = []
+
+        def recording_fetch(povline):
+            fetched.append(povline)
+            return self.fake_fetch(povline)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_dir = Path(temp_dir)
+            with self.assertRaises(ConnectionError):
+                fetch_povline_groups(failing_fetch, povline_list_dict, output_dir, 2017,
+                                     {"povline": [], "duration": []}, max_workers=1)
+            self.assertEqual(sorted(path.name for path in (output_dir / "checkpoint").iterdir()),
+                             ["4.parquet", "manifest.json"])
+            self.assertIsNone(fetched_version(output_dir))
+            fetch_povline_groups(recording_fetch, povline_list_dict, output_dir, 2017,
+                                 {"povline": [], "duration": []}, max_workers=1, resume=True)
+            self.assertEqual(fetched, [5, 6])
+            df_resumed = read_intermediate(output_dir / "group_b")
+            # Shards are deleted once merged into the files of their groups.
+            self.assertFalse((output_dir / "checkpoint").exists())
+            self.assertEqual(fetched_version(output_dir), PIP_VERSION[2017])
+
+        pd.testing.assert_frame_equal(df_resumed, pd.concat([self.fake_fetch(p) for p in [4, 5, 6]], ignore_index=True))
+
+
+class TestSearchPercentilesCountries(unittest.TestCase):
+    """Unit tests for the search of the percentiles of each country-year."""
+
+    def test_failed_entities_left_null_and_resumed(self):
+        """An entity whose queries fail should be left null without stopping the search, and searched again on resume."""
+        df_seed = pd.DataFrame({"Entity": ["Chile", "Peru"], "Year": [2000, 2000],
+                                "reporting_level": ["national", "national"], "welfare_type": ["income", "income"],
+                                "country_code": ["CHL", "PER"], "poverty_line": [50.0, 50.0], "headcount": [0.5, 0.5]})
+        queried = []
+
+        def query(country_code, value, fail=True, **kwargs):
+            queried.append(country_code)
+            if fail and (country_code == "PER"):
+                return pd.DataFrame()
+            return pd.DataFrame({"headcount": [min(value / 100, 1.0)]})
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for sub_dir in ["ppp_2017/raw", "ppp_2017/full_dist"]:
+                (Path(temp_dir) / sub_dir).mkdir(parents=True)
+            with mock.patch("scripts.shared.TEMP_DIR", Path(temp_dir)),\
+                    mock.patch("scripts.shared.country_data", return_value=df_seed),\
+                    mock.patch("scripts.shared.pip_query_country", side_effect=query):
+                df = search_percentiles_countries(2017, max_workers=1)
+                df_failures = pd.read_csv(Path(temp_dir) / "ppp_2017/raw/percentile_search_failures.csv")
+                self.assertEqual(df_failures["Entity"].tolist(), ["Peru"])
+                self.assertTrue(df[df["Entity"] == "Peru"]["poverty_line"].isna().all())
+                self.assertFalse(df[df["Entity"] == "Chile"]["poverty_line"].isna().any())
+
+            # The search of Chile is kept by an interrupted run, so resuming only searches Peru.
+            with mock.patch("scripts.shared.TEMP_DIR", Path(temp_dir)),\
+                    mock.patch("scripts.shared.country_data", return_value=df_seed),\
+                    mock.patch("scripts.shared.pip_query_country", side_effect=query),\
+                    mock.patch("scripts.checkpoint.PovlineCheckpoint.clear"):
+                search_percentiles_countries(2017, max_workers=1)
+            queried.clear()
+            with mock.patch("scripts.shared.TEMP_DIR", Path(temp_dir)),\
+                    mock.patch("scripts.shared.country_data", return_value=df_seed),\
+                    mock.patch("scripts.shared.pip_query_country",
+                               side_effect=lambda **kwargs: query(fail=False, **kwargs)):
+                df_resumed = search_percentiles_countries(2017, max_workers=1, resume=True)
+            self.assertEqual(set(queried), {"PER"})
+            self.assertFalse(df_resumed["poverty_line"].isna().any())
+            pd.testing.assert_frame_equal(df_resumed[df_resumed["Entity"] == "Chile"],
+                                          df[df["Entity"] == "Chile"])
+
+
+class TestLocalRelativePoverty(unittest.TestCase):
+    """Unit tests for the relative poverty values computed from the full-distribution grid."""
+
+    def test_stale_grid_raises(self):
+        """A grid fetched for another PIP version should not be used."""
+        df = pd.DataFrame({"Entity": ["Chile"], "Year": [2000], "reporting_level": ["national"],
+                           "welfare_type": ["income"], "median_50": [5.0]})
+        with tempfile.TemporaryDirectory() as temp_dir:
+            (Path(temp_dir) / "ppp_2017/full_dist").mkdir(parents=True)
+            (Path(temp_dir) / "ppp_2017/full_dist/version.json").write_text('{"version": "20000101_2017_01_01_PROD"}')
+            with mock.patch("scripts.shared.TEMP_DIR", Path(temp_dir)),\
+                    mock.patch("scripts.shared.missing_full_dist_groups", return_value=[]),\
+                    self.assertRaisesRegex(ValueError, "fetched for PIP version 20000101_2017_01_01_PROD"):
+                local_relative_poverty_values(df, [50], 2017)
+
+
+class TestBuildDistributionStore(unittest.TestCase):
+    """Unit tests for the building of the distribution store from the full-distribution grid."""
+
+    def test_only_built_for_current_grid(self):
+        """The store should be stamped with the version of the grid, and not built from a grid of another version."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            version_file = Path(temp_dir) / "ppp_2017/full_dist/version.json"
+            version_file.parent.mkdir(parents=True)
+            with mock.patch("scripts.shared.TEMP_DIR", Path(temp_dir)),\
+                    mock.patch("scripts.shared.missing_full_dist_groups", return_value=[]),\
+                    mock.patch("scripts.shared.read_full_dist_grid", return_value=pd.DataFrame()),\
+                    mock.patch("scripts.shared.write_distribution_store") as write_store:
+                build_distribution_store(2017)
+                version_file.write_text('{"version": "20000101_2017_01_01_PROD"}')
+                build_distribution_store(2017)
+                write_store.assert_not_called()
+
+                version_file.write_text(f'{{"version": "{PIP_VERSION[2017]}"}}')
+                build_distribution_store(2017)
+                self.assertEqual(write_store.call_args[0][2], PIP_VERSION[2017])
+
+
+class TestUnstackStrict(unittest.TestCase):
+    """Unit tests for making the data of several poverty lines wide."""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            "Entity": ["B", "A", "B", "A", "A", None],
+            "Year": [2000, 2000, 2000, 2000, 2001, 2000],
+            "poverty line": ["_190", "_190", "_320", "_320", "_190", "_190"],
+            "headcount": [0.2, 0.1, 0.4, np.nan, 0.3, 0.5],
+            "watts": [np.nan, np.nan, np.nan, np.nan, np.nan, 1.0],
+        })
+
+    def test_same_as_pivot_table(self):
+        """Without duplicated keys, the data should be the same as with pivot_table."""
+        df_wide = unstack_strict(self.df, ["Entity", "Year"], "poverty line", ["headcount", "watts"])
+        df_pivot = self.df.pivot_table(index=["Entity", "Year"], columns="poverty line")
+        df_pivot.columns = ["".join(col).strip() for col in df_pivot.columns.values]
+        pd.testing.assert_frame_equal(df_wide, df_pivot.reset_index())
+        self.assertEqual(df_wide.columns.tolist(), ["Entity", "Year", "headcount_190", "headcount_320"])
+
+    def test_duplicated_keys_raise(self):
+        """Keys appearing more than once should raise an error instead of being averaged."""
+        df = pd.concat([self.df, self.df.iloc[[0]]], ignore_index=True)
+        with self.assertRaisesRegex(ValueError, "2 rows have duplicated keys"):
+            unstack_strict(df, ["Entity", "Year"], "poverty line", ["headcount", "watts"])
+
+
+class TestAdditionalVariables(unittest.TestCase):
+    """Unit tests for the variables derived from the data of several poverty lines."""
+
+    def setUp(self):
+        self.povlines = [100, 200, 300, 400, 500, 600, 700, 2435]
+        headcounts = np.array([
+            [10, 20, 30, 40, 50, 60, 70, 80],
+            [10, 20, 15, 40, 50, 60, 70, 80],
+            [10, 20, 30, np.nan, 50, 60, 70, 80],
+        ])
+        columns = {"Entity": ["A", "B", "C"], "Year": [2000] * 3, "reporting_pop": [100.0] * 3, "mean": [2.0] * 3}
+        for j, povline in enumerate(self.povlines):
+            columns[f"headcount_{povline}"] = headcounts[:, j]
+            columns[f"headcount_ratio_{povline}"] = headcounts[:, j]
+            columns[f"poverty_gap_index_{povline}"] = [1.0] * 3
+            columns[f"total_shortfall_{povline}"] = [1.0] * 3
+        for i in range(1, 11):
+            columns[f"decile{i}_share"] = [i / 55] * 3
+            if i != 10:
+                columns[f"decile{i}_thr"] = [float(i)] * 3
+        self.df = pd.DataFrame(columns)
+
+    def test_variables_and_checks(self):
+        """Derived variables should be computed for each row, and rows with issues dropped."""
+        df, cols = additional_variables_and_check(self.df.copy(), self.povlines, [], 2017,
+                                                   stacked_between_cents=[(200, 500)])
+        # Headcounts that decrease, or that are missing, are dropped.
+        self.assertEqual(df["Entity"].tolist(), ["A"])
+        self.assertEqual(df["headcount_above_2435"][0], 20)
+        self.assertEqual(df["headcount_ratio_above_100"][0], 90)
+        # The line of high income countries is left out of the stacked variables.
+        self.assertEqual([df[f"headcount_stacked_below_{povline}"][0] for povline in self.povlines[:-1]], [10] * 7)
+        self.assertEqual(df["headcount_stacked_above_700"][0], 30)
+        self.assertEqual(df["headcount_ratio_stacked_between_200_500"][0], 30)
+        self.assertAlmostEqual(df["sum_pct"][0], 100)
+        self.assertAlmostEqual(df["decile10_share"][0], 1000 / 55)
+        self.assertAlmostEqual(df["decile10_avg"][0], 10 / 55 * 2 / 0.1)
+        self.assertAlmostEqual(df["quintile1_share"][0], 300 / 55)
+        self.assertAlmostEqual(df["palma_ratio"][0], 1)
+        self.assertEqual(df["p90_p10_ratio"][0], 9)
+        # Variables of each line are interleaved (number, then percentage), and the checks are kept at the end.
+        new_columns = df.columns[len(self.df.columns):].tolist()
+        self.assertEqual(new_columns[:4], ["headcount_above_100", "headcount_ratio_above_100",
+                                           "headcount_above_200", "headcount_ratio_above_200"])
+        self.assertEqual(new_columns[-3:], ["m_check_6", "m_check_7", "check_total"])
+        self.assertTrue(set(new_columns) - {"sum_pct", "check_total"} - {f"m_check_{i}" for i in range(1, 8)}
+                        <= set(cols))
+
+    def test_default_stacked_bands(self):
+        """By default, people should be counted between the pairs of lines of the PPP version."""
+        povlines = [100, 215, 365, 685, 1000, 2000, 2435, 3000, 4000]
+        df = self.df.drop(columns=[column for column in self.df.columns if column.split("_")[-1].isdigit()
+                                   and not column.startswith("decile")])
+        for j, povline in enumerate(povlines):
+            for variable in ("headcount", "headcount_ratio"):
+                df[f"{variable}_{povline}"] = float(10 * (j + 1))
+            df[f"poverty_gap_index_{povline}"] = 1.0
+            df[f"total_shortfall_{povline}"] = 1.0
+
+        df, cols = additional_variables_and_check(df, povlines, [], 2017)
+        self.assertEqual(df["headcount_stacked_between_215_1000"][0], 30)
+        self.assertEqual(df["headcount_stacked_between_1000_3000"][0], 30)
+        self.assertNotIn("headcount_stacked_below_2435", df.columns)
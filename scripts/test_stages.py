@@ -0,0 +1,104 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import pandas as pd
+
+from scripts import shared
+from scripts.stages import Stage, StageGraph, _package_modules, hash_code
+
+
+class TestStageGraph(unittest.TestCase):
+    """Unit tests for the incremental rebuild of a graph of stages."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.state_dir = Path(self.temp_dir.name) / "stages"
+        self.mapping_file = Path(self.temp_dir.name) / "mapping.csv"
+        self.mapping_file.write_text("country,name\nA,Country A\n")
+        self.calls = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_graph(self, povlines, always_run_query=False):
+        calls = self.calls
+
+        def query(povlines):
+            calls.append("query")
+            return pd.DataFrame({"Entity": ["A"] * len(povlines), "poverty_line": povlines})
+
+        def count(df_final):
+            calls.append("count")
+            return pd.DataFrame({"Entity": ["A"], "n_lines": [len(df_final)]})
+
+        def label(df_final):
+            calls.append("label")
+            return df_final.assign(name=pd.read_csv(self.mapping_file)["name"]), list(df_final.columns)
+
+        stages = [
+            Stage("query", query, outputs=["lines"], params={"povlines": povlines}, always_run=always_run_query),
+            Stage("count", count, outputs=["counts"], inputs={"df_final": "lines"}),
+            Stage("label", label, outputs=["labelled", "cols"], inputs={"df_final": "counts"},
+                  input_files=[self.mapping_file]),
+        ]
+
+        return StageGraph(stages, state_dir=self.state_dir)
+
+    def test_only_out_of_date_stages_run(self):
+        """Stages should only run again when their parameters, inputs or files change."""
+        values = self.make_graph([1, 2]).run()
+        self.assertEqual(self.calls, ["query", "count", "label"])
+        self.assertEqual(values["cols"], ["Entity", "n_lines"])
+
+        self.calls.clear()
+        self.make_graph([1, 2]).run()
+        self.assertEqual(self.calls, [])
+
+        # A change of parameters propagates downstream.
+        self.make_graph([1, 2, 3]).run()
+        self.assertEqual(self.calls, ["query", "count", "label"])
+
+        # A change of an input file only reruns the stage that reads it.
+        self.calls.clear()
+        self.mapping_file.write_text("country,name\nA,Country A (new)\n")
+        self.make_graph([1, 2, 3]).run()
+        self.assertEqual(self.calls, ["label"])
+
+    def test_code_of_helpers_in_fingerprint(self):
+        """The fingerprint of a stage should change with the code of the modules of the package it relies on."""
+        module_names = [module.__name__ for module in _package_modules(shared.query_poverty)]
+        # Helpers called by query_poverty live in other modules (e.g. stacked bands, or the storage of files).
+        self.assertIn("scripts.bands", module_names)
+        self.assertIn("scripts.storage", module_names)
+        self.assertNotIn("pandas", module_names)
+
+        def source(obj, edited=None):
+            return "edited" if obj.__name__ == edited else f"source of {obj.__name__}"
+
+        with mock.patch("scripts.stages.inspect.getsource", side_effect=source):
+            code_hash = hash_code(shared.query_poverty)
+        with mock.patch("scripts.stages.inspect.getsource", side_effect=lambda obj: source(obj, "scripts.bands")):
+            self.assertNotEqual(hash_code(shared.query_poverty), code_hash)
+
+    def test_identical_outputs_do_not_propagate(self):
+        """A stage that runs again with an identical output should not rerun the stages downstream."""
+        self.make_graph([1, 2]).run()
+        self.calls.clear()
+        self.make_graph([1, 2], always_run_query=True).run()
+        self.assertEqual(self.calls, ["query"])
+
+    def test_select_stages(self):
+        """Only selected stages should run, using the stored outputs of the others."""
+        graph = self.make_graph([1, 2])
+        self.assertEqual(graph.select(["count+"]), ["count", "label"])
+        with self.assertRaises(RuntimeError):
+            graph.run(selectors=["count"])
+
+        graph.run()
+        self.calls.clear()
+        values = self.make_graph([1, 2, 3]).run(selectors=["label"], force=True)
+        self.assertEqual(self.calls, ["label"])
+        # The stored (out of date) counts were used.
+        self.assertEqual(values["labelled"]["n_lines"].tolist(), [2])
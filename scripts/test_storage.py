@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.storage import FORMAT_SUFFIXES, configure_storage, read_intermediate, write_intermediate
+
+
+class TestIntermediateStorage(unittest.TestCase):
+    """Unit tests for the storage of intermediate files."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / "percentiles"
+        self.df = pd.DataFrame({
+            "Entity": ["Chile", "Chile"],
+            "Year": [2000, 2000],
+            "target_percentile": ["P1", "P2"],
+            "poverty line": ["_100", "_190"],
+            "percentile_value": [1.23, float("nan")],
+        })
+
+    def tearDown(self):
+        configure_storage()
+        self.temp_dir.cleanup()
+
+    def test_round_trip_in_all_formats(self):
+        """Data should be read back identically from any storage format."""
+        for storage_format in FORMAT_SUFFIXES:
+            configure_storage(storage_format)
+            file = write_intermediate(self.df, self.path)
+            self.assertEqual(file.suffix, FORMAT_SUFFIXES[storage_format])
+            pd.testing.assert_frame_equal(read_intermediate(self.path), self.df)
+
+    def test_read_files_in_other_formats(self):
+        """Files written in another format (e.g. csv files of previous runs) should still be read."""
+        configure_storage("csv")
+        write_intermediate(self.df, self.path)
+        configure_storage("parquet", export_csv=True)
+        pd.testing.assert_frame_equal(read_intermediate(self.path), self.df)
+        write_intermediate(self.df.iloc[:1], self.path)
+        # The file in the configured format is preferred, and the csv export is kept up to date.
+        pd.testing.assert_frame_equal(read_intermediate(self.path), self.df.iloc[:1])
+        self.assertEqual(len(pd.read_csv(self.path.with_name("percentiles.csv"))), 1)
+
+    def test_format_switch_reads_latest(self):
+        """After switching formats back and forth, the latest data should be read, and older copies removed."""
+        configure_storage("parquet")
+        write_intermediate(self.df.iloc[:1], self.path)
+        configure_storage("csv")
+        write_intermediate(self.df, self.path)
+        self.assertFalse(self.path.with_name("percentiles.parquet").exists())
+        configure_storage("parquet")
+        pd.testing.assert_frame_equal(read_intermediate(self.path), self.df)
+        configure_storage("feather", export_csv=True)
+        write_intermediate(self.df.iloc[:1], self.path)
+        self.assertEqual(sorted(file.name for file in self.path.parent.iterdir()),
+                         ["percentiles.csv", "percentiles.feather"])
@@ -0,0 +1,65 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from scripts.pip_client import CircuitBreaker, PIPRequestError, RetryPolicy, get_with_retries
+from scripts.telemetry import FetchMetrics, endpoint_of
+
+
+class TestFetchMetrics(unittest.TestCase):
+    """Unit tests for the metrics of the requests to the PIP API."""
+
+    def test_endpoint_of(self):
+        """The endpoint should be the last part of the path of the URL."""
+        self.assertEqual(endpoint_of("https://api.worldbank.org/pip/v1/pip?povline=1.9"), "pip")
+        self.assertEqual(endpoint_of("https://api.worldbank.org/pip/v1//pip-grp?povline=1.9"), "pip-grp")
+
+    def test_attempts_retries_and_failures_are_recorded(self):
+        """Each attempt should be recorded with its status and size, and each retry and failure counted."""
+        metrics = FetchMetrics(labels={"ppp_version": 2017}, buckets=(1, 10))
+        responses = [mock.Mock(status_code=503, content=b"", headers={}), mock.Mock(status_code=200, content=b"ok")]
+        with mock.patch("scripts.pip_client.requests.get", side_effect=responses),\
+                mock.patch("scripts.pip_client.time.sleep"):
+            get_with_retries("https://example.com/pip?povline=1", RetryPolicy(backoff_base=0), CircuitBreaker(),
+                             metrics=metrics)
+        with mock.patch("scripts.pip_client.requests.get", return_value=mock.Mock(status_code=404, content=b"no")):
+            with self.assertRaises(PIPRequestError):
+                get_with_retries("https://example.com/pip-grp?povline=1", RetryPolicy(), CircuitBreaker(),
+                                 metrics=metrics)
+        metrics.record_cache(hit=True)
+
+        summary = metrics.summary()
+        self.assertEqual(summary["endpoints"]["pip"]["attempts"], 2)
+        self.assertEqual(summary["endpoints"]["pip"]["statuses"], {"200": 1, "503": 1})
+        self.assertEqual(summary["endpoints"]["pip"]["retries"], 1)
+        self.assertEqual(summary["endpoints"]["pip"]["bytes_received"], 2)
+        self.assertEqual(summary["endpoints"]["pip"]["content_bytes"], 2)
+        self.assertEqual(summary["endpoints"]["pip-grp"]["failures"], 1)
+        self.assertEqual(summary["cache"], {"hits": 1, "misses": 0})
+
+        text = metrics.to_prometheus()
+        self.assertIn('pip_request_duration_seconds_bucket{endpoint="pip",le="+Inf",ppp_version="2017"} 2', text)
+        self.assertIn('pip_responses_total{endpoint="pip",ppp_version="2017",status="503"} 1', text)
+        self.assertIn('pip_cache_lookups_total{ppp_version="2017",result="hit"} 1', text)
+
+        # Compressed responses are counted by the bytes received over the network, and their size once decompressed.
+        gzipped = mock.Mock(status_code=200, content=b"x" * 100, headers={"Content-Length": "30"})
+        gzipped.raw.tell.return_value = 30
+        with mock.patch("scripts.pip_client.requests.get", return_value=gzipped):
+            get_with_retries("https://example.com/pip?povline=2", RetryPolicy(), CircuitBreaker(), metrics=metrics)
+        summary = metrics.summary()
+        self.assertEqual(summary["endpoints"]["pip"]["bytes_received"], 32)
+        self.assertEqual(summary["endpoints"]["pip"]["content_bytes"], 102)
+
+    def test_export(self):
+        """Metrics should be exported as a JSON summary and a Prometheus textfile."""
+        metrics = FetchMetrics()
+        metrics.record_attempt("https://example.com/pip", 0.2, status="200", n_bytes=10)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_file = Path(temp_dir) / "metrics/fetch.json"
+            prometheus_file = Path(temp_dir) / "metrics/fetch.prom"
+            metrics.export(json_file=json_file, prometheus_file=prometheus_file)
+            self.assertEqual(json.loads(json_file.read_text())["endpoints"]["pip"]["bytes_received"], 10)
+            self.assertIn('pip_response_bytes_total{endpoint="pip"} 10', prometheus_file.read_text())
@@ -10,7 +10,7 @@ from pathlib import Path
 from tqdm.auto import tqdm
 from owid.datautils.io.s3 import S3
 
-from scripts.shared import OUTPUT_CSV_FILE, OUTPUT_XLSX_FILE
+from scripts.constants import OUTPUT_CSV_FILE, OUTPUT_XLSX_FILE
 
 # Define S3 base URL.
 S3_URL = "https://nyc3.digitaloceanspaces.com"